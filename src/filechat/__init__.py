@@ -1,63 +1,204 @@
-import datetime
-import logging
-import os
-from argparse import ArgumentParser
+import time
+
+_IMPORT_START = time.perf_counter()
 
-from mistralai import Mistral
-from openai import OpenAI
+import importlib
+import sys
+from argparse import ArgumentParser
 
-from filechat.chat import Chat, ChatStore
-from filechat.config import CONFIG_PATH_DEFAULT, load_config
-from filechat.embedder import Embedder
-from filechat.index import get_index
-from filechat.tui import FilechatApp
-from filechat.watcher import FileWatcher
+# Importing these pulls in the LLM SDKs, Textual, faiss and onnxruntime, which takes a second or
+# more. They are imported on first use, so e.g. `filechat --help` doesn't pay for it.
+_LAZY_ATTRIBUTES = {
+    "Chat": "filechat.chat",
+    "ChatStore": "filechat.chat",
+    "CONFIG_PATH_DEFAULT": "filechat.config",
+    "load_config": "filechat.config",
+    "Embedder": "filechat.embedder",
+    "get_index": "filechat.index",
+    "get_workspace": "filechat.workspace",
+    "FilechatApp": "filechat.tui",
+    "FileWatcher": "filechat.watcher",
+}
 
-arg_parser = ArgumentParser(description="Chat with an LLM about your local project")
-arg_parser.add_argument("directory", type=str, help="Directory to index files from")
+arg_parser = ArgumentParser(
+    description="Chat with an LLM about your local project",
+    epilog="Run `filechat {index,search,ask,daemon} -h` for commands without the chat UI.",
+)
+arg_parser.add_argument(
+    "directories",
+    nargs="+",
+    metavar="directory",
+    help="Directory to index files from, several directories are opened as one workspace",
+)
 arg_parser.add_argument(
     "-r", "--rebuild", action="store_true", help="Ignore cache, rebuild index from scratch"
 )
 arg_parser.add_argument(
-    "-c", "--config", type=str, help="Path to a config file", default=CONFIG_PATH_DEFAULT
+    "-c", "--config", type=str, help="Path to a config file (default: ~/.config/filechat.json)"
 )
 arg_parser.add_argument(
     "-s", "--setup", action="store_true", help="Discard config and run LLM provider setup"
 )
+arg_parser.add_argument(
+    "--no-daemon", action="store_true", help="Don't use a running daemon, load the index here"
+)
+arg_parser.add_argument(
+    "--profile-startup",
+    action="store_true",
+    help="Print how long each phase of startup took after exiting",
+)
+arg_parser.add_argument(
+    "--metrics",
+    action="store_true",
+    help="Collect timing metrics of indexing, search and LLM responses, see them with /stats",
+)
+
+# `filechat <directory>` starts the chat UI, these commands are recognized by the first argument
+command_parser = ArgumentParser(prog="filechat", description="Use FileChat without the chat UI")
+commands = command_parser.add_subparsers(dest="command", required=True)
+index_parser = commands.add_parser(
+    "index", help="Build or update the index of a directory and store it"
+)
+index_parser.add_argument("directory", type=str, help="Directory to index files from")
+index_parser.add_argument(
+    "-r", "--rebuild", action="store_true", help="Ignore cache, rebuild index from scratch"
+)
+search_parser = commands.add_parser(
+    "search", help="Print the files most relevant to a query as JSON"
+)
+search_parser.add_argument("directory", type=str, help="Directory to search")
+search_parser.add_argument("query", type=str, help="What to search for")
+search_parser.add_argument(
+    "-k", "--top-k", type=int, default=10, help="Number of files to return (default: 10)"
+)
+ask_parser = commands.add_parser("ask", help="Stream an answer to a single question to stdout")
+ask_parser.add_argument("directory", type=str, help="Directory the question is about")
+ask_parser.add_argument("question", type=str, help="Question to ask")
+daemon_parser = commands.add_parser(
+    "daemon", help="Keep the embedding model and indexes in memory for other filechat processes"
+)
+daemon_action = daemon_parser.add_mutually_exclusive_group()
+daemon_action.add_argument("--stop", action="store_true", help="Stop the running daemon")
+daemon_action.add_argument(
+    "--status", action="store_true", help="Print the projects the running daemon has open"
+)
+daemon_action.add_argument(
+    "--stats",
+    action="store_true",
+    help="Print the metrics of a daemon started with --metrics, in the Prometheus text format",
+)
+for parser in (index_parser, search_parser, ask_parser, daemon_parser):
+    parser.add_argument(
+        "-c", "--config", type=str, help="Path to a config file (default: ~/.config/filechat.json)"
+    )
+for parser in (index_parser, search_parser, ask_parser):
+    parser.add_argument(
+        "--no-daemon", action="store_true", help="Don't use a running daemon, load the index here"
+    )
+for parser in (search_parser, ask_parser):
+    parser.add_argument(
+        "--no-update",
+        action="store_true",
+        help="Use the stored index as it is, without indexing new and changed files",
+    )
+for parser in (index_parser, search_parser, ask_parser, daemon_parser):
+    parser.add_argument(
+        "--metrics", action="store_true", help="Collect timing metrics of the command"
+    )
+for parser in (arg_parser, index_parser, search_parser, ask_parser, daemon_parser):
+    parser.add_argument(
+        "--metrics-file",
+        type=str,
+        help=(
+            "Write the collected metrics to this file on exit, as JSON if it ends with .json, in"
+            " the Prometheus text format otherwise (implies --metrics)"
+        ),
+    )
+
+
+def __getattr__(name: str):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in commands.choices:
+        from filechat import cli
+
+        cli.run(command_parser.parse_args())
+        return
+
     args = arg_parser.parse_args()
-    config = load_config(args.config, args.setup)
 
-    os.makedirs(config.log_dir, exist_ok=True)
-    log_file = os.path.join(
-        config.log_dir, datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + ".log"
-    )
-    logging.basicConfig(level=logging.INFO, handlers=[logging.FileHandler(log_file)])
+    from filechat import metrics
+    from filechat.chat import Chat, ChatStore, create_client
+    from filechat.config import CONFIG_PATH_DEFAULT, load_config
+    from filechat.daemon import RemoteIndex, connect
+    from filechat.tui import FilechatApp
+    from filechat.utils import StartupProfiler, setup_logging
+    from filechat.workspace import Workspace
 
-    embedder = Embedder(
-        config.embedding_model, config.embedding_model_path, config.embedding_model_url
-    )
+    profiler = StartupProfiler(_IMPORT_START)
+    profiler.mark("imports")
+    if args.metrics or args.metrics_file:
+        metrics.enable(args.metrics_file)
+
+    config = load_config(args.config or CONFIG_PATH_DEFAULT, args.setup)
 
-    index, _ = get_index(args.directory, config, embedder, args.rebuild)
-    watcher = FileWatcher(index, config)
-    watcher.start()
+    setup_logging(config.log_dir)
+    profiler.mark("config")
 
-    if config.model.provider == "openai":
-        client = OpenAI(api_key=config.model.api_key)
-    elif config.model.provider == "openai-selfhosted":
-        client = OpenAI(api_key=config.model.api_key, base_url=config.model.base_url)
-    elif config.model.provider == "mistral":
-        client = Mistral(api_key=config.model.api_key)
+    daemon_client = None if args.no_daemon else connect(config)
+    watchers = []
+    if daemon_client is not None:
+        # The daemon has the model loaded and keeps the indexes up to date
+        indexes = [RemoteIndex(daemon_client, d) for d in args.directories]
+        for index in indexes:
+            index.open(args.rebuild)
+        profiler.mark("daemon open")
+    else:
+        # The model, faiss and the file watcher are only needed without a daemon
+        from filechat.embedder import Embedder
+        from filechat.index import load_index, update_index
+        from filechat.watcher import FileWatcher
 
-    chat = Chat(client, config.model.model, config, args.directory)
-    chat_store = ChatStore(args.directory, config, client)
+        embedder = Embedder(
+            config.embedding_model, config.embedding_model_path, config.embedding_model_url
+        )
+        profiler.mark("model load")
 
-    app = FilechatApp(chat, index, chat_store)
+        indexes = [load_index(d, config, embedder, args.rebuild) for d in args.directories]
+        profiler.mark("index load")
+        for index in indexes:
+            update_index(index, config)
+        profiler.mark("reconcile")
+
+        watchers = [FileWatcher(index, config) for index in indexes]
+        for watcher in watchers:
+            watcher.start()
+        profiler.mark("watcher start")
+
+    index = indexes[0] if len(indexes) == 1 else Workspace(indexes, config)
+    client = create_client(config.model)
+    chat = Chat(client, config.model.model, config, index.directory(), index=index)
+    chat_store = ChatStore(index.directory(), config, client, index)
+    profiler.mark("chat setup")
+
+    app = FilechatApp(chat, index, chat_store, profiler)
     app.run()
 
-    watcher.stop()
+    for watcher in watchers:
+        watcher.stop()
+    if daemon_client is not None:
+        daemon_client.close()
+    chat_store.close()
+
+    if args.profile_startup:
+        print(profiler.report())
+    if args.metrics_file:
+        metrics.dump()
+        print(f"Metrics written to {args.metrics_file}")
 
 
 if __name__ == "__main__":
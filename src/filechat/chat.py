@@ -1,21 +1,52 @@
+import asyncio
 import json
+import logging
 import os
+import queue
+import socket
 import sqlite3
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from hashlib import sha256
 from pathlib import Path
 from textwrap import dedent
+from typing import TYPE_CHECKING
 
-from mistralai import Mistral
-from openai import OpenAI, omit
+from filechat import metrics, tools
+from filechat.config import Config, ModelConfig
+from filechat.context import ContextBuilder
+from filechat.daemon import RemoteIndex
+from filechat.index import FileIndex, IndexedFile
+from filechat.tree import ProjectTree
+from filechat.utils import process_running, truncate_text
+from filechat.workspace import Workspace
 
-from filechat import tools
-from filechat.config import Config
-from filechat.index import IndexedFile
-from filechat.utils import truncate_text
+if TYPE_CHECKING:
+    from mistralai import Mistral
+    from openai import AsyncOpenAI, OpenAI
+
+LLM_FIRST_TOKEN_SECONDS = metrics.histogram(
+    "filechat_llm_first_token_seconds", "Time from sending a request to the LLM to its first token"
+)
+LLM_RESPONSE_SECONDS = metrics.histogram(
+    "filechat_llm_response_seconds", "Time from sending a request to the LLM to its last token"
+)
+LLM_TOKENS_PER_SECOND = metrics.histogram(
+    "filechat_llm_tokens_per_second",
+    "Completion tokens streamed per second after the first one, per response",
+    metrics.RATE_BUCKETS,
+)
+SQLITE_WRITE_SECONDS = metrics.histogram(
+    "filechat_sqlite_write_seconds", "Writing to the chat database, in one transaction"
+)
 
 
 class Chat:
     TITLE_MAX_LENGTH = 30
+    MAX_TOOL_WORKERS = 8
 
     SYSTEM_MESSAGE = dedent("""\
     You are a local development assistant with access to project files. You help developers understand, debug, and improve their codebase.
@@ -34,84 +65,165 @@ class Chat:
     - Provide concrete, implementable solutions
     - This doesn't cover every file in the project, only the most relevant ones. You can use tools to get other files if you consider it useful
 
-    You have programmatic tools to inspect the project (list_directory and read_file). 
+    You have programmatic tools to inspect the project (list_directory and read_file, and if available search_code, grep and find_symbol).
     When you need any file contents or directory listing to answer correctly, prefer using those tools instead of guessing.
-    If you call read_file, pass the exact relative path within the project.
+    To locate code, use search_code for concepts, grep for exact text and find_symbol for definitions. They return line numbers and snippets, so you often don't need to read whole files.
+    If you call read_file, pass the exact relative path within the project. When you only need part of a file, e.g. a function found with find_symbol, read just those lines with start_line and end_line.
+    If you need several files or listings, request all of them at once in parallel tool calls instead of one by one.
     
     Respond with actionable advice. When suggesting code changes, show specific examples using the project's existing conventions.
     """)
 
+    WORKSPACE_MESSAGE = dedent("""
+    The workspace consists of several projects: {roots}. Every path starts with the name of its project, followed by the path within the project. List the directory "." to see all projects.
+    """)
+
     def __init__(
         self,
-        client: Mistral | OpenAI,
+        client: "Mistral | OpenAI",
         model: str,
         config: Config,
         project_directory: str,
         chat_id: int | None = None,
+        index: FileIndex | RemoteIndex | Workspace | None = None,
     ):
-        self._message_history: list[dict] = [{"role": "system", "content": self.SYSTEM_MESSAGE}]
+        system_message = self.SYSTEM_MESSAGE
+        if isinstance(index, Workspace):
+            system_message += self.WORKSPACE_MESSAGE.format(roots=", ".join(index.roots()))
+        self._message_history: list[dict] = [{"role": "system", "content": system_message}]
         self._model = model
         self._client = client
         self._config = config
         self._project_directory = Path(project_directory)
         self._id = chat_id
+        self._index = index
+        self._tree = index.tree() if index is not None else None
+        self._tool_cache = tools.ToolCache()
+        self._first_message_id = 0
+        self._load_older: Callable[[int, int | None], list[dict]] | None = None
+        # Messages before the window, once they're loaded because the model needs them
+        self._earlier_messages: list[dict] | None = None
+        self._context_builder = ContextBuilder(config)
+        self._usage = UsageStats()
+        self._last_usage = UsageStats()
+        self._async_openai: "AsyncOpenAI | None" = None
+        self._response = None
+        self._task: asyncio.Task | None = None
+        self._cancelled = threading.Event()
+        self._request_time: float | None = None
+        self._first_token_time: float | None = None
 
     def user_message(self, message: str | None, files: list[IndexedFile], use_tools: bool = True):
-        if message:
-            user_message = {"role": "user", "content": message}
-            self._message_history.append(user_message)
+        turn = self._start_turn(message, files)
+        if turn is None:
+            return
 
-        if isinstance(self._client, Mistral):
-            response = self._client.chat.stream(
-                model=self._model,
-                messages=self._history_with_context(files),  # type: ignore
-                tools=tools.TOOLS if use_tools else None,  # type: ignore
-                tool_choice="auto" if use_tools else "none"
-            )
+        messages, files = turn
+        request = self._request(messages, use_tools)
+        self._start_response_timing()
+        if _is_mistral(self._client):
+            response = self._client.chat.stream(**request)
         else:
-            response = self._client.chat.completions.create(
-                model=self._model,
-                messages=self._history_with_context(files),  # type: ignore
-                tools=tools.TOOLS if use_tools else None,  # type: ignore
-                stream=True,
-                parallel_tool_calls=False if use_tools else omit,
-            )
+            response = self._client.chat.completions.create(**request)
 
         response_str = ""
-        tool_call_id = tool_call_name = tool_call_arguments = None
+        tool_calls: dict[int, dict] = {}
 
-        for chunk in response:
-            if hasattr(chunk, "data"):
-                chunk = chunk.data
+        self._response = response
+        if self._cancelled.is_set():
+            _close_stream(response)
 
-            chunk_delta = chunk.choices[0].delta  # type: ignore
+        try:
+            for chunk in response:
+                if self._cancelled.is_set():
+                    break
+                text = self._read_chunk(chunk, tool_calls)
+                if text:
+                    response_str += text
+                    yield text
+        except Exception:
+            # Closing the stream makes the pending read fail
+            if not self._cancelled.is_set():
+                raise
+        finally:
+            self._response = None
 
-            if not chunk_delta.content and not chunk_delta.tool_calls:
-                continue
+        tool_calls_complete = self._finish_response(response_str, files, tool_calls)
+        if tool_calls_complete:
+            yield from self._call_tools(tool_calls_complete)
 
-            if chunk_delta.tool_calls:
-                if not tool_call_id:
-                    tool_call_id = chunk_delta.tool_calls[0].id
-                    tool_call_name = chunk_delta.tool_calls[0].function.name
-                    tool_call_arguments = chunk_delta.tool_calls[0].function.arguments
-                else:
-                    assert isinstance(tool_call_arguments, str)
-                    tool_call_arguments += str(chunk_delta.tool_calls[0].function.arguments)
-                continue
+    async def user_message_async(
+        self, message: str | None, files: list[IndexedFile], use_tools: bool = True
+    ):
+        """Same as `user_message`, but streams and calls tools on the running event loop."""
+        # Counting tokens and loading older messages would block the loop
+        turn = await asyncio.to_thread(self._start_turn, message, files)
+        if turn is None:
+            return
 
-            chunk_content = chunk_delta.content
-            response_str += str(chunk_content)
-            yield str(chunk_content)
+        messages, files = turn
+        request = self._request(messages, use_tools)
+        response_str = ""
+        tool_calls: dict[int, dict] = {}
 
-        filenames = [f.path() for f in files]
-        self._message_history.append({
-            "role": "assistant",
-            "content": response_str,
-            "files_used": filenames,
-        })
+        # Cancelling interrupts the task wherever it waits, there's no need to wait for a chunk
+        self._task = asyncio.current_task()
+        try:
+            if self._cancelled.is_set():
+                raise asyncio.CancelledError()
+            self._start_response_timing()
+            if _is_mistral(self._client):
+                response = await self._client.chat.stream_async(**request)
+            else:
+                response = await self._async_client().chat.completions.create(**request)
+
+            try:
+                async for chunk in response:
+                    if self._cancelled.is_set():
+                        break
+                    text = self._read_chunk(chunk, tool_calls)
+                    if text:
+                        response_str += text
+                        yield text
+            finally:
+                await response.response.aclose()
+        except asyncio.CancelledError:
+            task = asyncio.current_task()
+            if not self._cancelled.is_set() or task is None:
+                raise
+            task.uncancel()
+        finally:
+            self._task = None
+
+        tool_calls_complete = self._finish_response(response_str, files, tool_calls)
+        if tool_calls_complete:
+            for tool_message in await self._call_tools_async(tool_calls_complete):
+                yield tool_message
+
+    def cancel(self):
+        """Stops the current turn, immediately closing the response being streamed."""
+        self._cancelled.set()
+        response = self._response
+        if response is not None:
+            _close_stream(response)
+        task = self._task
+        if task is not None:
+            task.get_loop().call_soon_threadsafe(self._cancel_task, task)
 
-        if tool_call_id and tool_call_name and tool_call_arguments:
-            yield self._call_tool(tool_call_id, tool_call_name, str(tool_call_arguments))
+    async def aclose(self):
+        """Closes the client `user_message_async` streams with, if it was created."""
+        if self._async_openai is not None:
+            await self._async_openai.close()
+            self._async_openai = None
+
+    def _cancel_task(self, task: asyncio.Task):
+        # The turn may have ended before the loop got here
+        if self._task is task:
+            task.cancel()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
 
     @property
     def chat_id(self) -> int | None:
@@ -128,6 +240,58 @@ class Chat:
     @messages.setter
     def messages(self, messages: list[dict]):
         self._message_history = messages
+        self._context_builder.reset()
+
+    @property
+    def first_message_id(self) -> int:
+        """Stored id of the first message in `messages`, non-zero if older ones aren't loaded."""
+        return self._first_message_id
+
+    @property
+    def has_older_messages(self) -> bool:
+        return self._first_message_id > 0
+
+    def set_message_window(
+        self,
+        messages: list[dict],
+        first_message_id: int,
+        load_older: Callable[[int, int | None], list[dict]],
+    ):
+        self.messages = messages
+        self._first_message_id = first_message_id
+        self._load_older = load_older
+        self._earlier_messages = None
+
+    def load_older_messages(self, count: int | None = None) -> list[dict]:
+        """Prepends up to `count` (default all) older stored messages and returns them."""
+        if not self.has_older_messages:
+            return []
+
+        if self._earlier_messages is None:
+            assert self._load_older is not None
+            older = self._load_older(self._first_message_id, count)
+            self.messages = older + self._message_history
+        else:
+            # Loaded for the model already, which saw the same conversation, so the context
+            # builder's state stays valid
+            split = 0 if count is None else max(len(self._earlier_messages) - count, 0)
+            older = self._earlier_messages[split:]
+            self._earlier_messages = self._earlier_messages[:split]
+            self._message_history = older + self._message_history
+        self._first_message_id -= len(older)
+        return older
+
+    @property
+    def tool_cache(self) -> tools.ToolCache:
+        return self._tool_cache
+
+    @property
+    def usage(self) -> "UsageStats":
+        return self._usage
+
+    @property
+    def last_usage(self) -> "UsageStats":
+        return self._last_usage
 
     @property
     def title(self):
@@ -137,88 +301,374 @@ class Chat:
         first_user_message = self._message_history[1]["content"]
         return truncate_text(first_user_message, 50)
 
-    def _history_with_context(self, files: list[IndexedFile]) -> list[dict]:
-        message = (
-            "Here are the most relevant files to user's query found using embedding search."
-            "These are not the same as files returned via a tool call. Do no confuse the two."
-            "If you think these files are not enough, feel free to call a tool."
-        )
-        message += "<context>"
-
-        for file in files:
-            message += "<file>"
-            message += file.content_for_embedding()
-            message += "</file>"
-
-        message += "</context>"
-
-        messages = self._message_history.copy()
-        messages.insert(
-            1,
-            {
-                "role": "system",
-                "content": message,
-            },
-        )
+    def _history_with_context(
+        self, files: list[IndexedFile]
+    ) -> tuple[list[dict], list[IndexedFile]]:
+        history = (self._earlier_messages or []) + self._message_history
+        return self._context_builder.build(history, files)
 
-        return messages
+    def _tools(self) -> list[dict]:
+        if self._index is not None:
+            return tools.TOOLS
+        return [t for t in tools.TOOLS if t["function"]["name"] not in tools.INDEX_TOOLS]
 
-    def _call_tool(self, tool_call_id: str, tool_call_name: str, tool_call_arguments: str) -> dict:
-        arguments_parsed: dict = json.loads(tool_call_arguments)
-        if tool_call_name == "list_directory":
-            try:
-                result = tools.list_directory(
-                    self._project_directory, arguments_parsed["path"], self._config
-                )
-            except Exception as e:
-                result = e
-        elif tool_call_name == "read_file":
-            try:
-                result = tools.read_file(
-                    self._project_directory, arguments_parsed["path"], self._config
-                )
-            except Exception as e:
-                result = e
-        else:
-            raise ValueError(f"Unknown tool '{tool_call_name}'")
+    def _start_turn(
+        self, message: str | None, files: list[IndexedFile]
+    ) -> tuple[list[dict], list[IndexedFile]] | None:
+        # A new message starts a new turn, a cancelled turn isn't continued with tool results
+        if message:
+            self._cancelled.clear()
+        if self._cancelled.is_set():
+            return None
+
+        # The model needs the whole conversation, the window only limits what's shown
+        if self.has_older_messages and self._earlier_messages is None:
+            assert self._load_older is not None
+            self._earlier_messages = self._load_older(self._first_message_id, None)
+            self._context_builder.reset()
+
+        if message:
+            user_message = {"role": "user", "content": message}
+            self._message_history.append(user_message)
+
+        self._last_usage = UsageStats()
+        return self._history_with_context(files)
+
+    def _request(self, messages: list[dict], use_tools: bool) -> dict:
+        if _is_mistral(self._client):
+            return {
+                "model": self._model,
+                "messages": messages,
+                "tools": self._tools() if use_tools else None,
+                "tool_choice": "auto" if use_tools else "none",
+                "parallel_tool_calls": True if use_tools else None,
+            }
+
+        from openai import omit
+
+        return {
+            "model": self._model,
+            "messages": messages,
+            "tools": self._tools() if use_tools else None,
+            "stream": True,
+            "stream_options": {"include_usage": True},
+            "parallel_tool_calls": True if use_tools else omit,
+        }
+
+    def _async_client(self) -> "AsyncOpenAI":
+        if self._async_openai is None:
+            from openai import AsyncOpenAI
+
+            self._async_openai = AsyncOpenAI(
+                api_key=self._client.api_key, base_url=self._client.base_url
+            )
+        return self._async_openai
+
+    def _read_chunk(self, chunk, tool_calls: dict[int, dict]) -> str:
+        if hasattr(chunk, "data"):
+            chunk = chunk.data
+
+        if getattr(chunk, "usage", None):
+            self._last_usage.add(chunk)
+            self._usage.add(chunk)
+            logging.info(f"Usage: {self._last_usage}")
+
+        if not chunk.choices:
+            return ""
+
+        chunk_delta = chunk.choices[0].delta  # type: ignore
+        first_token = chunk_delta.content or chunk_delta.tool_calls
+        if first_token and self._request_time is not None and self._first_token_time is None:
+            self._first_token_time = time.perf_counter()
+            LLM_FIRST_TOKEN_SECONDS.observe(self._first_token_time - self._request_time)
+        if chunk_delta.tool_calls:
+            self._accumulate_tool_calls(tool_calls, chunk_delta.tool_calls)
+        return str(chunk_delta.content) if chunk_delta.content else ""
+
+    def _start_response_timing(self):
+        self._request_time = time.perf_counter()
+        self._first_token_time = None
+
+    def _observe_response_timing(self):
+        if self._request_time is None:
+            return
+        end = time.perf_counter()
+        LLM_RESPONSE_SECONDS.observe(end - self._request_time)
+        streaming_time = end - (self._first_token_time or end)
+        if streaming_time > 0 and self._last_usage.completion_tokens:
+            LLM_TOKENS_PER_SECOND.observe(self._last_usage.completion_tokens / streaming_time)
+        self._request_time = None
+
+    def _finish_response(
+        self, response_str: str, files: list[IndexedFile], tool_calls: dict[int, dict]
+    ) -> list[dict]:
+        """Records the response and returns the tool calls to make."""
+        self._observe_response_timing()
+        if self._cancelled.is_set():
+            logging.info("Response cancelled")
+            response_str = (response_str + ChatStore.INTERRUPTED_NOTE).lstrip()
+
+        filenames = [f.path() for f in files]
+        self._message_history.append({
+            "role": "assistant",
+            "content": response_str,
+            "files_used": filenames,
+        })
+
+        if self._cancelled.is_set():
+            return []
+        return [c for _, c in sorted(tool_calls.items()) if c["id"] and c["name"]]
+
+    def _accumulate_tool_calls(self, tool_calls: dict[int, dict], deltas: list):
+        for position, delta in enumerate(deltas):
+            index = getattr(delta, "index", None)
+            if index is None:
+                index = position
+
+            # Mistral sends complete calls, possibly several with the same index in one chunk
+            current = tool_calls.get(index)
+            if current is not None and delta.id and current["id"] and delta.id != current["id"]:
+                index = max(tool_calls) + 1
+                current = None
+
+            if current is None:
+                current = {"id": delta.id, "name": delta.function.name, "arguments": ""}
+                tool_calls[index] = current
+
+            arguments = delta.function.arguments
+            if isinstance(arguments, dict):
+                arguments = json.dumps(arguments)
+            if arguments:
+                current["arguments"] += arguments
+
+    def _call_tools(self, tool_calls: list[dict]) -> list[dict]:
+        num_workers = min(len(tool_calls), self.MAX_TOOL_WORKERS)
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            results = list(
+                executor.map(lambda c: self._call_tool(c["name"], c["arguments"]), tool_calls)
+            )
+        return self._record_tool_results(tool_calls, results)
+
+    async def _call_tools_async(self, tool_calls: list[dict]) -> list[dict]:
+        # Tools read files, so they run in threads to keep the event loop responsive
+        results = await asyncio.gather(
+            *(asyncio.to_thread(self._call_tool, c["name"], c["arguments"]) for c in tool_calls)
+        )
+        return self._record_tool_results(tool_calls, list(results))
+
+    def _record_tool_results(self, tool_calls: list[dict], results: list) -> list[dict]:
+        logging.info(
+            f"Tool cache: {self._tool_cache.hits} hits, {self._tool_cache.misses} misses"
+        )
 
         self._message_history.append({
             "role": "assistant",
             "tool_calls": [
                 {
-                    "id": tool_call_id,
+                    "id": tool_call["id"],
                     "type": "function",
                     "function": {
-                        "name": tool_call_name,
-                        "arguments": tool_call_arguments,
+                        "name": tool_call["name"],
+                        "arguments": tool_call["arguments"],
                     },
                 }
+                for tool_call in tool_calls
             ],
         })
 
-        self._message_history.append({
-            "tool_call_id": tool_call_id,
-            "role": "tool",
-            "name": tool_call_name,
-            "content": str(result),
-        })
+        tool_messages = []
+        for tool_call, result in zip(tool_calls, results):
+            tool_message = {
+                "tool_call_id": tool_call["id"],
+                "role": "tool",
+                "name": tool_call["name"],
+                "content": str(result),
+            }
+
+            # A window of a file can't stand in for the whole file later in the conversation
+            is_window = isinstance(result, dict) and ("start_line" in result or "offset" in result)
+            if tool_call["name"] == "read_file" and isinstance(result, dict) and not is_window:
+                file_hash = sha256(result["content"].encode()).hexdigest()
+                tool_message["file"] = [result["path"], file_hash]
+
+            self._message_history.append(tool_message)
+            tool_messages.append(tool_message)
+
+        return tool_messages
+
+    def _call_tool(self, tool_call_name: str, tool_call_arguments: str) -> dict | list | Exception:
+        try:
+            arguments_parsed: dict = json.loads(tool_call_arguments or "{}")
+            cache_key = tools.ToolCache.key(tool_call_name, arguments_parsed)
+            version = self._tool_result_version(tool_call_name, arguments_parsed)
+            if version is not None:
+                cached = self._tool_cache.get(cache_key, version)
+                if cached is not None:
+                    logging.info(f"Tool cache hit for {tool_call_name}")
+                    return cached
+
+            tool_seconds = tools.TOOL_SECONDS.get(tool_call_name, tools.UNKNOWN_TOOL_SECONDS)
+            with tool_seconds.time():
+                result = self._run_tool(tool_call_name, arguments_parsed)
+            if version is not None:
+                self._tool_cache.put(cache_key, version, result)
+            return result
+        except Exception as e:
+            return e
+
+    def _run_tool(self, tool_call_name: str, arguments_parsed: dict) -> dict | list:
+        if tool_call_name == "list_directory" and isinstance(self._index, Workspace):
+            return self._index.list_directory(
+                arguments_parsed.get("path", "."),
+                arguments_parsed.get("depth", 1),
+                arguments_parsed.get("max_entries", tools.MAX_LIST_ENTRIES),
+            )
+        elif tool_call_name == "list_directory":
+            return tools.list_directory(
+                self._project_tree(),
+                arguments_parsed.get("path", "."),
+                arguments_parsed.get("depth", 1),
+                arguments_parsed.get("max_entries", tools.MAX_LIST_ENTRIES),
+            )
+        elif tool_call_name == "read_file":
+            indexed_file = self._indexed_file(arguments_parsed)
+            whole_file = all(arguments_parsed.get(k) is None for k in tools.READ_RANGE_ARGUMENTS)
+            if indexed_file is not None and whole_file:
+                return {
+                    "name": os.path.basename(indexed_file.path()),
+                    "path": indexed_file.path(),
+                    "content": indexed_file.content(),
+                }
+            if isinstance(self._index, Workspace):
+                window = {k: arguments_parsed.get(k) for k in tools.READ_RANGE_ARGUMENTS}
+                return self._index.read_file(arguments_parsed["path"], **window)
+            return tools.read_file(
+                self._project_directory,
+                arguments_parsed["path"],
+                self._config,
+                arguments_parsed.get("start_line"),
+                arguments_parsed.get("end_line"),
+                arguments_parsed.get("offset"),
+                arguments_parsed.get("length"),
+            )
+        elif tool_call_name in tools.INDEX_TOOLS and self._index is None:
+            raise ValueError(f"Tool '{tool_call_name}' is not available")
+        elif tool_call_name in tools.INDEX_TOOLS and isinstance(self._index, FileIndex):
+            return tools.run_index_tool(self._index, tool_call_name, arguments_parsed)
+        elif tool_call_name in tools.INDEX_TOOLS:
+            return self._index.run_index_tool(tool_call_name, arguments_parsed)
+        else:
+            raise ValueError(f"Unknown tool '{tool_call_name}'")
+
+    def _tool_result_version(self, tool_call_name: str, arguments_parsed: dict) -> object:
+        """Identifies the state a tool's result depends on, None if it can't be cached."""
+        if tool_call_name == "list_directory":
+            path = os.path.normpath(arguments_parsed.get("path", "."))
+            if os.path.isabs(path) or path.startswith(".."):
+                return None
+            if isinstance(self._index, Workspace):
+                return self._index.directory_generation(path)
+            return self._project_tree().generation(path)
+        elif tool_call_name == "read_file":
+            indexed_file = self._indexed_file(arguments_parsed)
+            return None if indexed_file is None else indexed_file.hash()
+        elif tool_call_name in tools.INDEX_TOOLS and self._index is not None:
+            return self._index.generation()
+        return None
+
+    def _indexed_file(self, arguments_parsed: dict) -> IndexedFile | None:
+        path = arguments_parsed.get("path")
+        if self._index is None or not isinstance(path, str) or os.path.isabs(path):
+            return None
+        return self._index.file(path)
+
+    def _project_tree(self) -> ProjectTree:
+        if self._tree is None:
+            # Without an index there's no tree maintained by the watcher, scan the project once
+            self._tree = ProjectTree(str(self._project_directory), self._config)
+            self._tree.scan()
+        return self._tree
+
+
+class UsageStats:
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+
+    def __str__(self):
+        return (
+            f"{self.prompt_tokens} prompt tokens ({self.cache_hit_rate:.0%} cached),"
+            f" {self.completion_tokens} completion tokens"
+        )
+
+    @property
+    def cache_hit_rate(self) -> float:
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
+    def add(self, chunk):
+        usage = chunk.usage
+        self.requests += 1
+        self.prompt_tokens += usage.prompt_tokens or 0
+        self.completion_tokens += usage.completion_tokens or 0
+        self.cached_tokens += self._cached_tokens(chunk)
+
+    @staticmethod
+    def _cached_tokens(chunk) -> int:
+        details = getattr(chunk.usage, "prompt_tokens_details", None)
+        if isinstance(details, dict):
+            cached = details.get("cached_tokens")
+        else:
+            cached = getattr(details, "cached_tokens", None)
+
+        # llama.cpp reports reused KV cache entries in its own timings field
+        timings = getattr(chunk, "timings", None)
+        if cached is None and isinstance(timings, dict):
+            cached = timings.get("cache_n")
+
+        return cached or 0
 
-        return self._message_history[-1]
+
+SEARCH_ROWID_BITS = 24
+SEARCH_MATCH_START = "\x02"
+SEARCH_MATCH_END = "\x03"
 
 
 class ChatStore:
-    VERSION_LATEST = 1
+    """Stores chats and their messages in a per-project SQLite database.
+
+    The schema is versioned, `MIGRATIONS[v]` upgrades a database from version `v - 1` to `v`.
+    Databases are opened in WAL mode and every write runs in a single transaction.
+
+    All writes are applied by a `ChatWriter` thread with its own connection, so they never block
+    the caller. A response that's still streaming can be saved as a draft together with the ID of
+    the process streaming it. When a store is opened, drafts of processes that aren't running
+    anymore, e.g. because they crashed, are turned into (interrupted) assistant messages.
+    """
+
+    VERSION_LATEST = 5
+    INTERRUPTED_NOTE = "\n\n[Response interrupted]"
 
-    def __init__(self, directory: str, config: Config, client: Mistral | OpenAI):
+    def __init__(
+        self,
+        directory: str,
+        config: Config,
+        client: "Mistral | OpenAI",
+        index: FileIndex | RemoteIndex | Workspace | None = None,
+    ):
         self._client = client
+        self._index = index
         self._project_directory = directory
         self._file_path = self._get_file_path(directory, config.index_store_path)
         self._config = config
-        if not os.path.exists(self._file_path):
-            self._conn, self._cursor = self._create_database()
-        else:
-            self._conn = sqlite3.connect(self._file_path)
-            self._cursor = self._conn.cursor()
+        self._conn = _connect(self._file_path)
+        self._cursor = self._conn.cursor()
+        self._read_lock = threading.Lock()
+        self._migrate()
+        self._recover_drafts()
+        self._writer = ChatWriter(self._file_path)
+        self._writer.start()
 
     def _get_file_path(self, directory: str, store_directory: str) -> str:
         directory = os.path.abspath(directory)
@@ -228,127 +678,466 @@ class ChatStore:
         return file_path
 
     def new_chat(self) -> Chat:
-        return Chat(self._client, self._config.model.model, self._config, self._project_directory)
+        return Chat(
+            self._client,
+            self._config.model.model,
+            self._config,
+            self._project_directory,
+            index=self._index,
+        )
 
     def store(self, chat: Chat):
-        if chat.chat_id is None:
-            title = chat.title
-            self._cursor.execute("INSERT INTO chats (title) VALUES (?)", (title,))
-            assert self._cursor.lastrowid is not None
-            chat.chat_id = self._cursor.lastrowid
-
-        self._cursor.execute("SELECT MAX(id) FROM messages WHERE chat_id = ?", (chat.chat_id,))
-        messages_to_store = chat.messages
-        max_id = self._cursor.fetchone()[0]
-        start_id = 0 if max_id is None else max_id + 1
-        if max_id is not None:
-            messages_to_store = messages_to_store[start_id:]
-
-        self._store_messages(chat.chat_id, messages_to_store, start_id)
-        self._conn.commit()
-
-    def chat_list(self) -> list[tuple]:
-        self._cursor.execute("SELECT * FROM chats ORDER BY created_at DESC")
-        chats = self._cursor.fetchall()
+        self.store_async(chat).result()
+
+    def store_async(self, chat: Chat) -> Future:
+        """Saves messages of the chat that aren't stored yet, and discards its draft."""
+        title = chat.title
+        messages = list(chat.messages)
+        first_id = chat.first_message_id
+        return self._writer.submit(
+            lambda cursor: _write_chat(cursor, chat, title, messages, first_id)
+        )
+
+    def store_draft(self, chat: Chat, content: str, files_used: list[str]) -> Future:
+        """Saves the chat together with the partial content of the response being streamed."""
+        title = chat.title
+        messages = list(chat.messages)
+        first_id = chat.first_message_id
+
+        def write_draft(cursor: sqlite3.Cursor):
+            _write_chat(cursor, chat, title, messages, first_id)
+            cursor.execute(
+                "INSERT OR REPLACE INTO drafts (chat_id, content, files_used, pid)"
+                " VALUES (?, ?, ?, ?)",
+                (chat.chat_id, content, json.dumps(files_used), os.getpid()),
+            )
+
+        return self._writer.submit(write_draft)
+
+    def close(self):
+        self._writer.close()
+        self._conn.close()
+
+    def chat_list(self, limit: int | None = None, after: tuple | None = None) -> list[tuple]:
+        """Lists chats, newest first.
+
+        To page through them, pass the last chat of the previous page as `after`. Pages are
+        read with a range scan of the `(created_at, id)` index, whatever their position.
+        """
+        query = "SELECT id, created_at, title FROM chats"
+        parameters: tuple = ()
+        if after is not None:
+            query += " WHERE (created_at, id) < (?, ?)"
+            parameters = (after[1], after[0])
+        query += " ORDER BY created_at DESC, id DESC LIMIT ?"
+
+        with self._read_lock:
+            self._cursor.execute(query, parameters + (-1 if limit is None else limit,))
+            chats = self._cursor.fetchall()
         return chats
 
-    def load(self, chat_id: int) -> Chat | None:
-        self._cursor.execute("SELECT * FROM chats WHERE id == ?", (chat_id,))
-        chat = self._cursor.fetchone()
+    def load(self, chat_id: int, limit: int | None = None) -> Chat | None:
+        """Loads a chat with its newest `limit` messages, older ones are loaded on demand."""
+        with self._read_lock:
+            self._cursor.execute("SELECT id FROM chats WHERE id == ?", (chat_id,))
+            chat = self._cursor.fetchone()
 
         if not chat:
             return None
 
         chat = Chat(
-            self._client, self._config.model.model, self._config, self._project_directory, chat_id
+            self._client,
+            self._config.model.model,
+            self._config,
+            self._project_directory,
+            chat_id,
+            self._index,
+        )
+        messages, first_id = self._load_messages(chat_id, None, limit)
+        chat.set_message_window(
+            messages,
+            first_id,
+            lambda before_id, count: self._load_messages(chat_id, before_id, count)[0],
         )
-        self._cursor.execute("SELECT * FROM messages WHERE chat_id = ?", (chat_id,))
-        messages_raw = self._cursor.fetchall()
-        messages = []
+        return chat
 
-        for message_raw in messages_raw:
-            try:
-                message_dict = json.loads(message_raw[3])
-                if "tool_calls" in message_dict:
-                    messages.append({
-                        "role": "assistant",
-                        "content": "",
-                        "tool_calls": message_dict["tool_calls"],
-                    })
-                elif "tool_response" in message_dict:
-                    messages.append(message_dict["tool_response"])
-                continue
-            except json.JSONDecodeError:
-                pass
-            message = {
-                "role": message_raw[2],
-                "content": message_raw[3],
-            }
-            if message_raw[4]:
-                message["files_used"] = json.loads(message_raw[4])
-            messages.append(message)
+    def _load_messages(
+        self, chat_id: int, before_id: int | None, limit: int | None
+    ) -> tuple[list[dict], int]:
+        query = "SELECT id, role, content, files_used FROM messages WHERE chat_id = ?"
+        parameters: tuple = (chat_id,)
+        if before_id is not None:
+            query += " AND id < ?"
+            parameters += (before_id,)
+        query += " ORDER BY id DESC LIMIT ?"
 
-        chat.messages = messages
-        return chat
+        with self._read_lock:
+            self._cursor.execute(query, parameters + (-1 if limit is None else limit,))
+            rows = self._cursor.fetchall()[::-1]
 
-    def delete(self, chat_id: int) -> int:
-        self._cursor.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
-        self._cursor.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
-        self._conn.commit()
-        return self._cursor.rowcount
+        first_id = rows[0][0] if rows else (before_id or 0)
+        return [_message_from_row(row[1:]) for row in rows], first_id
 
-    def _create_database(self) -> tuple[sqlite3.Connection, sqlite3.Cursor]:
-        conn = sqlite3.connect(self._file_path)
-        cursor = conn.cursor()
+    def search(self, query: str, limit: int = 20) -> list[tuple]:
+        """Full-text search over chat titles and user and assistant messages.
 
-        cursor.execute("CREATE TABLE version (version INTEGER)")
-
-        cursor.execute("""
-        CREATE TABLE chats
-        (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            title TEXT
-        )         
-        """)
-
-        cursor.execute("""
-        CREATE TABLE messages
-        (
-            id INTEGER,
-            chat_id INTEGER,
-            role TEXT NOT NULL,
-            content TEXT NOT NULL,
-            files_used TEXT,
-            FOREIGN KEY (chat_id) REFERENCES chats(id) ON DELETE CASCADE
-        )         
-        """)
-
-        cursor.execute("INSERT INTO version (version) VALUES (1)")
-        conn.commit()
-
-        return conn, cursor
-
-    def _store_messages(self, chat_id: int, messages: list[dict], start_id: int):
-        query_template = "INSERT INTO messages VALUES (?, ?, ?, ?, ?)"
-        for i, message in enumerate(messages):
-            files_used = message.get("files_used")
-            if isinstance(files_used, list):
-                files_used = json.dumps(files_used)
-
-            if "tool_calls" in message:
-                message["content"] = json.dumps({"tool_calls": message["tool_calls"]})
-            elif "tool_call_id" in message:
-                message["content"] = json.dumps({"tool_response": message})
+        Returns (chat_id, message_id, title, snippet) tuples, best matches first. The message id
+        is -1 for matches in a chat's title. Matched terms in the snippet are enclosed in
+        `SEARCH_MATCH_START` and `SEARCH_MATCH_END`.
+        """
+        terms = query.split()
+        if not terms:
+            return []
 
+        # Every term is quoted so FTS5 syntax can't break the query, the last one is a prefix
+        fts_query = " ".join('"' + t.replace('"', '""') + '"' for t in terms) + "*"
+        with self._read_lock:
             self._cursor.execute(
-                query_template,
-                (
-                    start_id + i,
-                    chat_id,
-                    message["role"],
-                    message["content"],
-                    files_used,
-                ),
+                f"""
+                SELECT
+                    search.rowid >> {SEARCH_ROWID_BITS},
+                    (search.rowid & {(1 << SEARCH_ROWID_BITS) - 1}) - 1,
+                    chats.title,
+                    snippet(search, -1, ?, ?, '…', 12)
+                FROM search JOIN chats ON chats.id = search.rowid >> {SEARCH_ROWID_BITS}
+                WHERE search MATCH ?
+                ORDER BY rank
+                LIMIT ?
+                """,
+                (SEARCH_MATCH_START, SEARCH_MATCH_END, fts_query, limit),
             )
-        self._conn.commit()
+            return self._cursor.fetchall()
+
+    def delete(self, chat_id: int) -> int:
+        def delete_chat(cursor: sqlite3.Cursor) -> int:
+            # Messages and drafts are removed by ON DELETE CASCADE
+            cursor.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
+            return cursor.rowcount
+
+        return self._writer.submit(delete_chat).result()
+
+    def version(self) -> int:
+        try:
+            self._cursor.execute("SELECT version FROM version")
+        except sqlite3.OperationalError:
+            return 0
+        row = self._cursor.fetchone()
+        return 0 if row is None else row[0]
+
+    def _migrate(self):
+        version = self.version()
+        if version > self.VERSION_LATEST:
+            raise ValueError(
+                f"Chat database {self._file_path} has version {version}, newer than supported"
+                f" version {self.VERSION_LATEST}"
+            )
+
+        for target_version in range(version + 1, self.VERSION_LATEST + 1):
+            logging.info(f"Migrating chat database to version {target_version}")
+            # Tables are rebuilt during migrations, which would otherwise cascade deletes
+            self._conn.execute("PRAGMA foreign_keys = OFF")
+            try:
+                with _transaction(self._conn):
+                    MIGRATIONS[target_version](self._cursor)
+                    self._cursor.execute("UPDATE version SET version = ?", (target_version,))
+            finally:
+                self._conn.execute("PRAGMA foreign_keys = ON")
+
+    def _recover_drafts(self):
+        with _transaction(self._conn):
+            self._cursor.execute("SELECT chat_id, content, files_used, pid FROM drafts")
+            drafts = self._cursor.fetchall()
+            for chat_id, content, files_used, pid in drafts:
+                # The response may still be streaming in another session
+                if pid is not None and process_running(pid):
+                    continue
+                logging.info(f"Recovering interrupted response in chat {chat_id}")
+                message = {
+                    "role": "assistant",
+                    "content": content + self.INTERRUPTED_NOTE,
+                    "files_used": json.loads(files_used or "[]"),
+                }
+                self._cursor.execute("SELECT MAX(id) FROM messages WHERE chat_id = ?", (chat_id,))
+                max_id = self._cursor.fetchone()[0]
+                start_id = 0 if max_id is None else max_id + 1
+                _store_messages(self._cursor, chat_id, [message], start_id)
+                self._cursor.execute("DELETE FROM drafts WHERE chat_id = ?", (chat_id,))
+
+
+class ChatWriter(threading.Thread):
+    """Applies writes to the chat database in the order they were submitted.
+
+    Every write is a function of a cursor, run in its own transaction on the writer's connection.
+    """
+
+    def __init__(self, file_path: str):
+        super().__init__(daemon=True)
+        self._file_path = file_path
+        self._queue: queue.Queue[tuple[Callable, Future] | None] = queue.Queue()
+
+    def submit(self, write: Callable[[sqlite3.Cursor], object]) -> Future:
+        future = Future()
+        self._queue.put((write, future))
+        return future
+
+    def run(self):
+        conn = _connect(self._file_path)
+        cursor = conn.cursor()
+
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            write, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                with SQLITE_WRITE_SECONDS.time(), _transaction(conn):
+                    result = write(cursor)
+                future.set_result(result)
+            except Exception as e:
+                logging.warning(f"Failed to write to the chat database: {e}")
+                future.set_exception(e)
+
+        conn.close()
+
+    def close(self):
+        self._queue.put(None)
+        if self.is_alive():
+            self.join()
+
+
+def create_client(model_config: ModelConfig) -> "Mistral | OpenAI":
+    # Only the SDK of the configured provider is imported
+    if model_config.provider == "mistral":
+        from mistralai import Mistral
+
+        return Mistral(api_key=model_config.api_key)
+
+    from openai import OpenAI
+
+    if model_config.provider == "openai-selfhosted":
+        return OpenAI(api_key=model_config.api_key, base_url=model_config.base_url)
+    return OpenAI(api_key=model_config.api_key)
+
+
+def _is_mistral(client) -> bool:
+    # Checked by module, so the provider SDK that isn't used never gets imported
+    return type(client).__module__.split(".")[0] == "mistralai"
+
+
+def _close_stream(response):
+    # Closing the response alone doesn't wake up a thread blocked reading from its socket
+    http_response = getattr(response, "response", None)
+    network_stream = http_response.extensions.get("network_stream") if http_response else None
+    sock = network_stream.get_extra_info("socket") if network_stream else None
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.close()
+
+
+def _write_chat(
+    cursor: sqlite3.Cursor, chat: Chat, title: str, messages: list[dict], first_message_id: int
+):
+    if chat.chat_id is None:
+        cursor.execute("INSERT INTO chats (title) VALUES (?)", (title,))
+        assert cursor.lastrowid is not None
+        chat.chat_id = cursor.lastrowid
+
+    cursor.execute("SELECT MAX(id) FROM messages WHERE chat_id = ?", (chat.chat_id,))
+    max_id = cursor.fetchone()[0]
+    start_id = 0 if max_id is None else max_id + 1
+    new_messages = messages[max(start_id - first_message_id, 0) :]
+    _store_messages(cursor, chat.chat_id, new_messages, start_id)
+    cursor.execute("DELETE FROM drafts WHERE chat_id = ?", (chat.chat_id,))
+
+
+def _store_messages(cursor: sqlite3.Cursor, chat_id: int, messages: list[dict], start_id: int):
+    cursor.executemany(
+        "INSERT INTO messages (chat_id, id, role, content, files_used) VALUES (?, ?, ?, ?, ?)",
+        [(chat_id, start_id + i, *_message_to_row(message)) for i, message in enumerate(messages)],
+    )
+
+
+def _connect(file_path: str) -> sqlite3.Connection:
+    # Transactions are managed explicitly by _transaction
+    conn = sqlite3.connect(file_path, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA foreign_keys = ON")
+    return conn
+
+
+@contextmanager
+def _transaction(conn: sqlite3.Connection):
+    conn.execute("BEGIN")
+    try:
+        yield
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _message_to_row(message: dict) -> tuple[str, str, str | None]:
+    files_used = message.get("files_used")
+    if isinstance(files_used, list):
+        files_used = json.dumps(files_used)
+
+    content = message.get("content") or ""
+    if "tool_calls" in message:
+        content = json.dumps({"tool_calls": message["tool_calls"]})
+    elif "tool_call_id" in message:
+        content = json.dumps({"tool_response": message})
+
+    return message["role"], content, files_used
+
+
+def _message_from_row(row: tuple[str, str, str | None]) -> dict:
+    role, content, files_used = row
+    try:
+        message_dict = json.loads(content)
+        if "tool_calls" in message_dict:
+            return {"role": "assistant", "content": "", "tool_calls": message_dict["tool_calls"]}
+        elif "tool_response" in message_dict:
+            return message_dict["tool_response"]
+    except (json.JSONDecodeError, TypeError):
+        pass
+
+    message = {"role": role, "content": content}
+    if files_used:
+        message["files_used"] = json.loads(files_used)
+    return message
+
+
+def _create_tables(cursor: sqlite3.Cursor):
+    cursor.execute("CREATE TABLE version (version INTEGER)")
+
+    cursor.execute("""
+    CREATE TABLE chats
+    (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        title TEXT
+    )
+    """)
+
+    cursor.execute("""
+    CREATE TABLE messages
+    (
+        id INTEGER,
+        chat_id INTEGER,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        files_used TEXT,
+        FOREIGN KEY (chat_id) REFERENCES chats(id) ON DELETE CASCADE
+    )
+    """)
+
+    cursor.execute("INSERT INTO version (version) VALUES (1)")
+
+
+def _add_message_key(cursor: sqlite3.Cursor):
+    cursor.execute("""
+    CREATE TABLE messages_v2
+    (
+        chat_id INTEGER NOT NULL,
+        id INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        files_used TEXT,
+        PRIMARY KEY (chat_id, id),
+        FOREIGN KEY (chat_id) REFERENCES chats(id) ON DELETE CASCADE
+    ) WITHOUT ROWID
+    """)
+
+    # Messages of chats deleted while foreign keys weren't enforced are dropped
+    cursor.execute("""
+    INSERT OR REPLACE INTO messages_v2 (chat_id, id, role, content, files_used)
+    SELECT chat_id, id, role, content, files_used FROM messages
+    WHERE chat_id IN (SELECT id FROM chats)
+    """)
+    cursor.execute("DROP TABLE messages")
+    cursor.execute("ALTER TABLE messages_v2 RENAME TO messages")
+    cursor.execute("CREATE INDEX chats_created_at ON chats (created_at, id)")
+
+
+def _add_drafts(cursor: sqlite3.Cursor):
+    cursor.execute("""
+    CREATE TABLE drafts
+    (
+        chat_id INTEGER PRIMARY KEY,
+        content TEXT NOT NULL,
+        files_used TEXT,
+        FOREIGN KEY (chat_id) REFERENCES chats(id) ON DELETE CASCADE
+    )
+    """)
+
+
+def _add_search(cursor: sqlite3.Cursor):
+    # Messages are stored under rowid (chat_id << SEARCH_ROWID_BITS) + message_id + 1 and titles
+    # under chat_id << SEARCH_ROWID_BITS, so the rows of a chat form one rowid range
+    bits = SEARCH_ROWID_BITS
+    cursor.execute("CREATE VIRTUAL TABLE search USING fts5(text, tokenize='unicode61')")
+
+    def message_rowid(row: str) -> str:
+        return f"({row}.chat_id << {bits}) + {row}.id + 1"
+
+    def searchable(row: str) -> str:
+        # Tool calls and results are stored as JSON and not worth searching
+        return f"{row}.role IN ('user', 'assistant') AND {row}.content NOT LIKE '{{\"tool_calls\"%'"
+
+    cursor.execute(f"""
+    CREATE TRIGGER messages_search_insert AFTER INSERT ON messages WHEN {searchable("new")}
+    BEGIN
+        INSERT INTO search (rowid, text) VALUES ({message_rowid("new")}, new.content);
+    END
+    """)
+    cursor.execute(f"""
+    CREATE TRIGGER messages_search_delete AFTER DELETE ON messages
+    BEGIN
+        DELETE FROM search WHERE rowid = {message_rowid("old")};
+    END
+    """)
+    cursor.execute(f"""
+    CREATE TRIGGER chats_search_insert AFTER INSERT ON chats
+    BEGIN
+        INSERT INTO search (rowid, text) VALUES (new.id << {bits}, new.title);
+    END
+    """)
+    cursor.execute(f"""
+    CREATE TRIGGER chats_search_update AFTER UPDATE OF title ON chats
+    BEGIN
+        UPDATE search SET text = new.title WHERE rowid = new.id << {bits};
+    END
+    """)
+    cursor.execute(f"""
+    CREATE TRIGGER chats_search_delete AFTER DELETE ON chats
+    BEGIN
+        DELETE FROM search WHERE rowid >= old.id << {bits} AND rowid < (old.id + 1) << {bits};
+    END
+    """)
+
+    cursor.execute(f"INSERT INTO search (rowid, text) SELECT id << {bits}, title FROM chats")
+    cursor.execute(f"""
+    INSERT INTO search (rowid, text)
+    SELECT {message_rowid("m")}, m.content FROM messages AS m WHERE {searchable("m")}
+    """)
+
+
+def _add_draft_owner(cursor: sqlite3.Cursor):
+    # Drafts stored without a PID are recovered by any store that's opened, like before
+    cursor.execute("ALTER TABLE drafts ADD COLUMN pid INTEGER")
+
+
+MIGRATIONS = {
+    1: _create_tables,
+    2: _add_message_key,
+    3: _add_drafts,
+    4: _add_search,
+    5: _add_draft_owner,
+}
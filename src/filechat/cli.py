@@ -0,0 +1,160 @@
+"""Headless subcommands, for scripts and scheduled jobs that don't need the chat UI."""
+
+import json
+import os
+import sys
+import time
+from argparse import Namespace
+
+import tqdm
+
+from filechat import metrics
+from filechat.chat import ChatStore, create_client
+from filechat.config import CONFIG_PATH_DEFAULT, Config, load_config
+from filechat.daemon import Daemon, RemoteIndex, connect, socket_path
+from filechat.embedder import Embedder
+from filechat.index import QUERY_SECONDS, FileIndex, load_index, update_index
+from filechat.utils import setup_logging
+
+
+def run(args: Namespace):
+    if args.metrics or args.metrics_file:
+        metrics.enable(args.metrics_file)
+    try:
+        COMMANDS[args.command](args)
+    finally:
+        if args.metrics_file:
+            metrics.dump()
+
+
+def index_command(args: Namespace):
+    config = _load_config(args)
+
+    start = time.perf_counter()
+    daemon_client = None if args.no_daemon else connect(config)
+    if daemon_client is not None:
+        directory = os.path.abspath(args.directory)
+        result = daemon_client.request("index", directory=directory, rebuild=args.rebuild)
+        print(
+            f"Index updated by the daemon in {time.perf_counter() - start:.2f} s,"
+            f" {result['indexed']} of {result['files']} files (re)indexed"
+        )
+        return
+
+    embedder = _load_embedder(config)
+    model_loaded = time.perf_counter()
+    print(f"Embedding model loaded in {model_loaded - start:.2f} s")
+
+    index = load_index(args.directory, config, embedder, args.rebuild)
+    index_loaded = time.perf_counter()
+    print(f"Index loaded in {index_loaded - model_loaded:.2f} s, {index.num_files()} files")
+
+    with tqdm.tqdm(desc="Indexing", unit="file", file=sys.stderr) as progress:
+
+        def on_progress(num_checked: int, total: int):
+            progress.total = total
+            progress.update(num_checked - progress.n)
+
+        num_indexed = update_index(index, config, on_progress)
+
+    num_files = index.num_files()
+    print(
+        f"Index updated in {time.perf_counter() - index_loaded:.2f} s,"
+        f" {num_indexed} of {num_files} files (re)indexed"
+    )
+    print(f"Total time {time.perf_counter() - start:.2f} s")
+
+
+def search_command(args: Namespace):
+    config = _load_config(args)
+    index = _open_index(args, config)
+
+    with QUERY_SECONDS.time():
+        hits = index.query_with_scores(args.query, args.top_k)
+    results = [{"path": f.path(), "score": round(score, 4)} for f, score in hits]
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+def ask_command(args: Namespace):
+    config = _load_config(args)
+    index = _open_index(args, config)
+    chat_store = ChatStore(args.directory, config, create_client(config.model), index)
+    chat = chat_store.new_chat()
+
+    try:
+        files = index.query(args.question)
+        message = args.question
+        while True:
+            tool_results = []
+            for chunk in chat.user_message(message, files):
+                if isinstance(chunk, str):
+                    sys.stdout.write(chunk)
+                    sys.stdout.flush()
+                elif isinstance(chunk, dict):
+                    tool_results.append(chunk)
+                    print(f">>> Tool call: {chunk['name']}", file=sys.stderr)
+
+            if not tool_results:
+                break
+            message = None
+
+        print()
+        chat_store.store(chat)
+    finally:
+        chat_store.close()
+
+
+def daemon_command(args: Namespace):
+    config = _load_config(args)
+    if not args.stop and not args.status and not args.stats:
+        print(f"Listening on {socket_path(config)}, stop with Ctrl+C or `filechat daemon --stop`")
+        try:
+            Daemon(config).serve()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    daemon_client = connect(config)
+    if daemon_client is None:
+        sys.exit("No daemon is running")
+    elif args.stop:
+        daemon_client.request("stop")
+    elif args.stats:
+        sys.stdout.write(daemon_client.request("metrics"))
+    else:
+        json.dump(daemon_client.request("status"), sys.stdout, indent=2)
+        print()
+
+
+def _load_config(args: Namespace) -> Config:
+    config = load_config(args.config or CONFIG_PATH_DEFAULT)
+    setup_logging(config.log_dir)
+    return config
+
+
+def _load_embedder(config: Config) -> Embedder:
+    return Embedder(
+        config.embedding_model, config.embedding_model_path, config.embedding_model_url
+    )
+
+
+def _open_index(args: Namespace, config: Config) -> FileIndex | RemoteIndex:
+    daemon_client = None if args.no_daemon else connect(config)
+    if daemon_client is not None:
+        index = RemoteIndex(daemon_client, args.directory)
+        index.open()
+        return index
+
+    index = load_index(args.directory, config, _load_embedder(config))
+    if not args.no_update:
+        update_index(index, config)
+    return index
+
+
+COMMANDS = {
+    "index": index_command,
+    "search": search_command,
+    "ask": ask_command,
+    "daemon": daemon_command,
+}
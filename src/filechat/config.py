@@ -3,7 +3,6 @@ import os
 from pathlib import Path
 
 from pydantic import BaseModel, ValidationError
-from rich import print as rprint
 
 HOME_DIR = os.path.expanduser("~")
 CONFIG_PATH_DEFAULT = os.path.join(HOME_DIR, ".config", "filechat.json")
@@ -26,12 +25,19 @@ MODEL_CHOICES = {
     "openai-selfhosted": None,
 }
 
+CONTEXT_TOKENS_DEFAULT = {
+    "openai": 128000,
+    "mistral": 128000,
+    "openai-selfhosted": 16384,
+}
+
 
 class ModelConfig(BaseModel):
     provider: str
     model: str
     api_key: str
     base_url: str | None = None
+    max_context_tokens: int | None = None
 
 
 class Config(BaseModel):
@@ -81,6 +87,9 @@ class Config(BaseModel):
         ".ld",
     ]
     index_store_path: str = os.path.join(HOME_DIR, ".cache", "filechat")
+    watch_mode: str = "auto"
+    watch_poll_interval_s: float = 2.0
+    index_shard_depth: int = 0
     model: ModelConfig
 
     @property
@@ -91,6 +100,12 @@ class Config(BaseModel):
     def index_batch_size(self) -> int:
         return 1
 
+    @property
+    def context_budget(self) -> int:
+        if self.model.max_context_tokens is not None:
+            return self.model.max_context_tokens
+        return CONTEXT_TOKENS_DEFAULT.get(self.model.provider, 16384)
+
     @property
     def log_dir(self) -> str:
         return os.path.join(self.index_store_path, "logs")
@@ -120,6 +135,8 @@ def load_config(path: str = CONFIG_PATH_DEFAULT, discard: bool = False) -> Confi
     config_dir = os.path.dirname(path)
     if config_dir != "":
         os.makedirs(config_dir, exist_ok=True)
+    from rich import print as rprint
+
     with open(path, "w") as config_file:
         config_file.write(config_json)
         rprint(f"[blue]Config file stored at {path}[/blue]")
@@ -130,6 +147,8 @@ def load_config(path: str = CONFIG_PATH_DEFAULT, discard: bool = False) -> Confi
 
 
 def setup_config() -> Config:
+    from rich import print as rprint
+
     rprint("[blue]Hi. Looks like you don't have a valid config file yet. Let's create one.[/blue]")
 
     # Choose provider
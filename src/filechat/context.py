@@ -0,0 +1,279 @@
+import logging
+from functools import lru_cache
+
+from filechat.config import Config
+from filechat.index import IndexedFile
+from filechat.utils import truncate_text
+
+API_MESSAGE_KEYS = {"role", "content", "name", "tool_calls", "tool_call_id"}
+
+
+class TokenCounter:
+    """Counts tokens with the model's tokenizer, or estimates them if it's not available.
+
+    The tokenizer comes from `tiktoken`, which downloads its encodings on first use. If they
+    can't be loaded, e.g. offline, token counts are estimated from the text length, which is good
+    enough for budgeting.
+    """
+
+    CHARS_PER_TOKEN = 4
+    MESSAGE_OVERHEAD = 4
+
+    def __init__(self, model: str):
+        self._encoding = _load_encoding(model)
+        self.count = lru_cache(maxsize=4096)(self._count)
+
+    def count_message(self, message: dict) -> int:
+        tokens = self.MESSAGE_OVERHEAD + self.count(str(message.get("content") or ""))
+        tokens += self.count(message.get("context") or "")
+        for tool_call in message.get("tool_calls") or []:
+            tokens += self.count(tool_call["function"]["name"])
+            tokens += self.count(tool_call["function"]["arguments"])
+        return tokens
+
+    def count_messages(self, messages: list[dict]) -> int:
+        return sum(self.count_message(m) for m in messages)
+
+    def _count(self, text: str) -> int:
+        if self._encoding is None:
+            return (len(text) + self.CHARS_PER_TOKEN - 1) // self.CHARS_PER_TOKEN
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+
+class ContextBuilder:
+    """Assembles the messages for an LLM request within the configured token budget.
+
+    The request is laid out so that it only grows by appending: the system prompt comes first,
+    followed by the conversation, and the files retrieved for a turn are attached to the user
+    message that started it. Every later request then shares the previous one as a prefix,
+    which lets provider-side prompt caching and llama.cpp's KV cache reuse it.
+
+    Retrieved files are packed in the order of their relevance. A file that is still present in
+    the conversation with the same hash, from an earlier turn or a `read_file` call, is only
+    referenced by its path. If the conversation outgrows
+    the budget, everything before the current turn is compacted in one go, well below the
+    budget, so the compacted prefix stays stable for the following turns. Compaction removes
+    the files attached to older turns, then replaces their tool outputs with a note, then
+    shortens their messages, and finally drops the oldest turns and summarises them by the
+    questions the user asked in them.
+    """
+
+    RESPONSE_SHARE = 0.2
+    FILES_SHARE = 0.5
+    COMPACTION_TARGET = 0.6
+    RECENT_TURNS = 2
+    COMPACTED_MESSAGE_LENGTH = 300
+
+    CONTEXT_INTRO = (
+        "Here are the most relevant files to user's query found using embedding search."
+        "These are not the same as files returned via a tool call. Do no confuse the two."
+        "If you think these files are not enough, feel free to call a tool."
+        "Files in <file_ref> tags were provided earlier in this conversation and haven't changed"
+        " since."
+    )
+
+    def __init__(self, config: Config, token_counter: TokenCounter | None = None):
+        self._config = config
+        self._counter = token_counter or TokenCounter(config.model.model)
+        self.reset()
+
+    @property
+    def token_counter(self) -> TokenCounter:
+        return self._counter
+
+    def reset(self):
+        self._contexts: dict[int, dict] = {}
+        self._prefix: list[dict] = []
+        self._prefix_end = 1
+
+    def build(
+        self, history: list[dict], files: list[IndexedFile]
+    ) -> tuple[list[dict], list[IndexedFile]]:
+        system_message = history[0]
+        prompt_budget = int(self._config.context_budget * (1 - self.RESPONSE_SHARE))
+        prompt_budget -= self._counter.count_message(system_message)
+        files_budget = int(prompt_budget * self.FILES_SHARE)
+
+        turn_start = _current_turn_start(history)
+        if turn_start not in self._contexts and turn_start < len(history):
+            earlier = self._prefix + self._render(history, self._prefix_end, turn_start)
+            self._contexts[turn_start] = self._pack_files(
+                files, files_budget, _files_in_conversation(earlier)
+            )
+
+        conversation = self._prefix + self._render(history, self._prefix_end)
+        if self._counter.count_messages(conversation) > prompt_budget:
+            # Compaction may drop files the current context only refers to, so send them in full
+            if turn_start in self._contexts:
+                retrieved = self._contexts[turn_start]["files"]
+                self._contexts[turn_start] = self._pack_files(retrieved, files_budget, {})
+
+            current_turn = self._render(history, turn_start)
+            prefix_budget = int(prompt_budget * self.COMPACTION_TARGET)
+            prefix_budget -= self._counter.count_messages(current_turn)
+            logging.info(f"Compacting conversation to {prefix_budget} tokens")
+            self._prefix = self.compact(self._render(history, 1, turn_start), prefix_budget)
+            self._prefix_end = turn_start
+            conversation = self._prefix + current_turn
+
+        messages = [_api_message(system_message)] + [_api_message(m) for m in conversation]
+        files_used = self._contexts.get(turn_start, {}).get("files_used", [])
+        logging.info(
+            f"Context: {self._counter.count_messages(messages)} tokens, {len(files_used)} of"
+            f" {len(files)} files, {len(conversation)} conversation messages"
+        )
+        return messages, files_used
+
+    def compact(self, conversation: list[dict], budget: int) -> list[dict]:
+        if self._counter.count_messages(conversation) <= budget:
+            return conversation
+
+        turns = _split_turns(conversation)
+        num_old = max(len(turns) - self.RECENT_TURNS, 0)
+
+        for compact_turn in (self._without_context, self._without_tool_outputs, self._shortened):
+            for i in range(num_old):
+                turns[i] = compact_turn(turns[i])
+                if self._counter.count_messages(_flatten(turns)) <= budget:
+                    return _flatten(turns)
+
+        dropped_questions = []
+        while len(turns) > 1:
+            dropped_questions += [m["content"] for m in turns.pop(0) if m["role"] == "user"]
+            summary = self._summary(dropped_questions)
+            if self._counter.count_messages([summary] + _flatten(turns)) <= budget:
+                break
+
+        return [self._summary(dropped_questions)] + _flatten(turns)
+
+    def _render(self, history: list[dict], start: int, end: int | None = None) -> list[dict]:
+        rendered = []
+        for i in range(start, len(history) if end is None else end):
+            message = history[i]
+            if i in self._contexts:
+                context = self._contexts[i]
+                message = message | {
+                    "context": context["context"],
+                    "context_files": context["context_files"],
+                }
+            rendered.append(message)
+        return rendered
+
+    def _pack_files(
+        self, files: list[IndexedFile], budget: int, files_sent: dict[str, str]
+    ) -> dict:
+        message = self.CONTEXT_INTRO + "<context>"
+        used_tokens = self._counter.count(message)
+        files_used = []
+        context_files = []
+
+        for file in files:
+            already_sent = files_sent.get(file.path()) == file.hash()
+            if already_sent:
+                file_text = f"<file_ref>{file.path()}</file_ref>"
+            else:
+                file_text = "<file>" + file.content_for_embedding() + "</file>"
+
+            file_tokens = self._counter.count(file_text)
+            if used_tokens + file_tokens > budget:
+                continue
+
+            message += file_text
+            used_tokens += file_tokens
+            files_used.append(file)
+            if not already_sent:
+                context_files.append([file.path(), file.hash()])
+
+        logging.info(
+            f"Packed {len(context_files)} files, referenced {len(files_used) - len(context_files)}"
+        )
+        context = {"files": files, "context": "", "context_files": [], "files_used": files_used}
+        if files_used:
+            context["context"] = message + "</context>"
+            context["context_files"] = context_files
+        return context
+
+    def _without_context(self, turn: list[dict]) -> list[dict]:
+        return [{k: v for k, v in m.items() if k not in ("context", "context_files")} for m in turn]
+
+    def _without_tool_outputs(self, turn: list[dict]) -> list[dict]:
+        compacted = []
+        for message in turn:
+            if message["role"] == "tool":
+                message = {k: v for k, v in message.items() if k != "file"} | {
+                    "content": (
+                        f"[Output of {message.get('name', 'the tool')} omitted to save context."
+                        " Call the tool again if you need it.]"
+                    )
+                }
+            compacted.append(message)
+        return compacted
+
+    def _shortened(self, turn: list[dict]) -> list[dict]:
+        compacted = []
+        for message in turn:
+            if message["role"] in ("user", "assistant") and message.get("content"):
+                content = truncate_text(message["content"], self.COMPACTED_MESSAGE_LENGTH)
+                message = message | {"content": content}
+            compacted.append(message)
+        return compacted
+
+    def _summary(self, questions: list[str]) -> dict:
+        content = "Earlier parts of this conversation were removed to save context."
+        if questions:
+            content += " In them, the user asked:\n"
+            content += "\n".join(f"- {truncate_text(q, 200)}" for q in questions)
+        return {"role": "system", "content": content}
+
+
+@lru_cache
+def _load_encoding(model: str):
+    # Imported when a chat starts, so it doesn't slow down starting up
+    import tiktoken
+
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logging.warning(f"Cannot load tokenizer for {model}, estimating token counts: {e}")
+        return None
+
+
+def _api_message(message: dict) -> dict:
+    api_message = {k: v for k, v in message.items() if k in API_MESSAGE_KEYS}
+    if message.get("context"):
+        api_message["content"] = message["context"] + "\n\n" + message["content"]
+    return api_message
+
+
+def _files_in_conversation(conversation: list[dict]) -> dict[str, str]:
+    files = {}
+    for message in conversation:
+        for path, file_hash in message.get("context_files", []):
+            files[path] = file_hash
+        if "file" in message:
+            path, file_hash = message["file"]
+            files[path] = file_hash
+    return files
+
+
+def _current_turn_start(history: list[dict]) -> int:
+    for i in range(len(history) - 1, 0, -1):
+        if history[i]["role"] == "user":
+            return i
+    return len(history)
+
+
+def _split_turns(conversation: list[dict]) -> list[list[dict]]:
+    turns: list[list[dict]] = []
+    for message in conversation:
+        if message["role"] == "user" or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def _flatten(turns: list[list[dict]]) -> list[dict]:
+    return [m for turn in turns for m in turn]
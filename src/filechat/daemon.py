@@ -0,0 +1,334 @@
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import threading
+from typing import TYPE_CHECKING
+
+from filechat import metrics, tools
+from filechat.config import Config
+from filechat.index import (
+    QUERY_SECONDS,
+    FileIndex,
+    IndexedFile,
+    IndexStore,
+    ShardedIndex,
+    load_index,
+    update_index,
+)
+
+if TYPE_CHECKING:
+    from filechat.embedder import Embedder
+    from filechat.watcher import FileWatcher
+
+SOCKET_NAME = "daemon.sock"
+
+
+class DaemonError(Exception):
+    pass
+
+
+class Daemon:
+    """Keeps the embedding model and the indexes and watchers of projects in memory.
+
+    Clients connect to a Unix socket in the index store directory and send one JSON request per
+    line, e.g. `{"method": "query", "directory": "/path/to/project", "query": "..."}`. Each
+    request gets one line back, either `{"result": ...}` or `{"error": "..."}`.
+
+    A project is loaded, brought up to date and watched when it's first requested, and stays in
+    memory until the daemon stops. Indexes are stored whenever they're updated on request. Changes
+    made by the watchers are stored once the index stops changing for a moment, and everything is
+    stored again when the daemon stops.
+    """
+
+    # Indexes changed by the watchers are stored after they haven't changed for this long
+    STORE_DELAY_S = 5.0
+
+    def __init__(self, config: Config):
+        self._config = config
+        self._socket_path = socket_path(config)
+        self._lock = threading.Lock()
+        self._store = IndexStore(config.index_store_path)
+        self._stored_generations: dict[str, int] = {}
+        self._stopped = threading.Event()
+        self._embedder: "Embedder | None" = None
+        self._indexes: dict[str, FileIndex] = {}
+        self._watchers: dict[str, "FileWatcher"] = {}
+        self._server: socketserver.ThreadingUnixStreamServer | None = None
+        self._methods = {
+            "open": self._open,
+            "index": self._index,
+            "query": self._query,
+            "file": self._file,
+            "generation": self._generation,
+            "tool": self._tool,
+            "status": self._status,
+            "metrics": self._metrics,
+            "stop": self._stop,
+        }
+
+    def serve(self):
+        client = DaemonClient.connect(self._socket_path)
+        if client is not None:
+            client.close()
+            raise DaemonError(f"A daemon is already listening on {self._socket_path}")
+        if os.path.exists(self._socket_path):
+            # Left behind by a daemon that didn't stop cleanly
+            os.remove(self._socket_path)
+
+        self._server = socketserver.ThreadingUnixStreamServer(
+            self._socket_path, lambda *args: _RequestHandler(self, *args)
+        )
+        self._server.daemon_threads = True
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda *_: self._stop())
+        logging.info(f"Daemon listening on {self._socket_path}")
+
+        store_thread = threading.Thread(target=self._store_changed_projects, daemon=True)
+        store_thread.start()
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            os.remove(self._socket_path)
+            self._stopped.set()
+            store_thread.join()
+            self._close_projects()
+            logging.info("Daemon stopped")
+
+    def handle(self, line: bytes) -> bytes:
+        try:
+            request = json.loads(line)
+            name = request.pop("method", None)
+            method = self._methods.get(name)
+            if method is None:
+                raise DaemonError(f"Unknown method '{name}'")
+            response = {"result": method(**request)}
+        except Exception as e:
+            logging.info(f"Request failed: {e!r}")
+            response = {"error": str(e) or type(e).__name__}
+        return (json.dumps(response) + "\n").encode()
+
+    def _project(self, directory: str, rebuild: bool = False) -> tuple[FileIndex, int | None]:
+        """Returns the index of a project, and the number of files indexed if it was just opened."""
+        directory = os.path.abspath(directory)
+        index = self._indexes.get(directory)
+        if index is not None and not rebuild:
+            return index, None
+
+        with self._lock:
+            index = self._indexes.get(directory)
+            if index is not None and not rebuild:
+                return index, None
+            if index is not None:
+                self._watchers.pop(directory).stop()
+                del self._indexes[directory]
+
+            # Clients import this module too, but only the daemon needs the model and watchers
+            from filechat.embedder import Embedder
+            from filechat.watcher import FileWatcher
+
+            if self._embedder is None:
+                self._embedder = Embedder(
+                    self._config.embedding_model,
+                    self._config.embedding_model_path,
+                    self._config.embedding_model_url,
+                )
+
+            logging.info(f"Opening project {directory}")
+            index = load_index(directory, self._config, self._embedder, rebuild)
+            num_indexed = update_index(index, self._config)
+            self._stored_generations[directory] = index.generation()
+            watcher = FileWatcher(index, self._config)
+            watcher.start()
+            self._indexes[directory] = index
+            self._watchers[directory] = watcher
+            return index, num_indexed
+
+    def _close_projects(self):
+        with self._lock:
+            for directory, index in self._indexes.items():
+                self._watchers[directory].stop()
+                self._store.store(index)
+            self._indexes.clear()
+            self._watchers.clear()
+
+    def _store_changed_projects(self):
+        """Stores indexes changed since they were stored, once they stop changing.
+
+        Waiting for an index to settle avoids writing it again and again while e.g. a branch is
+        checked out. Shards that weren't used for a while are dropped from memory here too.
+        """
+        last_seen: dict[str, int] = {}
+        while not self._stopped.wait(self.STORE_DELAY_S):
+            with self._lock:
+                projects = list(self._indexes.items())
+            for directory, index in projects:
+                generation = index.generation()
+                if generation != self._stored_generations.get(directory):
+                    if last_seen.get(directory) == generation:
+                        logging.info(f"Storing changes in {directory}")
+                        self._store.store(index)
+                        self._stored_generations[directory] = generation
+                last_seen[directory] = generation
+                if isinstance(index, ShardedIndex):
+                    index.evict_idle_shards()
+
+    def _open(self, directory: str, rebuild: bool = False) -> dict:
+        index, _ = self._project(directory, rebuild)
+        return {"files": index.num_files(), "generation": index.generation()}
+
+    def _index(self, directory: str, rebuild: bool = False) -> dict:
+        index, num_indexed = self._project(directory, rebuild)
+        if num_indexed is None:
+            # `update_index` stores the index, so the work isn't lost if the daemon is killed. The
+            # watcher may change it meanwhile, so what's stored is only known to be this recent.
+            generation = index.generation()
+            num_indexed = update_index(index, self._config)
+            self._stored_generations[os.path.abspath(directory)] = generation
+        return {"indexed": num_indexed, "files": index.num_files()}
+
+    def _query(self, directory: str, query: str, top_k: int = 10) -> list[dict]:
+        index, _ = self._project(directory)
+        with QUERY_SECONDS.time():
+            hits = index.query_with_scores(query, top_k)
+        return [_file_to_dict(f) | {"score": s} for f, s in hits]
+
+    def _file(self, directory: str, path: str) -> dict | None:
+        indexed_file = self._project(directory)[0].file(path)
+        return None if indexed_file is None else _file_to_dict(indexed_file)
+
+    def _generation(self, directory: str) -> int:
+        return self._project(directory)[0].generation()
+
+    def _tool(self, directory: str, name: str, arguments: dict) -> dict | list:
+        if name not in tools.INDEX_TOOLS:
+            raise DaemonError(f"Tool '{name}' doesn't run in the daemon")
+        return tools.run_index_tool(self._project(directory)[0], name, arguments)
+
+    def _status(self) -> dict:
+        projects = [{"directory": d, "files": i.num_files()} for d, i in self._indexes.items()]
+        return {"pid": os.getpid(), "projects": projects}
+
+    def _metrics(self) -> str:
+        if not metrics.enabled():
+            raise DaemonError("The daemon doesn't collect metrics, start it with --metrics")
+        return metrics.REGISTRY.to_prometheus()
+
+    def _stop(self):
+        # `shutdown` waits for the serving loop to exit, so it can't run on the loop's thread
+        assert self._server is not None
+        threading.Thread(target=self._server.shutdown).start()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def __init__(self, daemon: Daemon, *args):
+        self._daemon = daemon
+        super().__init__(*args)
+
+    def handle(self):
+        for line in self.rfile:
+            self.wfile.write(self._daemon.handle(line))
+            self.wfile.flush()
+
+
+class DaemonClient:
+    """Connection to a running daemon. Requests from several threads are sent one at a time."""
+
+    def __init__(self, connection: socket.socket):
+        self._connection = connection
+        self._file = connection.makefile("rwb")
+        self._lock = threading.Lock()
+
+    @classmethod
+    def connect(cls, path: str) -> "DaemonClient | None":
+        """Connects to the daemon listening on `path`, returns None if there's none."""
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(path)
+        except OSError:
+            connection.close()
+            return None
+        return cls(connection)
+
+    def request(self, method: str, **params):
+        line = json.dumps({"method": method} | params) + "\n"
+        with self._lock:
+            self._file.write(line.encode())
+            self._file.flush()
+            response_line = self._file.readline()
+
+        if not response_line:
+            raise DaemonError("The daemon closed the connection")
+        response = json.loads(response_line)
+        if "error" in response:
+            raise DaemonError(response["error"])
+        return response["result"]
+
+    def close(self):
+        self._file.close()
+        self._connection.close()
+
+
+class RemoteIndex:
+    """Stands in for the `FileIndex` of a project kept by the daemon.
+
+    It has the methods the chat and the TUI use, index tools run in the daemon. There's no
+    project tree, so directory listings are made by the client.
+    """
+
+    def __init__(self, client: DaemonClient, directory: str):
+        self._client = client
+        self._directory = os.path.abspath(directory)
+
+    def open(self, rebuild: bool = False) -> int:
+        """Makes the daemon load the project, returns the number of indexed files."""
+        return self._client.request("open", directory=self._directory, rebuild=rebuild)["files"]
+
+    def query(self, query: str, top_k: int = 10) -> list[IndexedFile]:
+        with QUERY_SECONDS.time():
+            return [f for f, _ in self.query_with_scores(query, top_k)]
+
+    def query_with_scores(self, query: str, top_k: int = 10) -> list[tuple[IndexedFile, float]]:
+        hits = self._client.request("query", directory=self._directory, query=query, top_k=top_k)
+        return [(_file_from_dict(hit), hit["score"]) for hit in hits]
+
+    def file(self, relative_path: str) -> IndexedFile | None:
+        result = self._client.request("file", directory=self._directory, path=relative_path)
+        return None if result is None else _file_from_dict(result)
+
+    def generation(self) -> int:
+        return self._client.request("generation", directory=self._directory)
+
+    def run_index_tool(self, name: str, arguments: dict) -> dict | list:
+        return self._client.request(
+            "tool", directory=self._directory, name=name, arguments=arguments
+        )
+
+    def tree(self) -> None:
+        return None
+
+    def directory(self) -> str:
+        return self._directory
+
+
+def socket_path(config: Config) -> str:
+    return os.path.join(config.index_store_path, SOCKET_NAME)
+
+
+def connect(config: Config) -> DaemonClient | None:
+    return DaemonClient.connect(socket_path(config))
+
+
+def _file_to_dict(indexed_file: IndexedFile) -> dict:
+    return {
+        "path": indexed_file.path(),
+        "content": indexed_file.content(),
+        "hash": indexed_file.hash(),
+    }
+
+
+def _file_from_dict(data: dict) -> IndexedFile:
+    return IndexedFile.from_content(data["path"], data["content"], data["hash"])
@@ -2,14 +2,27 @@ import logging
 import os
 import shutil
 import tempfile
+import time
 import urllib.request
 from pathlib import Path
 
 import numpy as np
-import onnxruntime as ort
 import tqdm
 from tokenizers import Encoding, Tokenizer
 
+from filechat import metrics
+
+TOKENIZE_SECONDS = metrics.histogram("filechat_tokenize_seconds", "Tokenizing a batch of texts")
+EMBED_SECONDS = metrics.histogram(
+    "filechat_embed_seconds", "Running the embedding model on a batch of texts"
+)
+EMBED_TOKENS = metrics.counter("filechat_embed_tokens_total", "Tokens run through the model")
+EMBED_TOKENS_PER_SECOND = metrics.histogram(
+    "filechat_embed_tokens_per_second",
+    "Throughput of the embedding model, per batch",
+    metrics.RATE_BUCKETS,
+)
+
 
 class DownloadProgressBar(tqdm.tqdm):
     def update_to(self, b=1, bsize=1, tsize=None):
@@ -29,6 +42,9 @@ class Embedder:
 
         self._ensure_downloaded()
 
+        # Imported here, it's the slowest import and only needed once the model is loaded
+        import onnxruntime as ort
+
         ort.preload_dlls(cuda=True, cudnn=True)
 
         self._session = ort.InferenceSession(
@@ -49,7 +65,10 @@ class Embedder:
             shutil.move(temp_file, self._model_path)
 
     def embed(self, texts: list[str]) -> np.ndarray:
-        encoded: list[Encoding] = self._tokenizer.encode_batch(texts)
+        with TOKENIZE_SECONDS.time():
+            encoded: list[Encoding] = self._tokenizer.encode_batch(texts)
+
+        start = time.perf_counter()
         embeddings = self._session.run(
             None,
             {
@@ -58,6 +77,13 @@ class Embedder:
                 "attention_mask": np.array([e.attention_mask for e in encoded]),
             },
         )
+        if metrics.enabled():
+            duration = time.perf_counter() - start
+            num_tokens = sum(sum(e.attention_mask) for e in encoded)
+            EMBED_SECONDS.observe(duration)
+            EMBED_TOKENS.inc(num_tokens)
+            EMBED_TOKENS_PER_SECOND.observe(num_tokens / duration if duration else 0.0)
+
         assert isinstance(embeddings, list)
         assert isinstance(embeddings[0], np.ndarray)
         embeddings = embeddings[0][:, -1, :]
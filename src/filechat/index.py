@@ -1,15 +1,40 @@
+import glob
 import logging
 import os
 import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha256
 from textwrap import dedent
 from threading import Lock
+from typing import TYPE_CHECKING, Callable
 
-import faiss
 import numpy as np
 
+from filechat import metrics
 from filechat.config import Config
-from filechat.embedder import Embedder
+from filechat.symbols import Symbol, SymbolIndex, code_names
+from filechat.tree import ProjectTree
+
+if TYPE_CHECKING:
+    from filechat.embedder import Embedder
+
+SCAN_SECONDS = metrics.histogram("filechat_scan_seconds", "Walking a project for files to index")
+STAT_SECONDS = metrics.histogram(
+    "filechat_stat_seconds", "Checking whether a file is indexed, by its path and size"
+)
+READ_SECONDS = metrics.histogram("filechat_read_seconds", "Reading a file to index")
+READ_BYTES = metrics.counter("filechat_read_bytes_total", "Characters read from files to index")
+HASH_SECONDS = metrics.histogram("filechat_hash_seconds", "Hashing the content of a file")
+FAISS_ADD_SECONDS = metrics.histogram(
+    "filechat_faiss_add_seconds", "Adding a batch of embeddings to a vector index"
+)
+FAISS_SEARCH_SECONDS = metrics.histogram(
+    "filechat_faiss_search_seconds", "Searching a vector index for the nearest files"
+)
+QUERY_SECONDS = metrics.histogram(
+    "filechat_query_seconds", "Finding the files relevant to a message, end to end"
+)
 
 
 class IndexedFile:
@@ -27,6 +52,15 @@ class IndexedFile:
     def __repr__(self):
         return f"IndexedFile('{self._relative_path}')"
 
+    @classmethod
+    def from_content(cls, relative_path: str, content: str, sha_hash: str) -> "IndexedFile":
+        """Creates a file from content read elsewhere, e.g. by the daemon."""
+        indexed_file = cls.__new__(cls)
+        indexed_file._relative_path = relative_path
+        indexed_file._content = content
+        indexed_file._sha_hash = sha_hash
+        return indexed_file
+
     def content(self):
         return self._content
 
@@ -43,26 +77,57 @@ class IndexedFile:
         return self._sha_hash
 
     def _load_content(self):
-        with open(self._full_path) as f:
+        with READ_SECONDS.time(), open(self._full_path) as f:
             self._content: str = f.read()
-        self._sha_hash = sha256(self._content.encode()).hexdigest()
+        READ_BYTES.inc(len(self._content))
+        with HASH_SECONDS.time():
+            self._sha_hash = sha256(self._content.encode()).hexdigest()
 
 
 class FileIndex:
-    def __init__(self, embedder: Embedder, directory: str, dimensions: int):
+    # Added to the similarity of files defining a symbol named in the query
+    SYMBOL_MATCH_BONUS = 0.2
+
+    def __init__(self, embedder: "Embedder", directory: str, dimensions: int):
         self._file_lock = Lock()
         self._directory = os.path.abspath(directory)
         self._dimensions = dimensions
+        # faiss takes a while to import, processes using the daemon's indexes don't need it
+        import faiss
+
         self._vector_index = faiss.IndexFlatL2(self._dimensions)
         self._files: list[IndexedFile] = []
+        self._files_by_path: dict[str, IndexedFile] = {}
+        self._generation = 0
+        self._symbols = SymbolIndex()
+        self._tree: ProjectTree | None = None
         self.set_embedder(embedder)
 
-    def set_embedder(self, embedder: Embedder | None):
+    def __getstate__(self) -> dict:
+        # The embedder and the tree belong to the running process, not to the stored index
+        state = self.__dict__.copy()
+        for name in ("_embedder", "_tree", "_file_lock"):
+            del state[name]
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._embedder = None
+        self._tree = None
+        self._file_lock = Lock()
+
+    def set_embedder(self, embedder: "Embedder | None"):
         self._embedder = embedder
 
-    def embedder(self) -> Embedder | None:
+    def embedder(self) -> "Embedder | None":
         return self._embedder
 
+    def set_tree(self, tree: ProjectTree | None):
+        self._tree = tree
+
+    def tree(self) -> ProjectTree | None:
+        return self._tree
+
     def add_file(self, relative_path: str) -> bool:
         return self.add_files([relative_path]) > 0
 
@@ -74,19 +139,25 @@ class FileIndex:
             if not indexed_files:
                 return 0
 
-            texts = [f"search document: {f.content_for_embedding()}" for f in indexed_files]
-            assert self._embedder is not None
-            logging.info("Creating embeddings")
-            embeddings = self._embedder.embed(texts)
-            logging.info("Adding to vector index")
-            self._vector_index.add(embeddings)
-
-            for f in indexed_files:
-                self._files.append(f)
-                logging.info(f"Indexed file {f.path()}")
+            self._add_embedded(indexed_files, self._embed(indexed_files))
 
         return len(indexed_files)
 
+    def add_entries(self, indexed_files: list[IndexedFile], embeddings: np.ndarray):
+        """Adds files that were embedded already, replacing the versions indexed before."""
+        with self._file_lock:
+            for indexed_file in indexed_files:
+                idx, _ = self._file_needs_update(indexed_file)
+                if idx is not None:
+                    self._delete_file(idx)
+            self._add_embedded(indexed_files, embeddings)
+
+    def entries(self) -> list[tuple[IndexedFile, np.ndarray]]:
+        """Returns the indexed files with their embeddings."""
+        with self._file_lock:
+            embeddings = self._vector_index.reconstruct_n(0, self._vector_index.ntotal)
+            return list(zip(self._files, embeddings))
+
     def clean_old_files(self, config: Config):
         with self._file_lock:
             files_to_delete = []
@@ -100,22 +171,124 @@ class FileIndex:
             for i in files_to_delete[::-1]:
                 self._delete_file(i)
 
+    def remove_file(self, relative_path: str) -> bool:
+        with self._file_lock:
+            for i, f in enumerate(self._files):
+                if f.path() == relative_path:
+                    logging.info(f"Removing deleted file {relative_path}")
+                    self._delete_file(i)
+                    return True
+        return False
+
     def query(self, query: str, top_k: int = 10) -> list[IndexedFile]:
+        with QUERY_SECONDS.time():
+            return [f for f, _ in self.query_with_scores(query, top_k)]
+
+    def query_with_scores(
+        self, query: str, top_k: int = 10, query_embedding: np.ndarray | None = None
+    ) -> list[tuple[IndexedFile, float]]:
+        """`query_embedding` can be passed in if the query was embedded already."""
         filenames = [f.path() for f in self._files]
         assert len(filenames) == len(set(filenames))
         logging.info(f"Querying: `{query}`")
+        if query_embedding is None:
+            query_embedding = self.embed_query(query)
+        with FAISS_SEARCH_SECONDS.time():
+            distances, indices = self._vector_index.search(
+                query_embedding.reshape(1, -1), k=top_k
+            )
+
+        # Embeddings are normalized, so the squared L2 distance is 2 - 2 * cosine similarity
+        matching_files = {}
+        for idx, distance in zip(indices[0], distances[0]):
+            if idx >= 0:
+                indexed_file = self._files[idx]
+                matching_files[indexed_file.path()] = (indexed_file, 1 - float(distance) / 2)
+
+        # Files defining a symbol named in the query get a bonus
+        boosted_paths = set()
+        for name in code_names(query):
+            for symbol in self._symbols.definitions(name):
+                if symbol.kind == "variable" or symbol.path in boosted_paths:
+                    continue
+                boosted_paths.add(symbol.path)
+                if symbol.path not in matching_files:
+                    matching_files[symbol.path] = self._file_with_similarity(
+                        symbol.path, query_embedding
+                    )
+                indexed_file, similarity = matching_files[symbol.path]
+                matching_files[symbol.path] = (indexed_file, similarity + self.SYMBOL_MATCH_BONUS)
+
+        hits = sorted(matching_files.values(), key=lambda hit: hit[1], reverse=True)
+        return hits[:top_k]
+
+    def _file_with_similarity(
+        self, relative_path: str, query_embedding: np.ndarray
+    ) -> tuple[IndexedFile, float]:
+        indexed_file = self._files_by_path[relative_path]
+        embedding = self._vector_index.reconstruct(self._files.index(indexed_file))
+        return indexed_file, float(np.dot(embedding, query_embedding.reshape(-1)))
+
+    def embed_query(self, query: str) -> np.ndarray:
         assert self._embedder is not None
-        query_embedding = self._embedder.embed([f"search_query: {query}"])
-        _, indices = self._vector_index.search(query_embedding.reshape(1, -1), k=top_k)
+        return self._embedder.embed([f"search_query: {query}"])
+
+    def files(self, directory: str = "") -> list[IndexedFile]:
+        """Returns the indexed files, only the ones in `directory` if it's given."""
+        with self._file_lock:
+            files = list(self._files)
+        if not directory:
+            return files
+        return [f for f in files if _is_within(f.path(), directory)]
+
+    def search_files(
+        self, query: str, query_embedding: np.ndarray | None = None
+    ) -> list[IndexedFile]:
+        """Returns the files a text search for `query` should look at, here all of them."""
+        return self.files()
+
+    def num_files(self) -> int:
+        return len(self._files)
+
+    def centroid(self) -> np.ndarray | None:
+        """The normalized mean of the file embeddings, `None` if there are no files."""
+        with self._file_lock:
+            if self._vector_index.ntotal == 0:
+                return None
+            mean = self._vector_index.reconstruct_n(0, self._vector_index.ntotal).mean(axis=0)
+        return mean / max(float(np.linalg.norm(mean)), 1e-12)
+
+    def file(self, relative_path: str) -> IndexedFile | None:
+        return self._files_by_path.get(os.path.normpath(relative_path))
+
+    def generation(self) -> int:
+        """Increases whenever indexed files are added, changed or removed."""
+        return self._generation
 
-        matching_files = []
-        for idx in set(indices[0]):
-            matching_files.append(self._files[idx])
-        return matching_files
+    def symbols(self) -> SymbolIndex:
+        return self._symbols
 
     def directory(self) -> str:
         return self._directory
 
+    def _embed(self, indexed_files: list[IndexedFile]) -> np.ndarray:
+        texts = [f"search document: {f.content_for_embedding()}" for f in indexed_files]
+        assert self._embedder is not None
+        logging.info("Creating embeddings")
+        return self._embedder.embed(texts)
+
+    def _add_embedded(self, indexed_files: list[IndexedFile], embeddings: np.ndarray):
+        logging.info("Adding to vector index")
+        with FAISS_ADD_SECONDS.time():
+            self._vector_index.add(embeddings)
+
+        self._generation += 1
+        for f in indexed_files:
+            self._files.append(f)
+            self._files_by_path[f.path()] = f
+            self._symbols.update_file(f.path(), f.content())
+            logging.info(f"Indexed file {f.path()}")
+
     def _file_needs_update(self, indexed_file: IndexedFile):
         for i, f in enumerate(self._files):
             if indexed_file.path() == f.path():
@@ -123,7 +296,10 @@ class FileIndex:
         return None, True
 
     def _delete_file(self, idx: int):
-        self._files.pop(idx)
+        removed = self._files.pop(idx)
+        del self._files_by_path[removed.path()]
+        self._generation += 1
+        self._symbols.remove_file(removed.path())
         self._vector_index.remove_ids(np.array([idx]))
 
     def _prepare_for_indexing(self, relative_path: str) -> IndexedFile | None:
@@ -140,6 +316,296 @@ class FileIndex:
         return indexed_file
 
 
+class ShardedIndex(FileIndex):
+    """A `FileIndex` split into shards by the directories at `shard_depth`.
+
+    Every shard is a `FileIndex` of its own, stored in its own file. Files above `shard_depth`
+    share the shard `""`. The index itself keeps only a manifest with the hash of every indexed
+    file, so files that didn't change are recognized without loading their shard.
+
+    The manifest also keeps a summary of every stored shard: the centroid of its embeddings and
+    the names that occur in it. Queries are embedded once and run in a thread pool on the
+    `QUERIED_SHARDS` shards with the centroids closest to the query, and on the shards that have
+    a name from the query. Symbol lookups load only the shards that have the name. Shards that
+    changed since they were stored are always used, their summaries are updated when they're
+    stored.
+
+    A stored shard is loaded when it's needed and dropped again when it isn't used for
+    `SHARD_IDLE_S`. Only shards that changed since they were stored are written again.
+    """
+
+    # Number of shards a query runs on, besides the changed ones and the ones naming its symbols
+    QUERIED_SHARDS = 4
+    # Seconds after which a loaded shard without unstored changes is dropped if it isn't used
+    SHARD_IDLE_S = 300.0
+
+    def __init__(self, embedder: "Embedder", directory: str, dimensions: int, shard_depth: int):
+        super().__init__(embedder, directory, dimensions)
+        self._shard_depth = shard_depth
+        self._manifest: dict[str, dict[str, str]] = {}
+        self._centroids: dict[str, np.ndarray | None] = {}
+        self._names: dict[str, set[str]] = {}
+        self._stored_generations: dict[str, int] = {}
+        self._init_runtime_state()
+
+    def __getstate__(self) -> dict:
+        # Shards are stored in files of their own
+        state = super().__getstate__()
+        for name in ("_shards", "_shards_lock", "_last_used", "_executor", "_store"):
+            del state[name]
+        return state
+
+    def __setstate__(self, state: dict):
+        super().__setstate__(state)
+        # Shards of indexes stored without summaries are summarized when they're loaded
+        self.__dict__.setdefault("_centroids", {})
+        self.__dict__.setdefault("_names", {})
+        self._init_runtime_state()
+
+    def shard_depth(self) -> int:
+        return self._shard_depth
+
+    def set_embedder(self, embedder: "Embedder | None"):
+        super().set_embedder(embedder)
+        for shard in getattr(self, "_shards", {}).values():
+            shard.set_embedder(embedder)
+
+    def set_store(self, store: "IndexStore | None"):
+        """Sets where shards that aren't loaded yet are loaded from."""
+        self._store = store
+
+    def add_files(self, relative_paths: list[str]) -> int:
+        with self._file_lock:
+            logging.info(f"Indexing batch of {len(relative_paths)} files")
+            indexed_files = []
+            for relative_path in relative_paths:
+                indexed_file = IndexedFile(self._directory, relative_path)
+                stored_hash = self._manifest.get(self._shard_key(relative_path), {}).get(
+                    indexed_file.path()
+                )
+                if stored_hash == indexed_file.hash():
+                    logging.info(f"File {relative_path} is already up to date")
+                else:
+                    indexed_files.append(indexed_file)
+
+            if not indexed_files:
+                return 0
+            self._add_entries(indexed_files, self._embed(indexed_files))
+
+        return len(indexed_files)
+
+    def add_entries(self, indexed_files: list[IndexedFile], embeddings: np.ndarray):
+        with self._file_lock:
+            self._add_entries(indexed_files, embeddings)
+
+    def entries(self) -> list[tuple[IndexedFile, np.ndarray]]:
+        return [entry for shard in self._all_shards() for entry in shard.entries()]
+
+    def clean_old_files(self, config: Config):
+        with self._file_lock:
+            paths = [path for hashes in self._manifest.values() for path in hashes]
+        for path in paths:
+            if is_ignored(self._directory, os.path.join(self._directory, path), config):
+                self.remove_file(path)
+
+    def remove_file(self, relative_path: str) -> bool:
+        with self._file_lock:
+            key = self._shard_key(relative_path)
+            if relative_path not in self._manifest.get(key, {}):
+                return False
+            self._shard(key).remove_file(relative_path)
+            del self._manifest[key][relative_path]
+            self._generation += 1
+        return True
+
+    def query_with_scores(
+        self, query: str, top_k: int = 10, query_embedding: np.ndarray | None = None
+    ) -> list[tuple[IndexedFile, float]]:
+        if query_embedding is None:
+            query_embedding = self.embed_query(query)
+
+        shard_hits = self._executor.map(
+            lambda key: self._shard(key).query_with_scores(query, top_k, query_embedding),
+            self._needed_shards(code_names(query), query_embedding),
+        )
+        hits = [hit for hits in shard_hits for hit in hits]
+        hits.sort(key=lambda hit: hit[1], reverse=True)
+        self.evict_idle_shards()
+        return hits[:top_k]
+
+    def files(self, directory: str = "") -> list[IndexedFile]:
+        """Returns the indexed files, loading only the shards that can have files in `directory`."""
+        keys = list(self._manifest)
+        if directory:
+            # The shards of files right in `directory`, of `directory` if it's a file, and below it
+            containing = {self._shard_key(directory), self._shard_key(os.path.join(directory, "_"))}
+            keys = [key for key in keys if key in containing or _is_within(key, directory)]
+        return [f for key in keys for f in self._shard(key).files(directory)]
+
+    def search_files(
+        self, query: str, query_embedding: np.ndarray | None = None
+    ) -> list[IndexedFile]:
+        """Returns the files of the shards a query for `query` runs on."""
+        if query_embedding is None:
+            query_embedding = self.embed_query(query)
+        keys = self._needed_shards(code_names(query), query_embedding)
+        return [f for key in keys for f in self._shard(key).files()]
+
+    def num_files(self) -> int:
+        return sum(len(hashes) for hashes in list(self._manifest.values()))
+
+    def file(self, relative_path: str) -> IndexedFile | None:
+        relative_path = os.path.normpath(relative_path)
+        key = self._shard_key(relative_path)
+        if relative_path not in self._manifest.get(key, {}):
+            return None
+        return self._shard(key).file(relative_path)
+
+    def symbols(self) -> "ShardedSymbols":
+        return ShardedSymbols(
+            lambda name: [self._shard(key).symbols() for key in self._needed_shards([name])]
+        )
+
+    def loaded_shards(self) -> list[str]:
+        return list(self._shards)
+
+    def changed_shards(self) -> dict[str, FileIndex]:
+        """Returns the loaded shards that changed since they were stored."""
+        with self._shards_lock:
+            shards = list(self._shards.items())
+        return {
+            key: shard
+            for key, shard in shards
+            if self._stored_generations.get(key) != shard.generation()
+        }
+
+    def mark_stored(self, key: str):
+        shard = self._shards[key]
+        self._stored_generations[key] = shard.generation()
+        self._summarize(key, shard)
+
+    def evict_idle_shards(self):
+        """Drops loaded shards that weren't used for `SHARD_IDLE_S` and have no unstored changes."""
+        # Without a store, dropped shards couldn't be loaded again
+        if self._store is None:
+            return
+        # Skipped while the index changes, a shard must not be dropped between loading and changing
+        if not self._file_lock.acquire(blocking=False):
+            return
+        try:
+            now = time.monotonic()
+            with self._shards_lock:
+                for key, shard in list(self._shards.items()):
+                    idle = now - self._last_used.get(key, now) > self.SHARD_IDLE_S
+                    if idle and self._stored_generations.get(key) == shard.generation():
+                        logging.info(f"Dropping idle shard '{key}'")
+                        del self._shards[key]
+        finally:
+            self._file_lock.release()
+
+    def _init_runtime_state(self):
+        self._shards: dict[str, FileIndex] = {}
+        self._shards_lock = Lock()
+        self._last_used: dict[str, float] = {}
+        self._executor = ThreadPoolExecutor(thread_name_prefix="shard")
+        self._store: IndexStore | None = None
+
+    def _add_entries(self, indexed_files: list[IndexedFile], embeddings: np.ndarray):
+        files_by_shard: dict[str, list[int]] = {}
+        for i, indexed_file in enumerate(indexed_files):
+            files_by_shard.setdefault(self._shard_key(indexed_file.path()), []).append(i)
+
+        for key, positions in files_by_shard.items():
+            shard_files = [indexed_files[i] for i in positions]
+            self._shard(key).add_entries(shard_files, embeddings[positions])
+            self._manifest.setdefault(key, {}).update({f.path(): f.hash() for f in shard_files})
+        self._generation += 1
+
+    def _shard_key(self, relative_path: str) -> str:
+        directories = os.path.normpath(relative_path).split(os.sep)[:-1]
+        return os.path.join(*directories[: self._shard_depth]) if directories else ""
+
+    def _shard(self, key: str) -> FileIndex:
+        self._last_used[key] = time.monotonic()
+        shard = self._shards.get(key)
+        if shard is not None:
+            return shard
+
+        with self._shards_lock:
+            if key in self._shards:
+                return self._shards[key]
+
+            shard = None
+            if self._manifest.get(key):
+                if self._store is None:
+                    raise RuntimeError(f"Shard '{key}' isn't loaded and has no store to load from")
+                try:
+                    shard = self._store.load_shard(self._directory, key, self._embedder)
+                    self._stored_generations[key] = shard.generation()
+                    if key not in self._centroids:
+                        self._summarize(key, shard)
+                except FileNotFoundError:
+                    # The shard's files are indexed again by the next update
+                    logging.info(f"Stored shard '{key}' not found, starting it from scratch")
+                    self._manifest[key] = {}
+            if shard is None:
+                shard = FileIndex(self._embedder, self._directory, self._dimensions)
+            self._shards[key] = shard
+            return shard
+
+    def _all_shards(self) -> list[FileIndex]:
+        return [self._shard(key) for key in list(self._manifest)]
+
+    def _needed_shards(
+        self, names: list[str], query_embedding: np.ndarray | None = None
+    ) -> list[str]:
+        """Returns the keys of the shards that have one of `names` or are closest to the query.
+
+        Shards that changed since they were stored or have no summary yet are always needed.
+        """
+        changed = self.changed_shards()
+        centroids = dict(self._centroids)
+        shard_names = dict(self._names)
+        needed = {
+            key
+            for key in list(self._manifest)
+            if key in changed
+            or key not in centroids
+            or any(name in shard_names.get(key, ()) for name in names)
+        }
+        if query_embedding is not None:
+            query_embedding = query_embedding.reshape(-1)
+            scores = {
+                key: float(np.dot(centroid, query_embedding))
+                for key, centroid in centroids.items()
+                if centroid is not None
+            }
+            needed.update(sorted(scores, key=scores.get, reverse=True)[: self.QUERIED_SHARDS])
+        return sorted(needed)
+
+    def _summarize(self, key: str, shard: FileIndex):
+        self._centroids[key] = shard.centroid()
+        self._names[key] = shard.symbols().names()
+
+
+class ShardedSymbols:
+    """The symbols of a `ShardedIndex`, looked up like a `SymbolIndex`.
+
+    `symbol_indexes` returns the symbols of the shards that may have a name.
+    """
+
+    def __init__(self, symbol_indexes: Callable[[str], list[SymbolIndex]]):
+        self._symbol_indexes = symbol_indexes
+
+    def definitions(self, name: str, include_imports: bool = False) -> list[Symbol]:
+        return [
+            s for i in self._symbol_indexes(name) for s in i.definitions(name, include_imports)
+        ]
+
+    def references(self, name: str) -> list[str]:
+        return sorted(path for i in self._symbol_indexes(name) for path in i.references(name))
+
+
 class IndexStore:
 
     def __init__(self, directory: str):
@@ -148,32 +614,61 @@ class IndexStore:
 
     def store(self, file_index: FileIndex):
         logging.info(f"Storing index for {file_index.directory()}")
-        model = file_index.embedder()
-        file_index.set_embedder(None)
-        file_index._file_lock = None
-        file_path = self._get_file_path(file_index.directory())
-        with open(file_path, "wb") as f:
-            pickle.dump(file_index, f)
-        file_index.set_embedder(model)
-        file_index._file_lock = Lock()
+        # The index may be in use, e.g. by a watcher, so it's kept from changing while it's written.
+        # Shards only change through their sharded index, so its lock covers them too.
+        with file_index._file_lock:
+            if isinstance(file_index, ShardedIndex):
+                # Shards dropped from memory are loaded from here again
+                file_index.set_store(self)
+                for key, shard in file_index.changed_shards().items():
+                    logging.info(f"Storing shard '{key}'")
+                    self._write(shard, self._get_shard_path(file_index.directory(), key))
+                    file_index.mark_stored(key)
+            self._write(file_index, self._get_file_path(file_index.directory()))
+        if isinstance(file_index, ShardedIndex):
+            file_index.evict_idle_shards()
         logging.info("Index stored")
 
-    def load(self, directory: str, embedder: Embedder) -> FileIndex:
+    def load(self, directory: str, embedder: "Embedder") -> FileIndex:
         directory_abs_path = os.path.abspath(directory)
         logging.info(f"Trying to load cached index for {directory_abs_path}")
-        file_path = self._get_file_path(directory_abs_path)
-        with open(file_path, "rb") as f:
-            file_index = pickle.load(f)
-        file_index.set_embedder(embedder)
-        file_index._file_lock = Lock()
+        file_index = self._read(self._get_file_path(directory_abs_path), embedder)
+        if isinstance(file_index, ShardedIndex):
+            file_index.set_store(self)
         logging.info("Index loaded")
         return file_index
 
+    def load_shard(self, directory: str, key: str, embedder: "Embedder | None") -> FileIndex:
+        logging.info(f"Loading shard '{key}' of {directory}")
+        return self._read(self._get_shard_path(directory, key), embedder)
+
     def remove(self, directory: str):
         directory_abs_path = os.path.abspath(directory)
         file_path = self._get_file_path(directory_abs_path)
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        shard_paths = glob.glob(file_path.removesuffix(".pickle") + "-*.pickle")
+        for path in [file_path] + shard_paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _write(self, file_index: FileIndex, file_path: str):
+        # Written next to the stored index first, so a crash never leaves half of it behind
+        temp_path = file_path + ".tmp"
+        with open(temp_path, "wb") as f:
+            pickle.dump(file_index, f)
+        os.replace(temp_path, file_path)
+
+    def _read(self, file_path: str, embedder: "Embedder | None") -> FileIndex:
+        with open(file_path, "rb") as f:
+            file_index = pickle.load(f)
+        file_index.set_embedder(embedder)
+        if not hasattr(file_index, "_symbols"):
+            logging.info("Building symbol table for an index stored without one")
+            file_index._symbols = SymbolIndex()
+            for indexed_file in file_index._files:
+                file_index._symbols.update_file(indexed_file.path(), indexed_file.content())
+        file_index._files_by_path = {f.path(): f for f in file_index._files}
+        file_index._generation = getattr(file_index, "_generation", 0)
+        return file_index
 
     def _get_file_path(self, directory: str) -> str:
         file_hash = sha256(directory.encode()).hexdigest()
@@ -181,10 +676,23 @@ class IndexStore:
         file_path = os.path.join(self._directory, file_name)
         return file_path
 
+    def _get_shard_path(self, directory: str, key: str) -> str:
+        shard_hash = sha256(key.encode()).hexdigest()[:16]
+        return self._get_file_path(directory).removesuffix(".pickle") + f"-{shard_hash}.pickle"
+
 
 def get_index(
-    directory: str, config: Config, embedder: Embedder, rebuild: bool = False
+    directory: str, config: Config, embedder: "Embedder", rebuild: bool = False
 ) -> tuple[FileIndex, int]:
+    index = load_index(directory, config, embedder, rebuild)
+    num_indexed = update_index(index, config)
+    return index, num_indexed
+
+
+def load_index(
+    directory: str, config: Config, embedder: "Embedder", rebuild: bool = False
+) -> FileIndex:
+    """Loads the stored index for `directory`, or creates an empty one."""
     index_store = IndexStore(config.index_store_path)
 
     if not os.path.isdir(directory):
@@ -192,45 +700,101 @@ def get_index(
 
     if rebuild:
         logging.info("Rebuilding index from scratch")
-        index = FileIndex(embedder, directory, 768)
-    else:
-        try:
-            index = index_store.load(directory, embedder)
-            index.clean_old_files(config)
-        except FileNotFoundError:
-            logging.info("Index file not found. Creating new index from scratch")
-            index = FileIndex(embedder, directory, 768)
+        return _new_index(directory, config, embedder)
+
+    try:
+        index = index_store.load(directory, embedder)
+    except FileNotFoundError:
+        logging.info("Index file not found. Creating new index from scratch")
+        return _new_index(directory, config, embedder)
+
+    shard_depth = index.shard_depth() if isinstance(index, ShardedIndex) else 0
+    if shard_depth == config.index_shard_depth:
+        return index
+
+    # Embeddings are kept, so changing the layout doesn't index the files again
+    logging.info(f"Moving index from shard depth {shard_depth} to {config.index_shard_depth}")
+    new_index = _new_index(directory, config, embedder)
+    entries = index.entries()
+    if entries:
+        indexed_files, embeddings = zip(*entries)
+        new_index.add_entries(list(indexed_files), np.stack(embeddings))
+    index_store.remove(directory)
+    return new_index
+
+
+def update_index(
+    index: FileIndex, config: Config, on_progress: Callable[[int, int], None] | None = None
+) -> int:
+    """Brings the index in line with the files on disk and stores it.
+
+    `on_progress` is called with the number of files checked so far and the total after every
+    batch. Returns the number of files that had to be (re)indexed.
+    """
+    directory = index.directory()
+    index.clean_old_files(config)
+
+    relative_paths = []
+    tree = ProjectTree(directory, config)
+    with SCAN_SECONDS.time():
+        for root, dirs, files in walk_project(directory, config):
+            tree.add_listing(os.path.relpath(root, directory), dirs, files)
+            for file in files:
+                full_path = os.path.join(root, file)
+                if not is_ignored(directory, full_path, config):
+                    relative_paths.append(os.path.relpath(full_path, directory))
 
     num_indexed = 0
-    batch = []
-    for root, _, files in os.walk(directory):
-        for file in files:
-            full_path = os.path.join(root, file)
-            if not is_ignored(directory, full_path, config):
-                batch.append(os.path.relpath(full_path, directory))
+    for start in range(0, len(relative_paths), config.index_batch_size):
+        num_indexed += index.add_files(relative_paths[start : start + config.index_batch_size])
+        if on_progress is not None:
+            num_checked = min(start + config.index_batch_size, len(relative_paths))
+            on_progress(num_checked, len(relative_paths))
 
-            if len(batch) >= config.index_batch_size:
-                num_indexed += index.add_files(batch)
-                batch = []
+    index.set_tree(tree)
+    IndexStore(config.index_store_path).store(index)
+    return num_indexed
 
-    if batch:
-        num_indexed += index.add_files(batch)
 
-    index_store.store(index)
-    return index, num_indexed
+def _new_index(directory: str, config: Config, embedder: "Embedder") -> FileIndex:
+    if config.index_shard_depth > 0:
+        return ShardedIndex(embedder, directory, 768, config.index_shard_depth)
+    return FileIndex(embedder, directory, 768)
+
+
+def _is_within(path: str, directory: str) -> bool:
+    return path == directory or path.startswith(directory + os.sep)
+
+
+def walk_project(directory: str, config: Config, start: str | None = None):
+    for root, dirs, files in os.walk(start or directory):
+        dirs[:] = [d for d in dirs if d not in config.ignored_dirs]
+        yield root, dirs, files
 
 
 def is_ignored(directory: str, full_path: str, config: Config) -> bool:
+    with STAT_SECONDS.time():
+        return _is_ignored(directory, full_path, config)
+
+
+def _is_ignored(directory: str, full_path: str, config: Config) -> bool:
     relative_path = os.path.relpath(full_path, directory)
     directory_parts = relative_path.split(os.sep)[:-1]
-    file_size = os.path.getsize(full_path)
 
-    file_exists = os.path.exists(full_path)
+    if not os.path.exists(full_path):
+        return True
+
+    file_size = os.path.getsize(full_path)
     file_ignored = any(ign in directory_parts for ign in config.ignored_dirs)
     file_suffix_allowed = any(full_path.endswith(s) for s in config.allowed_suffixes)
     file_above_max_size = file_size > config.max_file_size_kb * 1024
 
-    should_ignore = (
-        not file_exists or file_ignored or not file_suffix_allowed or file_above_max_size
-    )
+    should_ignore = file_ignored or not file_suffix_allowed or file_above_max_size
     return should_ignore
+
+
+def is_ignored_directory(directory: str, full_path: str, config: Config) -> bool:
+    relative_path = os.path.relpath(full_path, directory)
+    if relative_path == ".":
+        return False
+    return any(part in config.ignored_dirs for part in relative_path.split(os.sep))
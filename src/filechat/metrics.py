@@ -0,0 +1,272 @@
+"""Counters and histograms of where time goes, e.g. in indexing, retrieval and LLM responses.
+
+Metrics are off unless `enable` is called. While they're off, recording is a single check of a
+flag and timers are a shared no-op context manager, so instrumented code doesn't pay for them.
+
+Metrics are created once, usually at module level, and are identified by their name and labels:
+
+    READ_SECONDS = metrics.histogram("filechat_read_seconds", "Reading a file to index")
+
+    with READ_SECONDS.time():
+        content = f.read()
+"""
+
+import json
+import os
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from threading import Lock
+
+# Upper bounds of the buckets of histograms measuring durations, from 0.1 ms to a minute
+SECONDS_BUCKETS = (
+    0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60
+)
+RATE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 100000)
+
+_enabled = False
+_dump_path: str | None = None
+_NO_TIMER = nullcontext()
+
+
+def enable(dump_path: str | None = None):
+    """Starts collecting metrics, `dump_path` is where `dump` writes them."""
+    global _enabled, _dump_path
+    _enabled = True
+    _dump_path = dump_path
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def dump_path() -> str | None:
+    return _dump_path
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: dict[str, str]):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._value = 0.0
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1.0):
+        if not _enabled:
+            return
+        with self._lock:
+            self._value += amount
+
+    def value(self) -> float:
+        return self._value
+
+    def reset(self):
+        with self._lock:
+            self._value = 0.0
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: dict[str, str], buckets: tuple):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._lock = Lock()
+        self.reset()
+
+    def observe(self, value: float):
+        if not _enabled:
+            return
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            self._bucket_counts[bucket] += 1
+            self._count += 1
+            self._sum += value
+            self._max = max(self._max, value)
+
+    def time(self) -> "_Timer | nullcontext":
+        """Observes how long the `with` block takes, in seconds."""
+        return _Timer(self) if _enabled else _NO_TIMER
+
+    def count(self) -> int:
+        return self._count
+
+    def sum(self) -> float:
+        return self._sum
+
+    def max(self) -> float:
+        return self._max
+
+    def mean(self) -> float:
+        return self._sum / self._count if self._count else 0.0
+
+    def quantile(self, q: float) -> float:
+        """Estimates a quantile by interpolating within the bucket it falls in."""
+        with self._lock:
+            bucket_counts = list(self._bucket_counts)
+            count = self._count
+            max_value = self._max
+        if not count:
+            return 0.0
+
+        rank = q * count
+        cumulative = 0
+        for i, bucket_count in enumerate(bucket_counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else max_value
+                estimate = lower + (upper - lower) * (rank - cumulative) / bucket_count
+                return min(estimate, max_value)
+            cumulative += bucket_count
+        return max_value
+
+    def cumulative_counts(self) -> list[int]:
+        """Number of observations up to each bucket's bound, the last one is all of them."""
+        with self._lock:
+            counts = []
+            total = 0
+            for bucket_count in self._bucket_counts:
+                total += bucket_count
+                counts.append(total)
+            return counts
+
+    def reset(self):
+        with self._lock:
+            # The last bucket has no upper bound
+            self._bucket_counts = [0] * (len(self.buckets) + 1)
+            self._count = 0
+            self._sum = 0.0
+            self._max = 0.0
+
+
+class _Timer:
+    __slots__ = ("_histogram", "_start")
+
+    def __init__(self, histogram: Histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[tuple, Counter | Histogram] = {}
+        self._lock = Lock()
+
+    def counter(self, name: str, help: str, **labels: str) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+    def histogram(
+        self, name: str, help: str, buckets: tuple = SECONDS_BUCKETS, **labels: str
+    ) -> Histogram:
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def metrics(self) -> list[Counter | Histogram]:
+        with self._lock:
+            return sorted(self._metrics.values(), key=lambda m: (m.name, sorted(m.labels.items())))
+
+    def reset(self):
+        for metric in self.metrics():
+            metric.reset()
+
+    def to_dict(self) -> list[dict]:
+        result = []
+        for metric in self.metrics():
+            entry = {"name": metric.name, "labels": metric.labels}
+            if isinstance(metric, Counter):
+                entry |= {"type": "counter", "value": metric.value()}
+            else:
+                bounds = [_number(b) for b in metric.buckets] + ["+Inf"]
+                entry |= {
+                    "type": "histogram",
+                    "count": metric.count(),
+                    "sum": metric.sum(),
+                    "max": metric.max(),
+                    "p50": metric.quantile(0.5),
+                    "p95": metric.quantile(0.95),
+                    "p99": metric.quantile(0.99),
+                    "buckets": dict(zip(bounds, metric.cumulative_counts())),
+                }
+            result.append(entry)
+        return result
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self) -> str:
+        """Formats the metrics in the Prometheus text exposition format."""
+        lines = []
+        described = set()
+        for metric in self.metrics():
+            if metric.name not in described:
+                kind = "counter" if isinstance(metric, Counter) else "histogram"
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {kind}")
+                described.add(metric.name)
+
+            if isinstance(metric, Counter):
+                lines.append(f"{metric.name}{_labels(metric.labels)} {_number(metric.value())}")
+                continue
+
+            bounds = [_number(b) for b in metric.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, metric.cumulative_counts()):
+                labels = _labels(metric.labels | {"le": bound})
+                lines.append(f"{metric.name}_bucket{labels} {count}")
+            lines.append(f"{metric.name}_sum{_labels(metric.labels)} {_number(metric.sum())}")
+            lines.append(f"{metric.name}_count{_labels(metric.labels)} {metric.count()}")
+        return "\n".join(lines) + "\n"
+
+    def _get(self, metric_class: type, name: str, help: str, labels: dict, *args):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(key, metric_class(name, help, labels, *args))
+        return metric
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, help: str, **labels: str) -> Counter:
+    return REGISTRY.counter(name, help, **labels)
+
+
+def histogram(name: str, help: str, buckets: tuple = SECONDS_BUCKETS, **labels: str) -> Histogram:
+    return REGISTRY.histogram(name, help, buckets, **labels)
+
+
+def dump(path: str | None = None):
+    """Writes the metrics as JSON if the path ends with `.json`, in the Prometheus format if not."""
+    path = path or _dump_path
+    if path is None:
+        raise ValueError("No path to dump metrics to")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    text = REGISTRY.to_json() if path.endswith(".json") else REGISTRY.to_prometheus()
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels.items()
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
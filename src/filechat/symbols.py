@@ -0,0 +1,264 @@
+import ast
+import logging
+import re
+from typing import NamedTuple
+
+IDENTIFIER_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+BACKTICKED_PATTERN = re.compile(r"`([^`\n]+)`")
+# A lowercase letter followed by an uppercase one, e.g. `renderTree`, or an acronym followed by
+# a word, e.g. `HTTPServer`
+CAMEL_CASE_PATTERN = re.compile(r"[a-z][A-Z]|[A-Z]{2}[a-z]")
+
+CONTROL_KEYWORDS = {"if", "for", "while", "switch", "catch", "return", "else", "sizeof", "do"}
+
+JS_PATTERNS = [
+    (
+        "function",
+        re.compile(r"^\s*(?:export\s+)?(?:default\s+)?(?:async\s+)?function\s*\*?\s*(\w+)"),
+    ),
+    ("class", re.compile(r"^\s*(?:export\s+)?(?:default\s+)?(?:abstract\s+)?class\s+(\w+)")),
+    ("interface", re.compile(r"^\s*(?:export\s+)?interface\s+(\w+)")),
+    ("type", re.compile(r"^\s*(?:export\s+)?type\s+(\w+)\s*(?:<[^=]*>)?\s*=")),
+    ("enum", re.compile(r"^\s*(?:export\s+)?(?:const\s+)?enum\s+(\w+)")),
+    ("variable", re.compile(r"^(?:export\s+)?(?:const|let|var)\s+(\w+)")),
+    (
+        "method",
+        re.compile(r"^\s+(?:static\s+)?(?:async\s+)?(?:get\s+|set\s+)?(\w+)\s*\([^)]*\)\s*\{"),
+    ),
+]
+JS_IMPORT = re.compile(r"^\s*import\s+(.+?)\s+from\s+['\"]")
+JS_IMPORT_ALIAS = re.compile(r"\w+\s+as\s+(\w+)")
+
+GO_PATTERNS = [
+    ("method", re.compile(r"^func\s+\([^)]*\)\s*(\w+)")),
+    ("function", re.compile(r"^func\s+(\w+)")),
+    ("struct", re.compile(r"^(?:type\s+)?(\w+)\s+struct\b")),
+    ("interface", re.compile(r"^(?:type\s+)?(\w+)\s+interface\b")),
+    ("type", re.compile(r"^type\s+(\w+)")),
+    ("variable", re.compile(r"^(?:const|var)\s+(\w+)")),
+]
+GO_IMPORT = re.compile(r"^\s*(?:import\s+)?(?:(\w+)\s+)?\"([^\"]+)\"\s*$")
+
+C_PATTERNS = [
+    ("macro", re.compile(r"^\s*#\s*define\s+(\w+)")),
+    ("struct", re.compile(r"^\s*(?:typedef\s+)?struct\s+(\w+)\s*\{?\s*$")),
+    ("enum", re.compile(r"^\s*(?:typedef\s+)?enum\s+(\w+)\s*\{?\s*$")),
+    ("type", re.compile(r"^\s*typedef\s+.*?(\w+)\s*;")),
+    ("type", re.compile(r"^\s*\}\s*(\w+)\s*;")),
+    ("function", re.compile(r"^(?:[A-Za-z_][\w\s\*]*?[\s\*])?(\w+)\s*\([^;]*$")),
+]
+C_INCLUDE = re.compile(r"^\s*#\s*include\s+[<\"]([^>\"]+)[>\"]")
+
+
+class Symbol(NamedTuple):
+    name: str
+    kind: str
+    path: str
+    line: int
+    signature: str
+
+
+class SymbolIndex:
+    """Definitions and identifier occurrences of the indexed files.
+
+    Python files are parsed with `ast`. JavaScript/TypeScript, Go and C files are scanned line by
+    line with patterns for their common definition forms. Lookups are dictionary accesses.
+    """
+
+    def __init__(self):
+        self._by_file: dict[str, list[Symbol]] = {}
+        self._by_name: dict[str, list[Symbol]] = {}
+        self._identifiers_by_file: dict[str, set[str]] = {}
+        self._files_by_identifier: dict[str, set[str]] = {}
+
+    def update_file(self, path: str, content: str):
+        self.remove_file(path)
+        symbols = extract_symbols(path, content)
+        self._by_file[path] = symbols
+        for symbol in symbols:
+            self._by_name.setdefault(symbol.name, []).append(symbol)
+
+        identifiers = set(IDENTIFIER_PATTERN.findall(content))
+        self._identifiers_by_file[path] = identifiers
+        for identifier in identifiers:
+            self._files_by_identifier.setdefault(identifier, set()).add(path)
+
+    def remove_file(self, path: str):
+        for symbol in self._by_file.pop(path, []):
+            remaining = [s for s in self._by_name[symbol.name] if s.path != path]
+            if remaining:
+                self._by_name[symbol.name] = remaining
+            else:
+                del self._by_name[symbol.name]
+
+        for identifier in self._identifiers_by_file.pop(path, set()):
+            files = self._files_by_identifier[identifier]
+            files.discard(path)
+            if not files:
+                del self._files_by_identifier[identifier]
+
+    def definitions(self, name: str, include_imports: bool = False) -> list[Symbol]:
+        symbols = self._by_name.get(name, [])
+        if include_imports:
+            return list(symbols)
+        return [s for s in symbols if s.kind != "import"]
+
+    def references(self, name: str) -> list[str]:
+        return sorted(self._files_by_identifier.get(name, set()))
+
+    def file_symbols(self, path: str) -> list[Symbol]:
+        return list(self._by_file.get(path, []))
+
+    def names(self) -> set[str]:
+        """Returns the names of all symbols and identifiers."""
+        return set(self._by_name) | set(self._files_by_identifier)
+
+    def __len__(self):
+        return sum(len(symbols) for symbols in self._by_file.values())
+
+
+def code_names(text: str) -> list[str]:
+    """Finds names in text that are clearly meant as code, e.g. in a question about a project.
+
+    Those are names in backticks, names with an underscore and CamelCase names. Plain words like
+    "start" or "file" can name symbols too, but in a question they're usually just words.
+    """
+    names = []
+    for code in BACKTICKED_PATTERN.findall(text):
+        names.extend(IDENTIFIER_PATTERN.findall(code))
+    for name in IDENTIFIER_PATTERN.findall(text):
+        if "_" in name or CAMEL_CASE_PATTERN.search(name):
+            names.append(name)
+    return list(dict.fromkeys(names))
+
+
+def extract_symbols(path: str, content: str) -> list[Symbol]:
+    suffix = path.rsplit(".", 1)[-1].lower() if "." in path else ""
+
+    if suffix == "py":
+        try:
+            return _python_symbols(path, content)
+        except (SyntaxError, ValueError) as e:
+            logging.info(f"Cannot parse {path}, no symbols extracted: {e}")
+            return []
+    if suffix in ("js", "jsx", "ts", "tsx", "vue"):
+        return _js_symbols(path, content)
+    if suffix == "go":
+        return _go_symbols(path, content)
+    if suffix in ("c", "h", "i"):
+        return _c_symbols(path, content)
+    return []
+
+
+def _python_symbols(path: str, content: str) -> list[Symbol]:
+    tree = ast.parse(content)
+    lines = content.splitlines()
+    symbols = []
+
+    def signature(node: ast.AST) -> str:
+        return lines[node.lineno - 1].strip() if node.lineno <= len(lines) else ""
+
+    def visit(node: ast.AST, in_class: bool):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, ast.ClassDef):
+                symbols.append(Symbol(child.name, "class", path, child.lineno, signature(child)))
+                visit(child, True)
+            elif isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                kind = "method" if in_class else "function"
+                symbols.append(Symbol(child.name, kind, path, child.lineno, signature(child)))
+                visit(child, False)
+            elif isinstance(child, (ast.Import, ast.ImportFrom)):
+                for alias in child.names:
+                    name = alias.asname or alias.name.split(".")[0]
+                    if name != "*":
+                        symbols.append(Symbol(name, "import", path, child.lineno, signature(child)))
+            elif isinstance(child, (ast.Assign, ast.AnnAssign)) and node is tree:
+                targets = child.targets if isinstance(child, ast.Assign) else [child.target]
+                for target in targets:
+                    if isinstance(target, ast.Name):
+                        symbols.append(
+                            Symbol(target.id, "variable", path, child.lineno, signature(child))
+                        )
+            elif not isinstance(child, ast.Lambda):
+                visit(child, in_class and not isinstance(child, ast.stmt))
+
+    visit(tree, False)
+    return symbols
+
+
+def _js_symbols(path: str, content: str) -> list[Symbol]:
+    symbols = []
+    for line_number, line in enumerate(content.splitlines(), 1):
+        import_match = JS_IMPORT.match(line)
+        if import_match:
+            imported = JS_IMPORT_ALIAS.sub(r"\1", import_match.group(1))
+            for name in IDENTIFIER_PATTERN.findall(imported):
+                if name != "type":
+                    symbols.append(Symbol(name, "import", path, line_number, line.strip()))
+            continue
+
+        for kind, pattern in JS_PATTERNS:
+            match = pattern.match(line)
+            if match and match.group(1) not in CONTROL_KEYWORDS:
+                symbols.append(Symbol(match.group(1), kind, path, line_number, line.strip()))
+                break
+    return symbols
+
+
+def _go_symbols(path: str, content: str) -> list[Symbol]:
+    symbols = []
+    in_block = None
+
+    for line_number, line in enumerate(content.splitlines(), 1):
+        stripped = line.strip()
+
+        if in_block is not None:
+            if stripped == ")":
+                in_block = None
+            elif in_block == "import":
+                import_match = GO_IMPORT.match(stripped)
+                if import_match:
+                    name = import_match.group(1) or import_match.group(2).rsplit("/", 1)[-1]
+                    symbols.append(Symbol(name, "import", path, line_number, stripped))
+            else:
+                name_match = IDENTIFIER_PATTERN.match(stripped)
+                if name_match:
+                    kind = "type" if in_block == "type" else "variable"
+                    symbols.append(Symbol(name_match.group(0), kind, path, line_number, stripped))
+            continue
+
+        block_match = re.match(r"^(import|const|var|type)\s*\($", stripped)
+        if block_match:
+            in_block = block_match.group(1)
+            continue
+
+        if stripped.startswith("import "):
+            import_match = GO_IMPORT.match(stripped)
+            if import_match:
+                name = import_match.group(1) or import_match.group(2).rsplit("/", 1)[-1]
+                symbols.append(Symbol(name, "import", path, line_number, stripped))
+            continue
+
+        for kind, pattern in GO_PATTERNS:
+            match = pattern.match(line)
+            if match:
+                symbols.append(Symbol(match.group(1), kind, path, line_number, stripped))
+                break
+    return symbols
+
+
+def _c_symbols(path: str, content: str) -> list[Symbol]:
+    symbols = []
+    for line_number, line in enumerate(content.splitlines(), 1):
+        include_match = C_INCLUDE.match(line)
+        if include_match:
+            name = include_match.group(1)
+            symbols.append(Symbol(name, "import", path, line_number, line.strip()))
+            continue
+
+        for kind, pattern in C_PATTERNS:
+            match = pattern.match(line)
+            if match and match.group(1) not in CONTROL_KEYWORDS:
+                symbols.append(Symbol(match.group(1), kind, path, line_number, line.strip()))
+                break
+    return symbols
@@ -1,21 +1,58 @@
+import json
+import mmap
 import os
+import re
+from collections import OrderedDict
 from pathlib import Path
+from threading import Lock
 
+import numpy as np
+
+from filechat import metrics
 from filechat.config import Config
+from filechat.index import FileIndex, IndexedFile
+from filechat.tree import ProjectTree
+
+INDEX_TOOLS = {"search_code", "grep", "find_symbol"}
+
+SNIPPET_LINES_BEFORE = 3
+SNIPPET_LINES_AFTER = 8
+
+LINE_OFFSETS_CACHE_SIZE = 32
+TOOL_CACHE_SIZE = 256
+READ_RANGE_ARGUMENTS = ("start_line", "end_line", "offset", "length")
+
+MAX_REFERENCES = 20
+MAX_LIST_ENTRIES = 200
+
+TOOL_CACHE_HITS = metrics.counter(
+    "filechat_tool_cache_lookups_total", "Lookups of tool results in the cache", result="hit"
+)
+TOOL_CACHE_MISSES = metrics.counter(
+    "filechat_tool_cache_lookups_total", "Lookups of tool results in the cache", result="miss"
+)
 
 TOOLS = [
     {
         "type": "function",
         "function": {
             "name": "list_directory",
-            "description": "Lists files and directories in a given directory",
+            "description": "Lists files and directories in a given directory, optionally with their subdirectories. Files come with their size in bytes, directories with the number and total size of the files in them. Use a larger depth to see the project layout in one call.",
             "parameters": {
                 "type": "object",
                 "properties": {
                     "path": {
                         "type": "string",
-                        "description": "Path relative to project. Do not explore paths outside the project directory",
-                    }
+                        "description": "Path relative to project root, use '.' for the root. Do not explore paths outside the project directory",
+                    },
+                    "depth": {
+                        "type": "integer",
+                        "description": "How many levels of subdirectories to list (default 1, only the directory itself)",
+                    },
+                    "max_entries": {
+                        "type": "integer",
+                        "description": "Maximum number of entries to return (default 200). Shallower entries are listed first",
+                    },
                 },
             },
         },
@@ -24,46 +61,192 @@ TOOLS = [
         "type": "function",
         "function": {
             "name": "read_file",
-            "description": "Reads the contents of a file inside the project. Returns file name, relative path and file content. Access outside the project is not allowed.",
+            "description": "Reads the contents of a file inside the project. Returns file name, relative path and file content. Access outside the project is not allowed. Large files can be read in windows of lines or bytes; prefer reading only the lines you need when you know them (e.g. from search_code, grep or find_symbol).",
             "parameters": {
                 "type": "object",
                 "properties": {
                     "path": {
                         "type": "string",
                         "description": "Path to the file relative to project root. Do not access files outside the project directory.",
-                    }
+                    },
+                    "start_line": {
+                        "type": "integer",
+                        "description": "First line to read, starting from 1. The response then also contains the returned line range and the total number of lines",
+                    },
+                    "end_line": {
+                        "type": "integer",
+                        "description": "Last line to read (inclusive). Defaults to the end of the file",
+                    },
+                    "offset": {
+                        "type": "integer",
+                        "description": "Byte offset to start reading from, for files without meaningful lines. Can't be combined with start_line/end_line",
+                    },
+                    "length": {
+                        "type": "integer",
+                        "description": "Number of bytes to read from offset",
+                    },
                 },
                 "required": ["path"],
             },
         },
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "search_code",
+            "description": "Searches the indexed project files by meaning and keywords. Returns the best matching files with a snippet of the most relevant lines and their line numbers.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {
+                        "type": "string",
+                        "description": "What you are looking for, in natural language or as keywords",
+                    },
+                    "top_k": {
+                        "type": "integer",
+                        "description": "Maximum number of files to return (default 5)",
+                    },
+                },
+                "required": ["query"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "grep",
+            "description": "Searches the indexed project files for a regular expression. Returns matching lines with their paths and line numbers.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "pattern": {
+                        "type": "string",
+                        "description": "Python regular expression matched against each line",
+                    },
+                    "path": {
+                        "type": "string",
+                        "description": "Only search files under this path relative to project root",
+                    },
+                    "ignore_case": {
+                        "type": "boolean",
+                        "description": "Match case-insensitively",
+                    },
+                    "max_matches": {
+                        "type": "integer",
+                        "description": "Maximum number of matching lines to return (default 50)",
+                    },
+                },
+                "required": ["pattern"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "find_symbol",
+            "description": "Finds where a function, class, type, or variable is defined in the indexed project files. Returns paths, line numbers, kinds and the defining lines of the definitions, and the files that mention the symbol.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "name": {
+                        "type": "string",
+                        "description": "Exact name of the symbol",
+                    }
+                },
+                "required": ["name"],
+            },
+        },
+    },
 ]
 
+TOOL_SECONDS = {
+    tool["function"]["name"]: metrics.histogram(
+        "filechat_tool_seconds", "Running a tool called by the LLM", tool=tool["function"]["name"]
+    )
+    for tool in TOOLS
+}
+# Tools the LLM made up share one series, so they can't add series without limit
+UNKNOWN_TOOL_SECONDS = metrics.histogram(
+    "filechat_tool_seconds", "Running a tool called by the LLM", tool="unknown"
+)
 
-def list_directory(project_path: Path, directory: str, config: Config) -> list[dict]:
-    path = Path(directory).resolve()
 
-    if project_path.resolve() not in list(path.parents) and project_path.resolve() != path:
-        raise ValueError("Looks like you want to access a directory that's not in the project")
+class ToolCache:
+    """Results of tool calls, each valid for as long as the version it was computed for.
 
-    if not path.exists():
-        raise FileNotFoundError("This directory doesn't exist")
+    The version is whatever identifies the state the result depends on, e.g. the hash of the
+    file that was read or the generation of the index that was searched.
+    """
+
+    def __init__(self, max_entries: int = TOOL_CACHE_SIZE):
+        self._max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[object, dict | list]] = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str, version: object) -> dict | list | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                TOOL_CACHE_MISSES.inc()
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            TOOL_CACHE_HITS.inc()
+            return entry[1]
+
+    def put(self, key: str, version: object, result: dict | list):
+        with self._lock:
+            self._entries[key] = (version, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
 
-    if not path.is_dir():
-        raise FileNotFoundError("This path is not a directory")
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
 
-    directory_contents = []
+    @staticmethod
+    def key(tool_name: str, arguments: dict) -> str:
+        normalized = {k: v for k, v in arguments.items() if v is not None}
+        if isinstance(normalized.get("path"), str):
+            normalized["path"] = os.path.normpath(normalized["path"])
+        return tool_name + json.dumps(normalized, sort_keys=True)
 
-    for item in path.iterdir():
-        if item.is_file() and any(item.name.endswith(s) for s in config.allowed_suffixes):
-            directory_contents.append({"name": item.name, "type": "file"})
 
-        if item.is_dir() and all(p not in config.ignored_dirs for p in item.parts):
-            directory_contents.append({"name": item.name, "type": "directory"})
+def list_directory(
+    tree: ProjectTree, directory: str, depth: int = 1, max_entries: int = MAX_LIST_ENTRIES
+) -> dict:
+    project_path = Path(tree.directory()).resolve()
+    path = (project_path / directory).resolve()
+
+    if project_path not in list(path.parents) and project_path != path:
+        raise ValueError("Looks like you want to access a directory that's not in the project")
+
+    if depth < 1 or max_entries < 1:
+        raise ValueError("depth and max_entries must be at least 1")
+
+    return tree.list(os.path.relpath(path, project_path), depth, max_entries)
 
-    return directory_contents
 
-def read_file(project_path: Path, file_path: str, config: Config) -> dict:
+def read_file(
+    project_path: Path,
+    file_path: str,
+    config: Config,
+    start_line: int | None = None,
+    end_line: int | None = None,
+    offset: int | None = None,
+    length: int | None = None,
+) -> dict:
+    """Reads a whole file or a window of its lines or bytes.
+
+    Windows are read from a memory map of the file, lines are located with a cached table of
+    line offsets. Only whole files are subject to `max_file_size_kb`, a window larger than that
+    is cut short and marked as truncated.
+    """
     candidate = Path(file_path)
     if not candidate.is_absolute():
         path = (project_path / candidate).resolve()
@@ -85,12 +268,242 @@ def read_file(project_path: Path, file_path: str, config: Config) -> dict:
     if any(p in config.ignored_dirs for p in path.parts):
         raise FileNotFoundError("File is in an ignored directory")
 
-    file_size = os.path.getsize(path)
-    if file_size > config.max_file_size_kb * 1024:
-        raise ValueError("File is too large to read")
+    relative = os.path.relpath(path, project_path.resolve())
+    result = {"name": path.name, "path": relative}
+    max_bytes = config.max_file_size_kb * 1024
+    line_range = start_line is not None or end_line is not None
+    byte_range = offset is not None or length is not None
 
-    with open(path, "r", encoding="utf-8", errors="replace") as f:
-        content = f.read()
+    if line_range and byte_range:
+        raise ValueError("Read either a range of lines or a range of bytes, not both")
 
-    relative = os.path.relpath(path, project_path.resolve())
-    return {"name": path.name, "path": relative, "content": content}
+    if not line_range and not byte_range:
+        if os.path.getsize(path) > max_bytes:
+            raise ValueError(
+                "File is too large to read at once. Read it in parts using start_line and"
+                " end_line, or offset and length"
+            )
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            result["content"] = f.read()
+        return result
+
+    with open(path, "rb") as f:
+        stat = os.fstat(f.fileno())
+        if stat.st_size == 0:
+            data = memoryview(b"")
+            mapped = None
+        else:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            data = memoryview(mapped)
+
+        try:
+            if line_range:
+                line_starts = _line_offsets(str(path), stat, data)
+                window = _line_window(line_starts, stat.st_size, start_line, end_line, max_bytes)
+            else:
+                window = _byte_window(stat.st_size, offset, length, max_bytes)
+
+            start, end = window.pop("bytes")
+            result["content"] = bytes(data[start:end]).decode("utf-8", errors="replace")
+            result |= window
+        finally:
+            data.release()
+            if mapped is not None:
+                mapped.close()
+
+    return result
+
+
+def run_index_tool(index: FileIndex, name: str, arguments: dict) -> dict | list:
+    if name == "search_code":
+        return search_code(index, arguments["query"], arguments.get("top_k", 5))
+    elif name == "grep":
+        return grep(
+            index,
+            arguments["pattern"],
+            arguments.get("path"),
+            arguments.get("ignore_case", False),
+            arguments.get("max_matches", 50),
+        )
+    elif name == "find_symbol":
+        return find_symbol(index, arguments["name"])
+    raise ValueError(f"Unknown tool '{name}'")
+
+
+def search_code(index: FileIndex, query: str, top_k: int = 5) -> list[dict]:
+    """Combines vector similarity with the share of query terms each file contains."""
+    terms = _query_terms(query)
+    scores: dict[str, float] = {}
+    files: dict[str, IndexedFile] = {}
+
+    query_embedding = index.embed_query(query)
+    for file, similarity in index.query_with_scores(query, top_k * 3, query_embedding):
+        scores[file.path()] = 0.7 * similarity
+        files[file.path()] = file
+
+    if terms:
+        for file in index.search_files(query, query_embedding):
+            content = file.content().lower()
+            coverage = sum(term in content for term in terms) / len(terms)
+            if coverage > 0:
+                scores[file.path()] = scores.get(file.path(), 0) + 0.3 * coverage
+                files[file.path()] = file
+
+    best = sorted(scores, key=lambda p: scores[p], reverse=True)[:top_k]
+    results = []
+    for path in best:
+        start_line, snippet = _snippet(files[path].content(), terms)
+        results.append({
+            "path": path,
+            "score": round(scores[path], 3),
+            "start_line": start_line,
+            "snippet": snippet,
+        })
+    return results
+
+
+def grep(
+    index: FileIndex,
+    pattern: str,
+    path: str | None = None,
+    ignore_case: bool = False,
+    max_matches: int = 50,
+) -> dict:
+    try:
+        regex = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+    except re.error as e:
+        raise ValueError(f"Invalid regular expression: {e}")
+
+    prefix = _normalize_prefix(path)
+    matches = []
+    truncated = False
+
+    for file in sorted(index.files(prefix), key=lambda f: f.path()):
+        for line_number, line in enumerate(file.content().splitlines(), 1):
+            if not regex.search(line):
+                continue
+            if len(matches) >= max_matches:
+                truncated = True
+                break
+            matches.append({"path": file.path(), "line": line_number, "text": line.strip()})
+
+        if truncated:
+            break
+
+    return {"matches": matches, "truncated": truncated}
+
+
+def find_symbol(index: FileIndex, name: str) -> dict:
+    symbols = index.symbols()
+    definitions = [
+        {"path": s.path, "line": s.line, "kind": s.kind, "text": s.signature}
+        for s in symbols.definitions(name)
+    ]
+    references = symbols.references(name)
+    return {
+        "definitions": definitions,
+        "referenced_in": references[:MAX_REFERENCES],
+        "references_truncated": len(references) > MAX_REFERENCES,
+    }
+
+
+def _query_terms(query: str) -> list[str]:
+    return list(dict.fromkeys(t.lower() for t in re.findall(r"\w{3,}", query)))
+
+
+def _snippet(content: str, terms: list[str]) -> tuple[int, str]:
+    lines = content.splitlines()
+    best_line = 0
+    best_score = 0
+
+    for i, line in enumerate(lines):
+        line_lower = line.lower()
+        score = sum(term in line_lower for term in terms)
+        if score > best_score:
+            best_line, best_score = i, score
+
+    start = max(best_line - SNIPPET_LINES_BEFORE, 0)
+    end = min(best_line + SNIPPET_LINES_AFTER + 1, len(lines))
+    snippet = "\n".join(f"{i + 1}: {lines[i]}" for i in range(start, end))
+    return start + 1, snippet
+
+
+def _normalize_prefix(path: str | None) -> str:
+    if not path:
+        return ""
+    prefix = os.path.normpath(path)
+    if prefix in (".", os.sep):
+        return ""
+    if prefix.startswith(".." + os.sep) or prefix == ".." or os.path.isabs(prefix):
+        raise ValueError("Looks like you want to access a directory that's not in the project")
+    return prefix
+
+
+_line_offsets_cache: OrderedDict[str, tuple[int, int, np.ndarray]] = OrderedDict()
+_line_offsets_lock = Lock()
+
+
+def _line_offsets(path: str, stat: os.stat_result, data: memoryview) -> np.ndarray:
+    """Byte offsets at which the lines of a file start, cached by path, mtime and size."""
+    with _line_offsets_lock:
+        cached = _line_offsets_cache.get(path)
+        if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            _line_offsets_cache.move_to_end(path)
+            return cached[2]
+
+    newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord("\n"))
+    line_starts = np.concatenate(([0], newlines + 1))
+    if line_starts[-1] == stat.st_size and len(line_starts) > 1:
+        line_starts = line_starts[:-1]
+
+    with _line_offsets_lock:
+        _line_offsets_cache[path] = (stat.st_mtime_ns, stat.st_size, line_starts)
+        _line_offsets_cache.move_to_end(path)
+        while len(_line_offsets_cache) > LINE_OFFSETS_CACHE_SIZE:
+            _line_offsets_cache.popitem(last=False)
+    return line_starts
+
+
+def _line_window(
+    line_starts: np.ndarray,
+    size: int,
+    start_line: int | None,
+    end_line: int | None,
+    max_bytes: int,
+) -> dict:
+    total_lines = len(line_starts)
+    start_line = 1 if start_line is None else start_line
+    end_line = total_lines if end_line is None else min(end_line, total_lines)
+    if start_line < 1 or start_line > total_lines or end_line < start_line:
+        raise ValueError(f"Invalid line range, the file has {total_lines} lines")
+
+    line_ends = np.append(line_starts[1:], size)
+    start = int(line_starts[start_line - 1])
+    end = int(line_ends[end_line - 1])
+    truncated = end - start > max_bytes
+    if truncated:
+        # Keep as many whole lines as fit, or cut the first line if even that is too long
+        fitting = int(np.searchsorted(line_ends, start + max_bytes, side="right"))
+        end_line = max(fitting, start_line)
+        end = min(int(line_ends[end_line - 1]), start + max_bytes)
+
+    window = {"start_line": start_line, "end_line": end_line, "total_lines": total_lines}
+    if truncated:
+        window["truncated"] = True
+    return window | {"bytes": (start, end)}
+
+
+def _byte_window(size: int, offset: int | None, length: int | None, max_bytes: int) -> dict:
+    offset = offset or 0
+    if offset < 0 or (offset >= size and size > 0) or (length is not None and length < 0):
+        raise ValueError(f"Invalid byte range, the file has {size} bytes")
+
+    end = size if length is None else min(offset + length, size)
+    truncated = end - offset > max_bytes
+    if truncated:
+        end = offset + max_bytes
+
+    window = {"offset": offset, "length": end - offset, "size": size}
+    if truncated:
+        window["truncated"] = True
+    return window | {"bytes": (offset, end)}
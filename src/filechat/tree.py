@@ -0,0 +1,215 @@
+import logging
+import os
+from collections import deque
+from itertools import count
+from threading import RLock
+
+from filechat.config import Config
+
+
+class DirectoryNode:
+    def __init__(self):
+        self.files: dict[str, int] = {}
+        self.directories: set[str] = set()
+        self.total_files = 0
+        self.total_size = 0
+        self.generation = 0
+
+
+class ProjectTree:
+    """In-memory listing of the project's directories and files with allowed suffixes.
+
+    It's filled by the initial scan and kept up to date by the watcher. Every directory keeps the
+    number and total size of the files below it, so listings never touch the filesystem.
+    Paths are relative to the project directory, the project directory itself is `""`.
+
+    Every change to a directory's subtree gives the directory a new generation, which tells
+    caches of its listings whether they are still valid.
+    """
+
+    def __init__(self, directory: str, config: Config):
+        self._directory = os.path.abspath(directory)
+        self._config = config
+        self._lock = RLock()
+        self._nodes: dict[str, DirectoryNode] = {"": DirectoryNode()}
+        self._generations = count(1)
+
+    def directory(self) -> str:
+        return self._directory
+
+    def generation(self, relative_path: str) -> int | None:
+        node = self._nodes.get(_normalize(relative_path))
+        return None if node is None else node.generation
+
+    def totals(self, relative_path: str = "") -> tuple[int, int]:
+        """Returns the number and total size of the files below a directory."""
+        node = self._nodes[_normalize(relative_path)]
+        return node.total_files, node.total_size
+
+    def scan(self, start: str = ""):
+        for root, dirs, files in os.walk(os.path.join(self._directory, start)):
+            dirs[:] = [d for d in dirs if d not in self._config.ignored_dirs]
+            self.add_listing(os.path.relpath(root, self._directory), dirs, files)
+
+    def add_listing(self, relative_path: str, dirs: list[str], files: list[str]):
+        relative_path = _normalize(relative_path)
+        if self.is_ignored_directory(relative_path):
+            return
+
+        with self._lock:
+            self._ensure_directory(relative_path)
+            for d in dirs:
+                if d not in self._config.ignored_dirs:
+                    self._ensure_directory(os.path.join(relative_path, d))
+            for f in files:
+                self.add_file(os.path.join(relative_path, f))
+
+    def add_file(self, relative_path: str) -> bool:
+        relative_path = _normalize(relative_path)
+        parent, name = os.path.split(relative_path)
+        if not self.is_listed(relative_path):
+            return False
+
+        try:
+            size = os.path.getsize(os.path.join(self._directory, relative_path))
+        except OSError:
+            return False
+
+        with self._lock:
+            node = self._ensure_directory(parent)
+            previous_size = node.files.get(name)
+            if previous_size is None:
+                self._update_totals(parent, 1, size)
+            else:
+                self._update_totals(parent, 0, size - previous_size)
+            node.files[name] = size
+        return True
+
+    def remove_file(self, relative_path: str) -> bool:
+        relative_path = _normalize(relative_path)
+        parent, name = os.path.split(relative_path)
+
+        with self._lock:
+            node = self._nodes.get(parent)
+            if node is None or name not in node.files:
+                return False
+            self._update_totals(parent, -1, -node.files.pop(name))
+
+            # The poller reports deleted files, but not the directories that contained them
+            while parent and not os.path.isdir(os.path.join(self._directory, parent)):
+                self.remove_directory(parent)
+                parent = os.path.dirname(parent)
+        return True
+
+    def add_directory(self, relative_path: str):
+        self.scan(_normalize(relative_path))
+
+    def remove_directory(self, relative_path: str):
+        relative_path = _normalize(relative_path)
+        if not relative_path:
+            return
+
+        with self._lock:
+            node = self._nodes.get(relative_path)
+            if node is None:
+                return
+
+            parent, name = os.path.split(relative_path)
+            self._nodes[parent].directories.discard(name)
+            self._update_totals(parent, -node.total_files, -node.total_size)
+            prefix = relative_path + os.sep
+            for path in [p for p in self._nodes if p == relative_path or p.startswith(prefix)]:
+                del self._nodes[path]
+
+    def list(self, relative_path: str, depth: int = 1, max_entries: int = 200) -> dict:
+        """Lists a directory down to `depth` levels, breadth first, up to `max_entries` entries."""
+        relative_path = _normalize(relative_path)
+
+        with self._lock:
+            if relative_path not in self._nodes:
+                if os.path.isfile(os.path.join(self._directory, relative_path)):
+                    raise FileNotFoundError("This path is not a directory")
+                raise FileNotFoundError("This directory doesn't exist")
+
+            root_node = self._nodes[relative_path]
+            listing = {
+                "path": relative_path or ".",
+                "files": root_node.total_files,
+                "size": root_node.total_size,
+                "entries": [],
+            }
+            num_entries = 0
+            truncated = False
+            queue = deque([(relative_path, listing["entries"], 1)])
+
+            while queue and not truncated:
+                path, entries, level = queue.popleft()
+                node = self._nodes[path]
+
+                for name in sorted(node.directories):
+                    if num_entries >= max_entries:
+                        truncated = True
+                        break
+                    child_path = os.path.join(path, name)
+                    child = self._nodes[child_path]
+                    entry = {
+                        "name": name,
+                        "type": "directory",
+                        "files": child.total_files,
+                        "size": child.total_size,
+                    }
+                    if level < depth:
+                        entry["entries"] = []
+                        queue.append((child_path, entry["entries"], level + 1))
+                    entries.append(entry)
+                    num_entries += 1
+
+                for name in sorted(node.files):
+                    if truncated or num_entries >= max_entries:
+                        truncated = True
+                        break
+                    entries.append({"name": name, "type": "file", "size": node.files[name]})
+                    num_entries += 1
+
+        if truncated:
+            logging.info(f"Listing of {listing['path']} truncated at {max_entries} entries")
+            listing["truncated"] = True
+        return listing
+
+    def is_listed(self, relative_path: str) -> bool:
+        name = os.path.basename(relative_path)
+        if not any(name.endswith(s) for s in self._config.allowed_suffixes):
+            return False
+        return not self.is_ignored_directory(os.path.dirname(relative_path))
+
+    def is_ignored_directory(self, relative_path: str) -> bool:
+        parts = _normalize(relative_path).split(os.sep)
+        return any(part in self._config.ignored_dirs for part in parts)
+
+    def _ensure_directory(self, relative_path: str) -> DirectoryNode:
+        node = self._nodes.get(relative_path)
+        if node is not None:
+            return node
+
+        node = self._nodes[relative_path] = DirectoryNode()
+        node.generation = next(self._generations)
+        parent, name = os.path.split(relative_path)
+        self._ensure_directory(parent).directories.add(name)
+        self._update_totals(parent, 0, 0)
+        return node
+
+    def _update_totals(self, relative_path: str, files_delta: int, size_delta: int):
+        generation = next(self._generations)
+        while True:
+            node = self._nodes[relative_path]
+            node.total_files += files_delta
+            node.total_size += size_delta
+            node.generation = generation
+            if not relative_path:
+                break
+            relative_path = os.path.dirname(relative_path)
+
+
+def _normalize(relative_path: str) -> str:
+    relative_path = os.path.normpath(relative_path)
+    return "" if relative_path == "." else relative_path
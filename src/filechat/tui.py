@@ -1,21 +1,43 @@
+import asyncio
 import logging
+import time
+from bisect import bisect_left, bisect_right
+from difflib import SequenceMatcher
+
 from textual import work
 from textual.app import App, ComposeResult
 from textual.containers import Center, Vertical, VerticalScroll
 from textual.screen import ModalScreen
+from rich.table import Table
+from rich.text import Text
+from textual.widget import Widget
+from textual.timer import Timer
+from textual.worker import Worker, WorkerCancelled, WorkerFailed
 from textual.widgets import Input, ListItem, ListView, Static
 
-from filechat.chat import Chat, ChatStore
-from filechat.index import FileIndex
-from filechat.utils import truncate_text
+from filechat import metrics
+from filechat.chat import SEARCH_MATCH_END, SEARCH_MATCH_START, Chat, ChatStore
+from filechat.daemon import RemoteIndex
+from filechat.index import FileIndex, IndexedFile
+from filechat.utils import StartupProfiler, truncate_text
+from filechat.workspace import Workspace
 
 
 class HistoryScreen(ModalScreen):
+    """Lists stored chats. Chats are read from the chat store in workers, off the UI thread."""
+
+    PAGE_SIZE = 50
+    # The next page is loaded when the highlight gets this close to the end of the list
+    LOAD_AHEAD = 10
+    MESSAGE_WINDOW = 50
+
     def __init__(self, chat_store: ChatStore, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._history_view = ListView()
         self._chat_store = chat_store
-        self._chats = self._chat_store.chat_list()
+        self._chats: list[tuple] = []
+        self._has_more = True
+        self._loading_page = False
 
     def compose(self) -> ComposeResult:
         with Vertical():
@@ -24,13 +46,7 @@ class HistoryScreen(ModalScreen):
             yield center
 
     def on_mount(self):
-        for chat in self._chats:
-            chat_item = ListItem(Static(chat[2]), Static(chat[1], classes="timestamp"))
-            self._history_view.append(chat_item)
-
-        if self._chats:
-            self._history_view.index = 0
-            self._history_view.focus()
+        self._load_page()
 
     def key_escape(self):
         self.dismiss()
@@ -51,18 +67,392 @@ class HistoryScreen(ModalScreen):
         selected_index = event.index
         self._close_with_selected_chat(selected_index)
 
-    def _close_with_selected_chat(self, selected_index: int):
+    def on_list_view_highlighted(self, event: ListView.Highlighted):
+        index = self._history_view.index
+        if self._has_more and index is not None and index >= len(self._chats) - self.LOAD_AHEAD:
+            self._load_page()
+
+    def _load_page(self):
+        if not self._loading_page:
+            self._loading_page = True
+            self._append_page()
+
+    @work()
+    async def _append_page(self):
+        first_page = not self._chats
+        after = self._chats[-1] if self._chats else None
+        try:
+            page = await asyncio.to_thread(self._chat_store.chat_list, self.PAGE_SIZE, after)
+        finally:
+            self._loading_page = False
+        self._has_more = len(page) == self.PAGE_SIZE
+        self._chats.extend(page)
+
+        for chat in page:
+            chat_item = ListItem(Static(chat[2]), Static(chat[1], classes="timestamp"))
+            self._history_view.append(chat_item)
+        if first_page and self._chats:
+            self._history_view.index = 0
+            self._history_view.focus()
+
+    @work(group="select", exclusive=True)
+    async def _close_with_selected_chat(self, selected_index: int):
         chat_id = self._chats[selected_index][0]
-        chat = self._chat_store.load(chat_id)
+        chat = await asyncio.to_thread(self._chat_store.load, chat_id, self.MESSAGE_WINDOW)
         self.dismiss(chat)
 
     def _delete_selected_chat(self, selected_index: int):
         chat_id = self._chats.pop(selected_index)[0]
-        self._chat_store.delete(chat_id)
         self._history_view.remove_items([selected_index])
+        self._delete_chat(chat_id)
+
+    @work()
+    async def _delete_chat(self, chat_id: int):
+        await asyncio.to_thread(self._chat_store.delete, chat_id)
+
+
+class SearchScreen(ModalScreen):
+    def __init__(self, chat_store: ChatStore, query: str = "", *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._chat_store = chat_store
+        self._search_input = Input(value=query, placeholder="Search all chats ...")
+        self._results_view = ListView()
+        self._results: list[tuple] = []
+
+    def compose(self) -> ComposeResult:
+        with Vertical():
+            center = Center(self._search_input, self._results_view)
+            center.border_title = "Search (enter to open a chat, escape to close)"
+            yield center
+
+    def on_mount(self):
+        self._search_input.focus()
+        if self._search_input.value:
+            self._search(self._search_input.value)
+
+    def on_input_changed(self, event: Input.Changed):
+        event.stop()
+        self._search(event.value)
+
+    def on_input_submitted(self, event: Input.Submitted):
+        event.stop()
+        if self._results:
+            self._results_view.index = 0
+            self._results_view.focus()
+
+    def on_list_view_selected(self, event: ListView.Selected):
+        chat_id, message_id = self._results[event.index][:2]
+        self.dismiss((chat_id, message_id))
+
+    def key_escape(self):
+        self.dismiss()
+
+    @work(group="search", exclusive=True)
+    async def _search(self, query: str):
+        # A newer search cancels this one, so results of outdated queries are never shown
+        self._results = await asyncio.to_thread(self._chat_store.search, query)
+        self._results_view.clear()
+        for _, message_id, title, snippet in self._results:
+            label = Text(title, style="bold")
+            if message_id < 0:
+                label.append(" (title)", style="dim")
+            self._results_view.append(ListItem(Static(label), Static(highlighted(snippet))))
+
+
+class StatsScreen(ModalScreen):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_view = Static()
+
+    def compose(self) -> ComposeResult:
+        with Vertical():
+            center = Center(VerticalScroll(self._stats_view), id="stats")
+            hint = "'r' to refresh, 's' to save" if metrics.dump_path() else "'r' to refresh"
+            center.border_title = f"Stats ({hint}, escape to close)"
+            yield center
+
+    def on_mount(self):
+        self._refresh_stats()
+
+    def key_escape(self):
+        self.dismiss()
+
+    def key_r(self):
+        self._refresh_stats()
+
+    def key_s(self):
+        path = metrics.dump_path()
+        if path is not None:
+            metrics.dump()
+            self.notify(f"Metrics written to {path}")
+
+    def _refresh_stats(self):
+        if not metrics.enabled():
+            self._stats_view.update("Metrics aren't collected, start FileChat with --metrics")
+            return
+
+        table = Table(expand=True, box=None)
+        table.add_column("Metric")
+        for column in ("Count", "Mean", "p50", "p95", "Max"):
+            table.add_column(column, justify="right")
+        for metric in metrics.REGISTRY.metrics():
+            table.add_row(*format_metric(metric))
+        self._stats_view.update(table)
+
+
+class StreamingResponse(Vertical):
+    """Shows a response while it's being streamed.
+
+    Text is appended, not re-set. Text up to the last paragraph break (or line break, once the
+    paragraph gets long) is frozen in its own `Static`, so only the unfinished tail is re-rendered.
+    """
+
+    DEFAULT_CSS = """
+        StreamingResponse {
+            height: auto;
+            border-top: solid green;
+            border-bottom: solid green;
+        }
+    """
+
+    MAX_TAIL_LENGTH = 2000
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._text = ""
+        self._frozen_length = 0
+        self._tail = Static(markup=False)
+
+    def compose(self) -> ComposeResult:
+        yield self._tail
+
+    def append(self, text: str):
+        self._text += text
+        # Frozen paragraphs keep one of the two newlines to stay separated by a blank line
+        boundary = self._text.rfind("\n\n", self._frozen_length)
+        frozen_end, tail_start = boundary + 1, boundary + 2
+        if boundary < 0 and len(self._text) - self._frozen_length > self.MAX_TAIL_LENGTH:
+            boundary = self._text.rfind("\n", self._frozen_length)
+            frozen_end, tail_start = boundary, boundary + 1
+
+        if boundary > self._frozen_length:
+            frozen = Static(self._text[self._frozen_length : frozen_end], markup=False)
+            self.mount(frozen, before=self._tail)
+            self._frozen_length = tail_start
+        self._tail.update(self._text[self._frozen_length :])
+
+    def set_text(self, text: str):
+        self.remove_children()
+        self._text = text
+        self._frozen_length = 0
+        self._tail = Static(text, markup=False)
+        self.mount(self._tail)
+
+
+class TranscriptEntry:
+    """A block of the transcript: a message, tool results or the files used for a response."""
+
+    def __init__(
+        self,
+        text: str,
+        classes: str,
+        title: str | None = None,
+        subtitle: str | None = None,
+        message_id: int | None = None,
+    ):
+        self.text = text
+        self.classes = classes
+        self.title = title
+        self.subtitle = subtitle
+        self.message_id = message_id
+        # Height at `width`, estimated from the text until the entry is rendered at that width
+        self.height = 0
+        self.width = 0
+
+
+class Transcript(VerticalScroll):
+    """Chat transcript that only mounts the entries near the viewport.
+
+    The entries above and below the mounted window are stood in for by two spacers. Rendered
+    heights are cached per entry, entries not rendered at the current width yet get an estimate.
+    Widgets of entries leaving the window are hidden and reused for entries entering it.
+    Other widgets, like a streamed response, can be mounted after the entries.
+    """
+
+    # Entries this many lines above or below the viewport are mounted too
+    OVERSCAN = 20
+    MAX_SPARE_WIDGETS = 20
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._entries: list[TranscriptEntry] = []
+        self._start = 0
+        self._window: list[Static] = []
+        self._spare: list[Static] = []
+        self._top_spacer = Widget()
+        self._bottom_spacer = Widget()
+        self._top_spacer.styles.height = 0
+        self._bottom_spacer.styles.height = 0
+
+    def compose(self) -> ComposeResult:
+        yield self._top_spacer
+        yield self._bottom_spacer
+
+    def entries(self) -> list[TranscriptEntry]:
+        return list(self._entries)
+
+    def set_entries(self, entries: list[TranscriptEntry]):
+        for widget in self._window:
+            self._release(widget)
+        self._entries = list(entries)
+        self._start = 0
+        self._window = []
+        self._refresh_window()
+
+    def add_entries(self, entries: list[TranscriptEntry]):
+        self._entries.extend(entries)
+        self._refresh_window()
+
+    def prepend_entries(self, entries: list[TranscriptEntry]):
+        """Adds entries to the top, keeping the entries on screen in place."""
+        self._entries[:0] = entries
+        self._start += len(entries)
+        width = self._width()
+        added_height = sum(self._height(entry, width) for entry in entries)
+        self._update_spacers(self._tops())
+        self.call_after_refresh(self._jump, self.scroll_y + added_height)
+
+    def scroll_to_message(self, message_id: int):
+        for i, entry in enumerate(self._entries):
+            if entry.message_id == message_id:
+                self.call_after_refresh(lambda: self._jump(self._tops()[i]))
+                return
+
+    def watch_scroll_y(self, old_value: float, new_value: float):
+        super().watch_scroll_y(old_value, new_value)
+        self._refresh_window()
+
+    def on_resize(self):
+        self._refresh_window()
+
+    def _jump(self, y: float):
+        self.scroll_to(y=y, animate=False, immediate=True)
+        self._refresh_window()
+
+    def _refresh_window(self):
+        width = self._width()
+        if not width:
+            return
+
+        tops = self._tops()
+        top = self.scroll_y - self.OVERSCAN
+        bottom = self.scroll_y + self.size.height + self.OVERSCAN
+        start = max(bisect_right(tops, top) - 1, 0)
+        end = min(max(bisect_left(tops, bottom), start), len(self._entries))
+        if (start, end) == (self._start, self._start + len(self._window)):
+            self._update_spacers(tops)
+            return
+
+        previous = dict(enumerate(self._window, self._start))
+        window = [previous.pop(i, None) for i in range(start, end)]
+        for widget in previous.values():
+            self._release(widget)
+
+        # New widgets go right above the next widget that stays
+        next_widget: Widget = self._bottom_spacer
+        for i in reversed(range(len(window))):
+            widget = window[i]
+            if widget is None:
+                widget = window[i] = self._acquire(self._entries[start + i], next_widget)
+            next_widget = widget
+
+        self._start, self._window = start, window
+        self._update_spacers(tops)
+        self.call_after_refresh(self._measure)
+
+    def _measure(self):
+        width = self._width()
+        tops = self._tops()
+        at_end = self.scroll_y >= self.max_scroll_y
+        shift = 0
+        changed = False
+
+        for i, widget in enumerate(self._window, self._start):
+            if not widget.is_mounted:
+                continue
+            entry = self._entries[i]
+            content_height = widget.get_content_height(self.size, self.app.size, width)
+            height = content_height + widget.styles.gutter.height
+            if height != entry.height:
+                changed = True
+                if tops[i + 1] <= self.scroll_y:
+                    shift += height - entry.height
+                entry.height = height
+
+        if not changed:
+            return
+        self._update_spacers(self._tops())
+        # Entries above the viewport changing their height mustn't move what's on screen
+        if at_end:
+            self.call_after_refresh(self.scroll_end, animate=False)
+        elif shift:
+            self.call_after_refresh(self._jump, self.scroll_y + shift)
+        else:
+            self.call_after_refresh(self._refresh_window)
+
+    def _acquire(self, entry: TranscriptEntry, before: Widget) -> Static:
+        if self._spare:
+            widget = self._spare.pop()
+            widget.set_classes(entry.classes)
+            widget.update(entry.text)
+            widget.display = True
+            self.move_child(widget, before=before)
+        else:
+            widget = Static(entry.text, classes=entry.classes)
+            self.mount(widget, before=before)
+        widget.border_title = entry.title
+        widget.border_subtitle = entry.subtitle
+        return widget
+
+    def _release(self, widget: Static):
+        if len(self._spare) >= self.MAX_SPARE_WIDGETS:
+            widget.remove()
+            return
+        widget.display = False
+        widget.set_classes("")
+        widget.update("")
+        self._spare.append(widget)
+
+    def _update_spacers(self, tops: list[int]):
+        self._top_spacer.styles.height = tops[self._start]
+        self._bottom_spacer.styles.height = tops[-1] - tops[self._start + len(self._window)]
+
+    def _tops(self) -> list[int]:
+        width = self._width()
+        tops = [0]
+        for entry in self._entries:
+            tops.append(tops[-1] + self._height(entry, width))
+        return tops
+
+    def _height(self, entry: TranscriptEntry, width: int) -> int:
+        if entry.width != width:
+            entry.width = width
+            entry.height = estimate_height(entry.text, width)
+        return entry.height
+
+    def _width(self) -> int:
+        return self.scrollable_content_region.width
 
 
 class FilechatApp(App):
+    DRAFT_INTERVAL_S = 1.0
+    # Files for the message being typed are looked up once typing pauses for this long, and
+    # reused if the sent message is at least this similar to the text they were looked up for
+    PREFETCH_DELAY_S = 0.3
+    PREFETCH_MIN_SIMILARITY = 0.9
+    # Streamed text is repainted at most this often
+    FRAME_INTERVAL_S = 1 / 20
+
     CSS = """
         Static {
             padding: 0;
@@ -108,18 +498,36 @@ class FilechatApp(App):
         Static.timestamp {
             color: gray;
         }
+
+        #stats {
+            width: 100;
+            height: 80%;
+        }
     """
 
-    def __init__(self, chat: Chat, index: FileIndex, chat_store: ChatStore):
+    def __init__(
+        self,
+        chat: Chat,
+        index: FileIndex | RemoteIndex | Workspace,
+        chat_store: ChatStore,
+        profiler: StartupProfiler | None = None,
+    ):
         super().__init__()
         self._chat = chat
+        self._profiler = profiler
         self._index = index
         self._chat_store = chat_store
-        self._chat_list = VerticalScroll()
+        self._chat_list = Transcript()
+        self._response_worker: Worker | None = None
+        self._older_messages_worker: Worker | None = None
+        self._stop_requested = False
+        self._prefetch_timer: Timer | None = None
+        self._prefetch: tuple[str, int, Worker] | None = None
         self._user_input = Input(
             placeholder=(
-                "Enter chat message ... (type /exit to quit, /new to start a new chat, or /history"
-                " to revisit previous chats)"
+                "Enter chat message ... (type /exit to quit, /new to start a new chat, /history"
+                " to revisit previous chats, /search to search them, /stats to see where time"
+                " goes, or press Esc to stop a response)"
             )
         )
 
@@ -129,59 +537,174 @@ class FilechatApp(App):
 
         self._user_input.focus()
 
+    def on_mount(self):
+        self.watch(self._chat_list, "scroll_y", self._on_chat_scroll, init=False)
+
+    async def on_unmount(self):
+        await self._chat.aclose()
+
+    def on_ready(self):
+        if self._profiler is not None:
+            self._profiler.mark("first paint")
+            logging.info(self._profiler.report())
+
+    def on_input_changed(self, event: Input.Changed):
+        if event.input is not self._user_input:
+            return
+
+        if self._prefetch_timer is not None:
+            self._prefetch_timer.stop()
+        text = event.value.strip()
+        if text and not text.startswith("/"):
+            self._prefetch_timer = self.set_timer(
+                self.PREFETCH_DELAY_S, lambda: self._start_prefetch(text)
+            )
+
     def on_input_submitted(self, event: Input.Submitted):
+        if event.input is not self._user_input:
+            return
+
+        if self._prefetch_timer is not None:
+            self._prefetch_timer.stop()
         user_message = event.value.strip()
         if user_message == "/exit":
             self.exit()
         elif user_message == "/history":
             self._show_history_modal()
+        elif user_message == "/search" or user_message.startswith("/search "):
+            self._show_search_modal(user_message.removeprefix("/search").strip())
+        elif user_message == "/stats":
+            self.push_screen(StatsScreen())
+        elif user_message == "/stop":
+            self.action_stop()
         elif user_message == "/new":
             self._start_new_chat()
         elif user_message != "":
-            self.send_message(event.value)
+            self._response_worker = self.send_message(event.value)
         self._user_input.value = ""
 
-    @work(thread=True)
-    def send_message(self, message: str | None):
-        self.call_from_thread(self._user_input.set_loading, True)
+    @work()
+    async def send_message(self, message: str | None):
+        self._user_input.set_loading(True)
+        self._stop_requested = False
         next_message = True
+        # The chat's messages must not change while older ones are being loaded into it
+        if self._older_messages_worker is not None:
+            try:
+                await self._older_messages_worker.wait()
+            except (WorkerCancelled, WorkerFailed):
+                pass
 
         while next_message:
             if message:
-                message_widget = Static(message, classes="user")
-                message_widget.border_title = "User"
-                self.call_from_thread(self._chat_list.mount, message_widget)
+                self._chat_list.add_entries([TranscriptEntry(message, "user", "User")])
 
-            output_widget = Static(classes="llm")
-            output_widget.border_title = "Assistant"
-            self.call_from_thread(self._chat_list.mount, output_widget)
+            stream_widget = StreamingResponse()
+            stream_widget.border_title = "Assistant"
+            stream_widget.border_subtitle = "Press Esc to stop"
+            self._chat_list.mount(stream_widget)
 
             if message:
-                files = self._index.query(message)
+                files = await self._retrieve(message)
 
-            output_text = ""
+            if self._stop_requested and message:
+                # Stopped before the message was sent, so it isn't part of the conversation
+                self._finish_response(stream_widget, ChatStore.INTERRUPTED_NOTE.strip(), None)
+                break
 
-            for chunk in self._chat.user_message(message, files):
-                logging.info(chunk)
-                if isinstance(chunk, str):
-                    output_text += chunk
-                    next_message = False
-                elif isinstance(chunk, dict):
-                    output_text = f">>> Tool call: {chunk['name']}\n"
-                    output_text += f">>> Result: {truncate_text(chunk['content'])}"
-                    message = None
-                    next_message = True
-                self.call_from_thread(output_widget.update, output_text)
-                self.call_from_thread(self._chat_list.scroll_end)
-
-            self.call_from_thread(self._chat_store.store, self._chat)
+            output_text = ""
+            response_text = ""
+            pending_text = ""
+            tool_results = []
+            changed = False
+            last_draft = time.monotonic()
+
+            def paint_frame():
+                nonlocal pending_text, changed
+                if not changed:
+                    return
+                if tool_results:
+                    stream_widget.set_text(output_text)
+                elif pending_text:
+                    stream_widget.append(pending_text)
+                pending_text = ""
+                changed = False
+                self._chat_list.scroll_end(animate=False)
+
+            # Painted on a timer, so text isn't held back when the stream pauses
+            frame_timer = self.set_interval(self.FRAME_INTERVAL_S, paint_frame)
+            try:
+                async for chunk in self._chat.user_message_async(message, files):
+                    logging.info(chunk)
+                    if isinstance(chunk, str):
+                        output_text += chunk
+                        response_text += chunk
+                        pending_text += chunk
+                        next_message = False
+                        if time.monotonic() - last_draft > self.DRAFT_INTERVAL_S:
+                            files_used = [f.path() for f in files]
+                            self._chat_store.store_draft(self._chat, response_text, files_used)
+                            last_draft = time.monotonic()
+                    elif isinstance(chunk, dict):
+                        tool_results.append(chunk)
+                        output_text = format_tool_results(tool_results)
+                        pending_text = ""
+                        message = None
+                        next_message = True
+                    changed = True
+            finally:
+                frame_timer.stop()
+
+            if self._stop_requested and not tool_results:
+                output_text = (output_text + ChatStore.INTERRUPTED_NOTE).lstrip()
+
+            usage = self._chat.last_usage
+            subtitle = str(usage) if usage.requests else None
+            self._finish_response(stream_widget, output_text, subtitle)
+
+            self._chat_store.store_async(self._chat)
+            if self._stop_requested:
+                break
 
         files_used = "; ".join(f.path() for f in files)
-        files_widget = Static(files_used, classes="files")
-        files_widget.border_title = "Files"
-        self.call_from_thread(self._chat_list.mount, files_widget)
-        self.call_from_thread(self._chat_list.scroll_end)
-        self.call_from_thread(self._user_input.set_loading, False)
+        self._chat_list.add_entries([TranscriptEntry(files_used, "files", "Files")])
+        self._chat_list.scroll_end()
+        self._user_input.set_loading(False)
+
+    def _start_prefetch(self, text: str):
+        self._prefetch = (text, self._index.generation(), self._query_index(text))
+
+    @work(group="prefetch", exclusive=True)
+    async def _query_index(self, text: str) -> list[IndexedFile]:
+        return await asyncio.to_thread(self._index.query, text)
+
+    async def _retrieve(self, message: str) -> list[IndexedFile]:
+        if self._prefetch is not None:
+            text, generation, worker = self._prefetch
+            self._prefetch = None
+            similarity = SequenceMatcher(None, text, message.strip()).ratio()
+            unchanged = generation == self._index.generation()
+            if similarity >= self.PREFETCH_MIN_SIMILARITY and unchanged:
+                try:
+                    files = await worker.wait()
+                    logging.info(f"Reusing files prefetched for `{text}`")
+                    return files
+                except (WorkerCancelled, WorkerFailed):
+                    pass
+        return await asyncio.to_thread(self._index.query, message)
+
+    def key_escape(self):
+        self.action_stop()
+
+    def action_stop(self):
+        if self._responding():
+            self._stop_requested = True
+            self._chat.cancel()
+
+    def _finish_response(self, stream_widget: StreamingResponse, text: str, subtitle: str | None):
+        stream_widget.remove()
+        self._chat_list.add_entries([TranscriptEntry(text, "llm", "Assistant", subtitle)])
+        self._chat_list.scroll_end(animate=False)
 
     def _show_history_modal(self):
         def handle_history_result(chat: Chat | None):
@@ -191,37 +714,135 @@ class FilechatApp(App):
 
         self.push_screen(HistoryScreen(self._chat_store), callback=handle_history_result)
 
-    def _load_chat(self, chat: Chat):
+    def _show_search_modal(self, query: str):
+        def handle_search_result(result: tuple[int, int] | None):
+            if result:
+                self._open_search_result(*result)
+
+        self.push_screen(SearchScreen(self._chat_store, query), callback=handle_search_result)
+
+    @work(group="open_chat", exclusive=True)
+    async def _open_search_result(self, chat_id: int, message_id: int):
+        window = HistoryScreen.MESSAGE_WINDOW
+        chat = await asyncio.to_thread(self._chat_store.load, chat_id, window)
+        if chat is None:
+            return
+        while chat.first_message_id > max(message_id, 0):
+            await asyncio.to_thread(chat.load_older_messages, window)
+        self._load_chat(chat, message_id)
+
+    def _load_chat(self, chat: Chat, message_id: int | None = None):
+        self._set_chat(chat)
+        self._chat_list.set_entries(message_entries(self._chat.messages, chat.first_message_id))
+
+        if message_id is None:
+            self.call_after_refresh(self._chat_list.scroll_end, animate=False)
+        elif message_id < 0:
+            self._chat_list.scroll_home(animate=False)
+        else:
+            self._chat_list.scroll_to_message(message_id)
+        # Without a scrollbar there's no scrolling up to load older messages
+        self.call_after_refresh(
+            lambda: self._chat_list.max_scroll_y == 0 and self._on_chat_scroll(0)
+        )
+
+    def _on_chat_scroll(self, scroll_y: float):
+        if scroll_y > 0 or not self._chat.has_older_messages or self._responding():
+            return
+        worker = self._older_messages_worker
+        if worker is None or worker.is_finished:
+            self._older_messages_worker = self._load_older_messages(self._chat)
+
+    @work()
+    async def _load_older_messages(self, chat: Chat):
+        older = await asyncio.to_thread(chat.load_older_messages, HistoryScreen.MESSAGE_WINDOW)
+        # Another chat may have been opened in the meantime
+        if chat is self._chat:
+            self._chat_list.prepend_entries(message_entries(older, chat.first_message_id))
+
+    def _responding(self) -> bool:
+        return self._response_worker is not None and not self._response_worker.is_finished
+
+    def _start_new_chat(self):
+        self._set_chat(self._chat_store.new_chat())
+        self._chat_list.set_entries([])
+
+    def _set_chat(self, chat: Chat):
+        # Chats are switched only between responses, so the previous one's client isn't in use
+        if chat is not self._chat:
+            self.run_worker(self._chat.aclose())
         self._chat = chat
-        self._chat_list.remove_children()
 
-        for message in self._chat.messages:
-            if message["role"] == "system":
-                continue
 
-            if "tool_call_id" in message:
-                output_text = f">>> Tool call: {message['name']}\n"
-                output_text += f">>> Result: {truncate_text(message['content'])}"
-                message_widget = Static(output_text, classes="llm")
-                self._chat_list.mount(message_widget)
-                continue
+def message_entries(messages: list[dict], first_message_id: int = 0) -> list[TranscriptEntry]:
+    entries = []
+    tool_results = []
 
-            if not message["content"] or "tool_calls" in message:
-                continue
+    for message_id, message in enumerate(messages, first_message_id):
+        if message["role"] == "system":
+            continue
+
+        if "tool_call_id" in message:
+            tool_results.append(message)
+            continue
 
-            message_widget = Static(
-                message["content"], classes="user" if message["role"] == "user" else "llm"
+        if tool_results:
+            entries.append(TranscriptEntry(format_tool_results(tool_results), "llm"))
+            tool_results = []
+
+        if not message["content"] or "tool_calls" in message:
+            continue
+
+        if message["role"] == "user":
+            entries.append(TranscriptEntry(message["content"], "user", "User", None, message_id))
+        else:
+            entries.append(
+                TranscriptEntry(message["content"], "llm", "Assistant", None, message_id)
             )
-            message_widget.border_title = "User" if message["role"] == "user" else "Assistant"
-            self._chat_list.mount(message_widget)
+            files_used = "; ".join(message.get("files_used", []))
+            entries.append(TranscriptEntry(files_used, "files", "Files"))
 
-            if message["role"] == "assistant":
-                files_widget = Static("; ".join(message["files_used"]), classes="files")
-                files_widget.border_title = "Files"
-                self._chat_list.mount(files_widget)
+    if tool_results:
+        entries.append(TranscriptEntry(format_tool_results(tool_results), "llm"))
 
-        self._chat_list.scroll_end()
+    return entries
 
-    def _start_new_chat(self):
-        self._chat = self._chat_store.new_chat()
-        self._chat_list.remove_children()
+
+def estimate_height(text: str, width: int) -> int:
+    """Height of a bordered `Static` showing `text`, assuming lines wrap at exactly `width`."""
+    width = max(width, 1)
+    lines = sum(max(-(-len(line) // width), 1) for line in text.split("\n"))
+    return lines + 2
+
+
+def highlighted(snippet: str) -> Text:
+    text = Text()
+    for i, part in enumerate(snippet.split(SEARCH_MATCH_START)):
+        match, _, rest = part.partition(SEARCH_MATCH_END) if i else ("", "", part)
+        text.append(match, style="bold reverse")
+        text.append(rest)
+    return text
+
+
+def format_metric(metric: metrics.Counter | metrics.Histogram) -> list[str]:
+    """Formats a metric as a row of the stats table, durations in milliseconds."""
+    name = metric.name.removeprefix("filechat_")
+    if metric.labels:
+        name += " " + ", ".join(f"{k}={v}" for k, v in metric.labels.items())
+    if isinstance(metric, metrics.Counter):
+        return [name, f"{metric.value():.0f}", "", "", "", ""]
+
+    if not metric.count():
+        return [name, "0", "", "", "", ""]
+
+    scale, unit = (1000, " ms") if metric.name.endswith("_seconds") else (1, "")
+    values = [metric.mean(), metric.quantile(0.5), metric.quantile(0.95), metric.max()]
+    return [name, str(metric.count()), *(f"{v * scale:.2f}{unit}" for v in values)]
+
+
+def format_tool_results(tool_results: list[dict]) -> str:
+    lines = []
+    for result in tool_results:
+        lines.append(f">>> Tool call: {result['name']}")
+        lines.append(f">>> Result: {truncate_text(result['content'])}")
+    return "\n".join(lines)
@@ -1,3 +1,19 @@
+import datetime
+import logging
+import os
+import time
+
+# Windows API constants used by process_running
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+STILL_ACTIVE = 259
+
+
+def setup_logging(log_dir: str):
+    os.makedirs(log_dir, exist_ok=True)
+    log_file = os.path.join(log_dir, datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + ".log")
+    logging.basicConfig(level=logging.INFO, handlers=[logging.FileHandler(log_file)])
+
+
 def truncate_text(text: str, max_length: int = 100) -> str:
     words = []
     length_without_spaces = 0
@@ -13,3 +29,55 @@ def truncate_text(text: str, max_length: int = 100) -> str:
     if len(truncated) < len(text):
         truncated += "..."
     return truncated
+
+
+def process_running(pid: int) -> bool:
+    if os.name == "nt":
+        # os.kill would terminate the process on Windows
+        import ctypes
+
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return False
+        exit_code = ctypes.c_ulong()
+        kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+        kernel32.CloseHandle(handle)
+        return exit_code.value == STILL_ACTIVE
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists, it just belongs to another user
+        return True
+    return True
+
+
+class StartupProfiler:
+    """Measures how long each phase of startup takes.
+
+    Every `mark` ends a phase, which started at the previous mark or when the profiler was created.
+    """
+
+    def __init__(self, start: float | None = None):
+        self._start = time.perf_counter() if start is None else start
+        self._last_mark = self._start
+        self._phases: list[tuple[str, float]] = []
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self._phases.append((phase, now - self._last_mark))
+        self._last_mark = now
+
+    def phases(self) -> list[tuple[str, float]]:
+        return list(self._phases)
+
+    def report(self) -> str:
+        width = max([len(phase) for phase, _ in self._phases] + [len("total")])
+        lines = ["Startup profile:"]
+        for phase, duration in self._phases:
+            lines.append(f"  {phase:<{width}}  {duration * 1000:8.1f} ms")
+        lines.append(f"  {'total':<{width}}  {(self._last_mark - self._start) * 1000:8.1f} ms")
+        return "\n".join(lines)
@@ -1,18 +1,46 @@
+import errno
 import logging
 import os
+import threading
+import time
 
-from watchdog.events import FileSystemEvent, FileSystemEventHandler
+from watchdog.events import (
+    FileCreatedEvent,
+    FileDeletedEvent,
+    FileModifiedEvent,
+    FileSystemEvent,
+    FileSystemEventHandler,
+)
 from watchdog.observers import Observer
+from watchdog.observers.api import BaseObserver, ObservedWatch
 
 from filechat.config import Config
-from filechat.index import FileIndex, is_ignored
+from filechat.index import FileIndex, is_ignored, is_ignored_directory, walk_project
+
+NETWORK_FILESYSTEMS = {
+    "nfs",
+    "nfs4",
+    "cifs",
+    "smb3",
+    "smbfs",
+    "9p",
+    "afs",
+    "ceph",
+    "glusterfs",
+    "fuse.sshfs",
+    "fuse.rclone",
+    "davfs",
+}
+
+WATCH_LIMIT_ERRORS = {errno.ENOSPC, errno.EMFILE}
 
 
 class FileChangeHandler(FileSystemEventHandler):
-    def __init__(self, index: FileIndex, config: Config):
+    def __init__(self, index: FileIndex, config: Config, watcher: "FileWatcher | None" = None):
         super().__init__()
         self._index = index
         self._config = config
+        self._watcher = watcher
 
     def on_modified(self, event: FileSystemEvent):
         logging.info(event)
@@ -23,15 +51,21 @@ class FileChangeHandler(FileSystemEventHandler):
     def on_created(self, event: FileSystemEvent):
         logging.info(event)
         if event.is_directory:
+            self._handle_directory_creation(event.src_path)
             return
         self._handle_file_change(event.src_path)
 
     def on_deleted(self, event: FileSystemEvent):
         if event.is_directory:
+            self._handle_directory_deletion(event.src_path)
             return
         self._handle_file_deletion(event.src_path)
 
     def on_moved(self, event: FileSystemEvent):
+        if event.is_directory:
+            self._handle_directory_deletion(event.src_path)
+            self._handle_directory_creation(event.dest_path)
+            return
         self._handle_file_deletion(event.src_path)
         self._handle_file_change(event.dest_path)
 
@@ -41,8 +75,14 @@ class FileChangeHandler(FileSystemEventHandler):
             relative_path = os.path.relpath(file_path, self._index.directory())
             logging.info(f"File changed: {relative_path}")
 
+            tree = self._index.tree()
+            if tree is not None:
+                tree.add_file(relative_path)
+
             if not is_ignored(self._index.directory(), file_path, self._config):
                 self._index.add_file(relative_path)
+            else:
+                self._index.remove_file(relative_path)
         except Exception as e:
             logging.warning(type(e))
             logging.warning(e)
@@ -53,26 +93,336 @@ class FileChangeHandler(FileSystemEventHandler):
             relative_path = os.path.relpath(file_path, self._index.directory())
             logging.info(f"File deleted: {relative_path}")
 
+            tree = self._index.tree()
+            if tree is not None:
+                tree.remove_file(relative_path)
+
             if is_ignored(self._index.directory(), file_path, self._config):
-                self._index.clean_old_files()
+                self._index.remove_file(relative_path)
+        except Exception as e:
+            logging.warning(type(e))
+            logging.warning(e)
+
+    def _handle_directory_creation(self, dir_path: bytes | str):
+        try:
+            dir_path = str(dir_path)
+            if self._watcher is not None:
+                self._watcher.directory_created(dir_path)
+
+            if is_ignored_directory(self._index.directory(), dir_path, self._config):
+                return
+
+            tree = self._index.tree()
+            if tree is not None:
+                tree.add_directory(os.path.relpath(dir_path, self._index.directory()))
+
+            # Files created before the new directory got watched don't produce any events
+            for root, _, files in walk_project(self._index.directory(), self._config, dir_path):
+                for file in files:
+                    self._handle_file_change(os.path.join(root, file))
+        except Exception as e:
+            logging.warning(type(e))
+            logging.warning(e)
+
+    def _handle_directory_deletion(self, dir_path: bytes | str):
+        try:
+            dir_path = str(dir_path)
+            logging.info(f"Directory deleted: {dir_path}")
+            if self._watcher is not None:
+                self._watcher.directory_deleted(dir_path)
+
+            tree = self._index.tree()
+            if tree is not None:
+                tree.remove_directory(os.path.relpath(dir_path, self._index.directory()))
+            self._index.clean_old_files(self._config)
         except Exception as e:
             logging.warning(type(e))
             logging.warning(e)
 
 
+class SnapshotPoller(threading.Thread):
+    """Detects file changes by diffing stat snapshots of the non-ignored project tree.
+
+    Directory listings are cached by the directory's mtime, so an unchanged directory costs one
+    `stat` per relevant file instead of a full `scandir`.
+    """
+
+    # Directories modified this recently are always re-listed, their mtime may not be final yet
+    RACY_WINDOW_NS = 2_000_000_000
+
+    def __init__(self, directory: str, config: Config, handler: FileSystemEventHandler):
+        super().__init__(daemon=True)
+        self._directory = directory
+        self._config = config
+        self._handler = handler
+        self._interval = config.watch_poll_interval_s
+        self._stopped = threading.Event()
+        self._files: dict[str, tuple[int, int]] = {}
+        self._listings: dict[str, tuple[int, list[str], list[str]]] = {}
+
+    def run(self):
+        self._files = self._take_snapshot()
+        while not self._stopped.wait(self._interval):
+            try:
+                self.poll()
+            except Exception as e:
+                logging.warning(type(e))
+                logging.warning(e)
+
+    def stop(self):
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+
+    def poll(self):
+        snapshot = self._take_snapshot()
+
+        for path, stat in snapshot.items():
+            previous = self._files.get(path)
+            if previous is None:
+                self._handler.dispatch(FileCreatedEvent(path))
+            elif previous != stat:
+                self._handler.dispatch(FileModifiedEvent(path))
+
+        for path in self._files.keys() - snapshot.keys():
+            self._handler.dispatch(FileDeletedEvent(path))
+
+        self._files = snapshot
+
+    def _take_snapshot(self) -> dict[str, tuple[int, int]]:
+        snapshot = {}
+        listings = {}
+        now = time.time_ns()
+        stack = [self._directory]
+
+        while stack:
+            path = stack.pop()
+            try:
+                dir_mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+
+            cached = self._listings.get(path)
+            if cached and cached[0] == dir_mtime and now - dir_mtime > self.RACY_WINDOW_NS:
+                _, files, subdirs = cached
+            else:
+                files, subdirs = self._list_directory(path)
+
+            listings[path] = (dir_mtime, files, subdirs)
+            stack.extend(subdirs)
+
+            for file in files:
+                try:
+                    stat = os.stat(file)
+                except OSError:
+                    continue
+                snapshot[file] = (stat.st_mtime_ns, stat.st_size)
+
+        self._listings = listings
+        return snapshot
+
+    def _list_directory(self, path: str) -> tuple[list[str], list[str]]:
+        files = []
+        subdirs = []
+
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name not in self._config.ignored_dirs:
+                            subdirs.append(entry.path)
+                    elif any(entry.name.endswith(s) for s in self._config.allowed_suffixes):
+                        files.append(entry.path)
+        except OSError:
+            pass
+
+        return files, subdirs
+
+
 class FileWatcher:
     def __init__(self, index: FileIndex, config: Config):
         self._index = index
         self._config = config
-        self._observer = Observer()
+        self._handler = FileChangeHandler(index, config, self)
+        self._observer: BaseObserver | None = None
+        self._poller: SnapshotPoller | None = None
+        self._watches: dict[str, ObservedWatch] = {}
+        self._watch_lock = threading.RLock()
 
     def start(self):
-        event_handler = FileChangeHandler(self._index, self._config)
-        self._observer.schedule(event_handler, self._index.directory(), recursive=True)
-        self._observer.start()
-        logging.info(f"Started watching directory: {self._index.directory()}")
+        directory = self._index.directory()
+        mode = self._config.watch_mode
+
+        if mode == "auto" and is_network_filesystem(directory):
+            logging.info(f"{directory} is on a network filesystem, falling back to polling")
+            mode = "polling"
+
+        if mode != "polling":
+            try:
+                self._start_observer()
+                num_watches = len(self._watches)
+                logging.info(f"Started watching directory: {directory} ({num_watches} watches)")
+                return
+            except OSError as e:
+                if mode == "native" or e.errno not in WATCH_LIMIT_ERRORS:
+                    raise
+                logging.warning(f"Cannot watch {directory} ({e}), falling back to polling")
+
+        self._start_poller()
 
     def stop(self):
+        with self._watch_lock:
+            self._stop_observer()
+            if self._poller is not None:
+                self._poller.stop()
+                self._poller = None
+        logging.info(f"Stopped watching directory: {self._index.directory()}")
+
+    def directory_created(self, path: str):
+        with self._watch_lock:
+            if self._observer is None:
+                return
+
+            root = self._covering_watch(path)
+            if root is None:
+                return
+
+            try:
+                if self._watches[root].is_recursive:
+                    # Recursive watches are only placed on trees without ignored directories
+                    if is_ignored_directory(self._index.directory(), path, self._config):
+                        self._replan(root)
+                elif root == os.path.dirname(path):
+                    if not is_ignored_directory(self._index.directory(), path, self._config):
+                        for watch_path, recursive in plan_watches(path, self._config):
+                            self._schedule(watch_path, recursive)
+            except OSError as e:
+                if e.errno not in WATCH_LIMIT_ERRORS:
+                    raise
+                logging.warning(f"Watch limit reached ({e}), falling back to polling")
+                threading.Thread(target=self._fall_back_to_polling, daemon=True).start()
+
+    def directory_deleted(self, path: str):
+        with self._watch_lock:
+            for watch_path in list(self._watches):
+                if watch_path == path or watch_path.startswith(path + os.sep):
+                    self._unschedule(watch_path)
+
+    def _start_observer(self):
+        self._observer = Observer()
+        self._observer.start()
+
+        try:
+            with self._watch_lock:
+                for path, recursive in plan_watches(self._index.directory(), self._config):
+                    self._schedule(path, recursive)
+        except OSError:
+            self._stop_observer()
+            raise
+
+    def _stop_observer(self):
+        if self._observer is None:
+            return
         self._observer.stop()
         self._observer.join()
-        logging.info(f"Stopped watching directory: {self._index.directory()}")
+        self._observer = None
+        self._watches = {}
+
+    def _start_poller(self):
+        self._poller = SnapshotPoller(self._index.directory(), self._config, self._handler)
+        self._poller.start()
+        logging.info(f"Started polling directory: {self._index.directory()}")
+
+    def _fall_back_to_polling(self):
+        with self._watch_lock:
+            if self._observer is None:
+                return
+            self._stop_observer()
+            self._start_poller()
+
+    def _schedule(self, path: str, recursive: bool):
+        assert self._observer is not None
+        self._watches[path] = self._observer.schedule(self._handler, path, recursive=recursive)
+
+    def _unschedule(self, path: str):
+        watch = self._watches.pop(path)
+        try:
+            assert self._observer is not None
+            self._observer.unschedule(watch)
+        except (KeyError, OSError) as e:
+            logging.warning(f"Failed to remove watch for {path}: {e}")
+
+    def _covering_watch(self, path: str) -> str | None:
+        directory = self._index.directory()
+        current = os.path.dirname(path)
+        while True:
+            if current in self._watches:
+                return current
+            if current == directory or os.path.dirname(current) == current:
+                return None
+            current = os.path.dirname(current)
+
+    def _replan(self, root: str):
+        self._unschedule(root)
+        for watch_path, recursive in plan_watches(root, self._config):
+            self._schedule(watch_path, recursive)
+
+
+def plan_watches(start: str, config: Config) -> list[tuple[str, bool]]:
+    """Covers the non-ignored part of a tree with as few watches as possible.
+
+    A directory gets a recursive watch if there is no ignored directory anywhere below it.
+    Otherwise it's watched non-recursively and planning continues with its children.
+    """
+    clean: dict[str, bool] = {}
+    children: dict[str, list[str]] = {}
+    order = []
+
+    for root, dirs, _ in os.walk(start):
+        kept = [d for d in dirs if d not in config.ignored_dirs]
+        clean[root] = len(kept) == len(dirs)
+        children[root] = [os.path.join(root, d) for d in kept]
+        dirs[:] = kept
+        order.append(root)
+
+    if not order:
+        return []
+
+    for root in reversed(order):
+        clean[root] = clean[root] and all(clean[c] for c in children[root])
+
+    watches = []
+    stack = [start]
+    while stack:
+        path = stack.pop()
+        watches.append((path, clean[path]))
+        if not clean[path]:
+            stack.extend(children[path])
+
+    return watches
+
+
+def is_network_filesystem(path: str) -> bool:
+    try:
+        with open("/proc/self/mounts") as f:
+            mounts = f.read().splitlines()
+    except OSError:
+        return False
+
+    path = os.path.realpath(path)
+    best_mount_point, fs_type = "", ""
+
+    for line in mounts:
+        parts = line.split()
+        if len(parts) < 3:
+            continue
+
+        mount_point = parts[1].replace("\\040", " ")
+        prefix = mount_point.rstrip("/") + "/"
+        if path != mount_point and not path.startswith(prefix):
+            continue
+
+        if len(mount_point) > len(best_mount_point):
+            best_mount_point, fs_type = mount_point, parts[2]
+
+    return fs_type in NETWORK_FILESYSTEMS
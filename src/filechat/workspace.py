@@ -0,0 +1,229 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import Lock
+from typing import TYPE_CHECKING
+
+from filechat import tools
+from filechat.config import Config
+from filechat.daemon import RemoteIndex
+from filechat.index import QUERY_SECONDS, FileIndex, IndexedFile, load_index, update_index
+from filechat.tree import ProjectTree
+
+if TYPE_CHECKING:
+    from filechat.embedder import Embedder
+
+
+class Workspace:
+    """Several project roots, searched and browsed as one project.
+
+    Every root keeps its own index. Paths in the workspace start with the name of the root, which
+    is the name of its directory, with a number appended if several roots share a name.
+
+    Queries and index tools run on all roots in parallel. Local indexes share one embedder, so a
+    query is embedded once and the similarities of all roots are on the same scale. That's why
+    merged results are rescaled to the range of all of them together. Rescaling every root on its
+    own would rank the best match of an unrelated root as high as the best match overall.
+    """
+
+    def __init__(self, indexes: list[FileIndex | RemoteIndex], config: Config):
+        self._roots: dict[str, FileIndex | RemoteIndex] = {}
+        for index in indexes:
+            base_name = name = os.path.basename(index.directory())
+            suffix = 2
+            while name in self._roots:
+                name = f"{base_name}-{suffix}"
+                suffix += 1
+            self._roots[name] = index
+
+        self._config = config
+        self._scanned_trees: dict[str, tuple[int, ProjectTree]] = {}
+        self._trees_lock = Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=len(self._roots), thread_name_prefix="workspace"
+        )
+
+    def roots(self) -> dict[str, str]:
+        """Maps names of the roots to their directories."""
+        return {name: index.directory() for name, index in self._roots.items()}
+
+    def directory(self) -> str:
+        """Identifies the workspace, e.g. to keep its chats apart from those of its roots."""
+        return os.pathsep.join(index.directory() for index in self._roots.values())
+
+    def resolve(self, path: str) -> tuple[str, FileIndex | RemoteIndex, str]:
+        """Splits a workspace path into the root's name, the root's index and the path in it."""
+        parts = os.path.normpath(path).split(os.sep, 1)
+        if os.path.isabs(path) or parts[0] not in self._roots:
+            raise FileNotFoundError(
+                f"Paths must start with one of the workspace roots: {', '.join(self._roots)}"
+            )
+        return parts[0], self._roots[parts[0]], parts[1] if len(parts) > 1 else "."
+
+    def query(self, query: str, top_k: int = 10) -> list[IndexedFile]:
+        with QUERY_SECONDS.time():
+            return [f for f, _ in self.query_with_scores(query, top_k)]
+
+    def query_with_scores(self, query: str, top_k: int = 10) -> list[tuple[IndexedFile, float]]:
+        local_indexes = [i for i in self._roots.values() if isinstance(i, FileIndex)]
+        query_embedding = local_indexes[0].embed_query(query) if local_indexes else None
+
+        def query_root(name: str, index: FileIndex | RemoteIndex):
+            if isinstance(index, FileIndex):
+                hits = index.query_with_scores(query, top_k, query_embedding)
+            else:
+                hits = index.query_with_scores(query, top_k)
+            return [(_in_root(name, f), score) for f, score in hits]
+
+        root_hits = self._executor.map(query_root, self._roots.keys(), self._roots.values())
+        hits = [hit for hits_of_root in root_hits for hit in hits_of_root]
+        if not hits:
+            return []
+
+        low = min(score for _, score in hits)
+        score_range = max(score for _, score in hits) - low or 1.0
+        hits.sort(key=lambda hit: hit[1], reverse=True)
+        return [(f, (score - low) / score_range) for f, score in hits[:top_k]]
+
+    def file(self, path: str) -> IndexedFile | None:
+        try:
+            name, index, relative_path = self.resolve(path)
+        except FileNotFoundError:
+            return None
+        indexed_file = index.file(relative_path)
+        return None if indexed_file is None else _in_root(name, indexed_file)
+
+    def generation(self) -> int:
+        return sum(index.generation() for index in self._roots.values())
+
+    def tree(self) -> None:
+        # Listings go through `list_directory`, which knows about the roots
+        return None
+
+    def list_directory(
+        self, path: str, depth: int = 1, max_entries: int = tools.MAX_LIST_ENTRIES
+    ) -> dict:
+        if os.path.normpath(path) != ".":
+            name, _, relative_path = self.resolve(path)
+            listing = tools.list_directory(self._tree(name), relative_path, depth, max_entries)
+            listing["path"] = os.path.normpath(os.path.join(name, listing["path"]))
+            return listing
+
+        listing = {"path": ".", "files": 0, "size": 0, "entries": []}
+        for name in self._roots:
+            files, size = self._tree(name).totals()
+            entry = {"name": name, "type": "directory", "files": files, "size": size}
+            if depth > 1:
+                root_max_entries = max(1, max_entries // len(self._roots))
+                root_listing = tools.list_directory(
+                    self._tree(name), ".", depth - 1, root_max_entries
+                )
+                entry["entries"] = root_listing["entries"]
+            listing["files"] += files
+            listing["size"] += size
+            listing["entries"].append(entry)
+        return listing
+
+    def directory_generation(self, path: str) -> object:
+        """Identifies the state of a directory's listing, like `ProjectTree.generation`.
+
+        Generations are counted by each tree, so the tree is part of the state too, in case a root
+        gets a new one.
+        """
+        if os.path.normpath(path) == ".":
+            trees = [self._tree(name) for name in self._roots]
+            return tuple((id(tree), tree.generation("")) for tree in trees)
+        name, _, relative_path = self.resolve(path)
+        tree = self._tree(name)
+        return name, id(tree), tree.generation(relative_path)
+
+    def read_file(self, path: str, **window) -> dict:
+        name, index, relative_path = self.resolve(path)
+        result = tools.read_file(Path(index.directory()), relative_path, self._config, **window)
+        result["path"] = os.path.join(name, result["path"])
+        return result
+
+    def run_index_tool(self, name: str, arguments: dict) -> dict | list:
+        roots = self._roots
+        path = arguments.get("path")
+        if name == "grep" and path and os.path.normpath(path) != ".":
+            root, index, relative_path = self.resolve(path)
+            roots = {root: index}
+            arguments = arguments | {"path": relative_path}
+
+        def run_on_root(index: FileIndex | RemoteIndex):
+            if isinstance(index, RemoteIndex):
+                return index.run_index_tool(name, arguments)
+            return tools.run_index_tool(index, name, arguments)
+
+        results = dict(zip(roots, self._executor.map(run_on_root, roots.values())))
+
+        if name == "search_code":
+            hits = [
+                hit | {"path": os.path.join(root, hit["path"])}
+                for root, result in results.items()
+                for hit in result
+            ]
+            hits.sort(key=lambda hit: hit["score"], reverse=True)
+            return hits[: arguments.get("top_k", 5)]
+        elif name == "grep":
+            max_matches = arguments.get("max_matches", 50)
+            matches = [
+                match | {"path": os.path.join(root, match["path"])}
+                for root, result in results.items()
+                for match in result["matches"]
+            ]
+            truncated = len(matches) > max_matches or any(r["truncated"] for r in results.values())
+            return {"matches": matches[:max_matches], "truncated": truncated}
+        else:
+            definitions = [
+                definition | {"path": os.path.join(root, definition["path"])}
+                for root, result in results.items()
+                for definition in result["definitions"]
+            ]
+            references = [
+                os.path.join(root, path)
+                for root, result in results.items()
+                for path in result["referenced_in"]
+            ]
+            truncated = len(references) > tools.MAX_REFERENCES or any(
+                r["references_truncated"] for r in results.values()
+            )
+            return {
+                "definitions": definitions,
+                "referenced_in": references[: tools.MAX_REFERENCES],
+                "references_truncated": truncated,
+            }
+
+    def _tree(self, name: str) -> ProjectTree:
+        # Local roots have a tree kept up to date by the watcher, which is replaced when the index
+        # is updated, so it's never cached here
+        index = self._roots[name]
+        tree = index.tree()
+        if tree is not None:
+            return tree
+
+        # Roots kept by the daemon have no tree here, they're scanned again when their index changes
+        generation = index.generation()
+        with self._trees_lock:
+            scanned = self._scanned_trees.get(name)
+            if scanned is None or scanned[0] != generation:
+                tree = ProjectTree(index.directory(), self._config)
+                tree.scan()
+                scanned = self._scanned_trees[name] = (generation, tree)
+            return scanned[1]
+
+
+def get_workspace(
+    directories: list[str], config: Config, embedder: "Embedder", rebuild: bool = False
+) -> tuple[Workspace, int]:
+    """Like `get_index`, for several directories sharing one embedder."""
+    indexes = [load_index(d, config, embedder, rebuild) for d in directories]
+    num_indexed = sum(update_index(index, config) for index in indexes)
+    return Workspace(indexes, config), num_indexed
+
+
+def _in_root(name: str, indexed_file: IndexedFile) -> IndexedFile:
+    return IndexedFile.from_content(
+        os.path.join(name, indexed_file.path()), indexed_file.content(), indexed_file.hash()
+    )
@@ -1,12 +1,17 @@
 import os
 import sqlite3
+import subprocess
+import sys
+import threading
 
+import pytest
 from mistralai import Mistral
 from openai import OpenAI
 
 from filechat.chat import Chat, ChatStore
 from filechat.config import Config
-from filechat.index import IndexedFile
+from filechat.embedder import Embedder
+from filechat.index import IndexedFile, get_index
 
 
 def test_chat_store_creation(test_directory: str, config: Config, client: OpenAI | Mistral):
@@ -17,7 +22,55 @@ def test_chat_store_creation(test_directory: str, config: Config, client: OpenAI
     cursor = conn.cursor()
     cursor.execute("SELECT version FROM version")
     version = cursor.fetchone()
-    assert version[0] == 1
+    assert version[0] == ChatStore.VERSION_LATEST
+
+    cursor.execute("PRAGMA journal_mode")
+    assert cursor.fetchone()[0] == "wal"
+
+
+def test_chat_store_migration(test_directory: str, config: Config, client: OpenAI | Mistral):
+    file_path = ChatStore(test_directory, config, client)._file_path
+    os.remove(file_path)
+
+    # Version 1 database with one chat and an orphaned message of a deleted one
+    conn = sqlite3.connect(file_path)
+    conn.executescript("""
+        CREATE TABLE version (version INTEGER);
+        INSERT INTO version (version) VALUES (1);
+        CREATE TABLE chats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            title TEXT
+        );
+        CREATE TABLE messages (
+            id INTEGER,
+            chat_id INTEGER,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            files_used TEXT,
+            FOREIGN KEY (chat_id) REFERENCES chats(id) ON DELETE CASCADE
+        );
+        INSERT INTO chats (title) VALUES ('Old chat');
+        INSERT INTO messages VALUES (0, 1, 'system', 'System', NULL);
+        INSERT INTO messages VALUES (1, 1, 'user', 'Hello', NULL);
+        INSERT INTO messages VALUES (2, 1, 'assistant', 'Hi', '["test.md"]');
+        INSERT INTO messages VALUES (0, 2, 'user', 'Orphaned', NULL);
+    """)
+    conn.close()
+
+    chat_store = ChatStore(test_directory, config, client)
+    assert chat_store.version() == ChatStore.VERSION_LATEST
+
+    chat = chat_store.load(1)
+    assert chat is not None
+    assert chat.messages[1:] == [
+        {"role": "user", "content": "Hello"},
+        {"role": "assistant", "content": "Hi", "files_used": ["test.md"]},
+    ]
+
+    assert chat_store.delete(1) == 1
+    conn = sqlite3.connect(file_path)
+    assert conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0] == 0
 
 
 def test_chat_store(test_directory: str, config: Config, client: OpenAI | Mistral):
@@ -76,3 +129,232 @@ def test_load_existing(test_directory: str, config: Config, client: OpenAI | Mis
 
     for _ in chat.user_message("Thank you", []):
         pass
+
+
+def test_tool_cache(test_directory: str, config: Config, client: OpenAI | Mistral):
+    embedder = Embedder(
+        config.embedding_model, config.embedding_model_path, config.embedding_model_url
+    )
+    index, _ = get_index(test_directory, config, embedder)
+    chat = Chat(client, config.model.model, config, test_directory, index=index)
+
+    first = chat._call_tool("read_file", '{"path": "test.md"}')
+    second = chat._call_tool("read_file", '{"path": "./test.md"}')
+    assert first == second == {
+        "name": "test.md",
+        "path": "test.md",
+        "content": "This is the content of test.md",
+    }
+    assert (chat.tool_cache.hits, chat.tool_cache.misses) == (1, 1)
+
+    chat._call_tool("grep", '{"pattern": "content"}')
+    chat._call_tool("list_directory", '{"path": "."}')
+    with open(os.path.join(test_directory, "test.md"), "w") as f:
+        f.write("Changed content")
+    index.add_file("test.md")
+    index.tree().add_file("test.md")
+
+    result = chat._call_tool("read_file", '{"path": "test.md"}')
+    assert isinstance(result, dict) and result["content"] == "Changed content"
+    chat._call_tool("grep", '{"pattern": "content"}')
+    listing = chat._call_tool("list_directory", '{"path": "."}')
+    assert isinstance(listing, dict)
+    assert {"name": "test.md", "type": "file", "size": 15} in listing["entries"]
+    assert chat.tool_cache.hits == 1
+
+
+def test_draft_recovery(test_directory: str, config: Config, client: OpenAI | Mistral):
+    chat_store = ChatStore(test_directory, config, client)
+    chat = chat_store.new_chat()
+    chat.messages.append({"role": "user", "content": "Explain the project"})
+    chat_store.store_draft(chat, "The project is", ["test.md"]).result()
+    chat_store.close()
+
+    # The draft is left by a process that isn't running anymore
+    exited_process = subprocess.run(
+        [sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True, text=True
+    )
+    with sqlite3.connect(chat_store._file_path) as conn:
+        conn.execute("UPDATE drafts SET pid = ?", (int(exited_process.stdout),))
+    conn.close()
+
+    chat_store = ChatStore(test_directory, config, client)
+    assert chat.chat_id is not None
+    chat_loaded = chat_store.load(chat.chat_id)
+    assert chat_loaded is not None
+    assert chat_loaded.messages[-1] == {
+        "role": "assistant",
+        "content": "The project is" + ChatStore.INTERRUPTED_NOTE,
+        "files_used": ["test.md"],
+    }
+
+    chat_loaded.messages.append({"role": "user", "content": "Go on"})
+    chat_store.store_draft(chat_loaded, "It's a", []).result()
+    chat_store.store(chat_loaded)
+    chat_store.close()
+
+    chat_store = ChatStore(test_directory, config, client)
+    chat_loaded = chat_store.load(chat.chat_id)
+    assert chat_loaded is not None
+    assert chat_loaded.messages[-1] == {"role": "user", "content": "Go on"}
+
+
+def test_draft_of_running_session(test_directory: str, config: Config, client: OpenAI | Mistral):
+    chat_store = ChatStore(test_directory, config, client)
+    chat = chat_store.new_chat()
+    chat.messages.append({"role": "user", "content": "Explain the project"})
+    chat_store.store_draft(chat, "The project is", []).result()
+
+    # E.g. `filechat ask` run while the chat UI is streaming a response
+    other_store = ChatStore(test_directory, config, client)
+    assert chat.chat_id is not None
+    other_chat = other_store.load(chat.chat_id)
+    assert other_chat is not None
+    assert other_chat.messages[-1] == {"role": "user", "content": "Explain the project"}
+    other_store.close()
+
+    chat.messages.append({"role": "assistant", "content": "The project is a chat"})
+    chat_store.store(chat)
+    chat_store.close()
+
+    chat_store = ChatStore(test_directory, config, client)
+    chat_loaded = chat_store.load(chat.chat_id)
+    assert chat_loaded is not None
+    assert chat_loaded.messages[-1] == {"role": "assistant", "content": "The project is a chat"}
+    chat_store.close()
+
+
+def test_cancel(test_directory: str, config: Config, client: OpenAI | Mistral):
+    chat = Chat(client, config.model.model, config, test_directory)
+    chunks = []
+    for chunk in chat.user_message("Count from 1 to 100, one number per line", [], False):
+        chunks.append(chunk)
+        chat.cancel()
+
+    assert len(chunks) == 1
+    assert chat.cancelled
+    assert chat.messages[-1]["content"] == chunks[0] + ChatStore.INTERRUPTED_NOTE
+    assert list(chat.user_message(None, [])) == []
+
+
+@pytest.mark.asyncio
+async def test_cancel_async(test_directory: str, config: Config, client: OpenAI | Mistral):
+    chat = Chat(client, config.model.model, config, test_directory)
+    chunks = []
+    async for chunk in chat.user_message_async("Count from 1 to 100, one per line", [], False):
+        chunks.append(chunk)
+        chat.cancel()
+
+    assert len(chunks) == 1
+    assert chat.messages[-1]["content"] == chunks[0] + ChatStore.INTERRUPTED_NOTE
+
+    chunks = [c async for c in chat.user_message_async("Just say hi", [], False)]
+    assert chunks
+    assert chat.messages[-1]["content"] == "".join(chunks)
+
+
+def test_paginated_history(test_directory: str, config: Config, client: OpenAI | Mistral):
+    chat_store = ChatStore(test_directory, config, client)
+    for i in range(5):
+        chat = chat_store.new_chat()
+        for j in range(3):
+            chat.messages.append({"role": "user", "content": f"Question {i}.{j}"})
+            chat.messages.append({"role": "assistant", "content": "Answer", "files_used": []})
+        chat_store.store(chat)
+
+    first_page = chat_store.chat_list(2)
+    second_page = chat_store.chat_list(2, first_page[-1])
+    last_page = chat_store.chat_list(2, second_page[-1])
+    assert [c[0] for c in first_page + second_page + last_page] == [5, 4, 3, 2, 1]
+
+    chat = chat_store.load(5, limit=3)
+    assert chat is not None
+    assert chat.first_message_id == 4
+    assert [m["content"] for m in chat.messages] == ["Answer", "Question 4.2", "Answer"]
+
+    older = chat.load_older_messages(2)
+    assert [m["content"] for m in older] == ["Answer", "Question 4.1"]
+    chat.load_older_messages()
+    assert not chat.has_older_messages
+    assert len(chat.messages) == 7
+
+    chat = chat_store.load(5, limit=2)
+    assert chat is not None
+    chat.messages.append({"role": "user", "content": "Question 4.3"})
+    chat_store.store(chat)
+    chat = chat_store.load(5)
+    assert chat is not None
+    assert [m["content"] for m in chat.messages[-2:]] == ["Answer", "Question 4.3"]
+
+
+def test_message_in_windowed_chat(test_directory: str, config: Config, client: OpenAI | Mistral):
+    chat_store = ChatStore(test_directory, config, client)
+    chat = chat_store.new_chat()
+    for i in range(3):
+        chat.messages.append({"role": "user", "content": f"Remember the number {i}"})
+        chat.messages.append({"role": "assistant", "content": "OK", "files_used": []})
+    chat_store.store(chat)
+
+    chat = chat_store.load(chat.chat_id, limit=2)
+    assert chat is not None
+    assert list(chat.user_message("Just say hi", [], False))
+
+    # The model got the whole conversation, the window still starts where it did
+    assert chat.first_message_id == 5
+    assert chat.has_older_messages
+    older = chat.load_older_messages(2)
+    assert [m["content"] for m in older] == ["Remember the number 1", "OK"]
+    assert len(chat.load_older_messages()) == 3
+    assert not chat.has_older_messages
+    assert chat.messages[1]["content"] == "Remember the number 0"
+    chat_store.close()
+
+
+def test_search(test_directory: str, config: Config, client: OpenAI | Mistral):
+    chat_store = ChatStore(test_directory, config, client)
+    chat = chat_store.new_chat()
+    chat.messages.append({"role": "user", "content": "How do I configure the watcher?"})
+    chat.messages.append({
+        "role": "assistant",
+        "content": "Set watch_mode to polling on network filesystems.",
+        "files_used": [],
+    })
+    chat_store.store(chat)
+
+    other_chat = chat_store.new_chat()
+    other_chat.messages.append({"role": "user", "content": "What does the embedder do?"})
+    chat_store.store(other_chat)
+
+    results = chat_store.search("network filesys")
+    assert [(r[0], r[1]) for r in results] == [(chat.chat_id, 2)]
+    assert "\x02network\x03" in results[0][3]
+
+    results = chat_store.search("watcher")
+    assert {(r[0], r[1]) for r in results} == {(chat.chat_id, -1), (chat.chat_id, 1)}
+    assert chat_store.search('"(') == []
+
+    assert other_chat.chat_id is not None
+    chat_store.delete(other_chat.chat_id)
+    assert chat_store.search("embedder") == []
+
+
+@pytest.mark.asyncio
+async def test_async_turn(test_directory: str, config: Config, client: OpenAI | Mistral):
+    chat = Chat(client, config.model.model, config, test_directory)
+    start_turn = chat._start_turn
+    threads = []
+
+    def record_thread(*args):
+        threads.append(threading.current_thread())
+        return start_turn(*args)
+
+    # Starting a turn counts tokens and may read older messages, which would block the loop
+    chat._start_turn = record_thread
+    chunks = [c async for c in chat.user_message_async("Just say hi", [], False)]
+    assert chunks
+    assert threads and threading.main_thread() not in threads
+
+    async_client = chat._async_openai
+    await chat.aclose()
+    assert chat._async_openai is None
+    assert async_client is None or async_client.is_closed()
@@ -0,0 +1,24 @@
+import json
+import os
+import tempfile
+
+from filechat import command_parser
+from filechat.cli import run
+from filechat.config import Config
+
+
+def test_index_and_search(test_directory, config: Config, capsys):
+    config_path = os.path.join(tempfile.mkdtemp(), "filechat.json")
+    with open(config_path, "w") as f:
+        f.write(config.model_dump_json())
+
+    run(command_parser.parse_args(["index", test_directory, "-c", config_path]))
+    output = capsys.readouterr().out
+    assert "6 of 6 files (re)indexed" in output
+
+    query = "content of test.py"
+    run(command_parser.parse_args(["search", test_directory, query, "-k", "3", "-c", config_path]))
+    results = json.loads(capsys.readouterr().out)
+    assert len(results) == 3
+    assert {"path", "score"} == set(results[0])
+    assert results[0]["score"] >= results[-1]["score"]
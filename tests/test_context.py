@@ -0,0 +1,141 @@
+from filechat.config import Config
+from filechat.context import ContextBuilder
+from filechat.index import IndexedFile
+
+
+def _conversation(num_turns: int, tool_output: str) -> list[dict]:
+    conversation = []
+    for i in range(num_turns):
+        conversation += [
+            {"role": "user", "content": f"Question {i}"},
+            {
+                "role": "assistant",
+                "content": "",
+                "tool_calls": [
+                    {
+                        "id": f"call_{i}",
+                        "type": "function",
+                        "function": {"name": "read_file", "arguments": '{"path": "a.py"}'},
+                    }
+                ],
+            },
+            {
+                "tool_call_id": f"call_{i}",
+                "role": "tool",
+                "name": "read_file",
+                "content": tool_output,
+            },
+            {"role": "assistant", "content": f"Answer {i}", "files_used": []},
+        ]
+    return conversation
+
+
+def test_files_packed_by_relevance(test_directory: str, config: Config):
+    with open(f"{test_directory}/large.txt", "w") as f:
+        f.write("word " * 4000)
+
+    files = [IndexedFile(test_directory, p) for p in ("test.md", "large.txt", "test.py")]
+    config.model.max_context_tokens = 4000
+    builder = ContextBuilder(config)
+    history = [{"role": "system", "content": "System"}, {"role": "user", "content": "Hi"}]
+
+    messages, files_used = builder.build(history, files)
+
+    assert [f.path() for f in files_used] == ["test.md", "test.py"]
+    assert "large.txt" not in messages[-1]["content"]
+    assert messages[-1]["content"].endswith("Hi")
+    assert "files_used" not in messages[-1]
+
+
+def test_request_prefix_is_stable(test_directory: str, config: Config):
+    files = [IndexedFile(test_directory, "test.md")]
+    builder = ContextBuilder(config)
+    history = [{"role": "system", "content": "System"}, {"role": "user", "content": "Hi"}]
+
+    first, _ = builder.build(history, files)
+    history += [
+        {"role": "assistant", "content": "Hello", "files_used": ["test.md"]},
+        {"role": "user", "content": "Tell me more"},
+    ]
+    second, _ = builder.build(history, files)
+
+    assert second[: len(first)] == first
+    assert "test.md" in first[1]["content"]
+
+
+def test_unchanged_files_referenced(test_directory: str, config: Config):
+    builder = ContextBuilder(config)
+    history = [{"role": "system", "content": "System"}, {"role": "user", "content": "Hi"}]
+    builder.build(history, [IndexedFile(test_directory, "test.md")])
+
+    with open(f"{test_directory}/test.py", "w") as f:
+        f.write("print('changed')")
+
+    read_file_hash = IndexedFile(test_directory, "test.txt").hash()
+    history += [
+        {"role": "assistant", "content": "Hello"},
+        {
+            "tool_call_id": "call_1",
+            "role": "tool",
+            "name": "read_file",
+            "content": "...",
+            "file": ["test.txt", read_file_hash],
+        },
+        {"role": "user", "content": "Tell me more"},
+    ]
+    files = [IndexedFile(test_directory, p) for p in ("test.md", "test.txt", "test.py")]
+    messages, files_used = builder.build(history, files)
+
+    context = messages[-1]["content"]
+    assert len(files_used) == 3
+    assert "<file_ref>test.md</file_ref>" in context
+    assert "<file_ref>test.txt</file_ref>" in context
+    assert "print('changed')" in context
+
+
+def test_compacted_prefix_is_stable(config: Config):
+    config.model.max_context_tokens = 6000
+    builder = ContextBuilder(config)
+    history = [{"role": "system", "content": "System"}] + _conversation(4, "x" * 4000)
+    history.append({"role": "user", "content": "Next question"})
+
+    first, _ = builder.build(history, [])
+    history.append({"role": "assistant", "content": "Next answer"})
+    history.append({"role": "user", "content": "Another question"})
+    second, _ = builder.build(history, [])
+
+    assert len(first) < len(history)
+    assert second[: len(first) - 1] == first[:-1]
+
+
+def test_no_compaction_within_budget(config: Config):
+    builder = ContextBuilder(config)
+    conversation = _conversation(3, "short output")
+    assert builder.compact(conversation, 100000) == conversation
+
+
+def test_old_tool_outputs_compacted_first(config: Config):
+    builder = ContextBuilder(config)
+    conversation = _conversation(4, "x" * 4000)
+    budget = builder.token_counter.count_messages(conversation) - 1500
+
+    compacted = builder.compact(conversation, budget)
+
+    assert len(compacted) == len(conversation)
+    assert builder.token_counter.count_messages(compacted) <= budget
+    assert "omitted" in compacted[2]["content"]
+    assert compacted[-2]["content"] == "x" * 4000
+
+
+def test_oldest_turns_dropped(config: Config):
+    builder = ContextBuilder(config)
+    conversation = _conversation(6, "x" * 4000)
+    last_turn = conversation[-4:]
+    budget = builder.token_counter.count_messages(last_turn) + 200
+
+    compacted = builder.compact(conversation, budget)
+
+    assert compacted[0]["role"] == "system"
+    assert "Question 0" in compacted[0]["content"]
+    assert compacted[-4:] == last_turn
+    assert builder.token_counter.count_messages(compacted) <= budget
@@ -0,0 +1,61 @@
+import os
+import threading
+import time
+
+import pytest
+
+from filechat.config import Config
+from filechat.daemon import Daemon, DaemonError, RemoteIndex, connect
+from filechat.index import IndexStore
+
+
+def test_daemon(test_directory, config: Config):
+    daemon = Daemon(config)
+    daemon.STORE_DELAY_S = 0.1
+    # A daemon thread doesn't keep pytest from exiting if the test fails before stopping it
+    thread = threading.Thread(target=daemon.serve, daemon=True)
+    thread.start()
+
+    client = None
+    for _ in range(100):
+        client = connect(config)
+        if client is not None:
+            break
+        time.sleep(0.05)
+    assert client is not None
+
+    try:
+        index = RemoteIndex(client, test_directory)
+        assert index.open() == 6
+
+        files = index.query("content of test.py", top_k=3)
+        assert len(files) == 3
+        assert files[0].content() == f"This is the content of {files[0].path()}"
+        assert index.file("test.md").content() == "This is the content of test.md"
+        assert index.file("missing.md") is None
+
+        grep = index.run_index_tool("grep", {"pattern": "test.json"})
+        assert [m["path"] for m in grep["matches"]] == ["test.json"]
+
+        status = client.request("status")
+        assert status["projects"] == [{"directory": index.directory(), "files": 6}]
+        with pytest.raises(DaemonError):
+            client.request("unknown")
+
+        # Changes made by the watcher are stored while the daemon runs
+        with open(os.path.join(test_directory, "new.md"), "w") as f:
+            f.write("This file is new")
+        stored = None
+        for _ in range(100):
+            stored = IndexStore(config.index_store_path).load(test_directory, None)
+            if stored.file("new.md") is not None:
+                break
+            time.sleep(0.05)
+        assert stored.file("new.md") is not None
+    finally:
+        client.request("stop")
+        client.close()
+
+    thread.join(timeout=10)
+    assert not thread.is_alive()
+    assert connect(config) is None
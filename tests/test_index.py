@@ -5,6 +5,8 @@ import pytest
 from filechat import get_index
 from filechat.config import Config
 from filechat.embedder import Embedder
+from filechat.index import ShardedIndex, load_index, update_index
+from filechat.tools import grep, search_code
 
 
 @pytest.fixture
@@ -124,3 +126,105 @@ def test_rebuild(test_directory, config: Config, embedder: Embedder):
     assert num_indexed == 0
     _, num_indexed = get_index(test_directory, config, embedder, True)
     assert num_indexed == len(os.listdir(test_directory))
+
+
+def test_sharded_index(test_directory, config: Config, embedder: Embedder):
+    for path in ["api/server.py", "api/routes/users.py", "web/app.js"]:
+        os.makedirs(os.path.join(test_directory, os.path.dirname(path)), exist_ok=True)
+        with open(os.path.join(test_directory, path), "w") as f:
+            f.write(f"This is the content of {path}")
+
+    get_index(test_directory, config, embedder)
+    config.index_shard_depth = 1
+    index = load_index(test_directory, config, embedder)
+    assert isinstance(index, ShardedIndex)
+    assert update_index(index, config) == 0
+    assert len(index.files()) == 9
+
+    index = load_index(test_directory, config, embedder)
+    assert update_index(index, config) == 0
+    assert index.loaded_shards() == []
+    users_file = index.file("api/routes/users.py")
+    assert users_file.content() == "This is the content of api/routes/users.py"
+    assert index.loaded_shards() == ["api"]
+
+    with open(os.path.join(test_directory, "web", "app.js"), "a") as f:
+        f.write("\nconsole.log('changed')")
+    assert update_index(index, config) == 1
+    assert sorted(index.changed_shards()) == []
+    assert sorted(index.loaded_shards()) == ["api", "web"]
+
+    assert len(index.query("content of test.py", top_k=4)) == 4
+    assert sorted(index.loaded_shards()) == ["", "api", "web"]
+
+    assert index.remove_file("api/server.py")
+    assert index.file("api/server.py") is None
+    assert len(index.files()) == 8
+
+
+def test_sharded_index_loads_needed_shards(test_directory, config: Config, embedder: Embedder):
+    for name in ["api", "web", "docs", "tools"]:
+        os.makedirs(os.path.join(test_directory, name))
+        with open(os.path.join(test_directory, name, "main.py"), "w") as f:
+            f.write(f"def {name}_main():\n    pass\n")
+
+    config.index_shard_depth = 1
+    get_index(test_directory, config, embedder)
+    index = load_index(test_directory, config, embedder)
+    index.QUERIED_SHARDS = 1
+    assert index.num_files() == 10
+    assert index.loaded_shards() == []
+
+    assert len(index.query("content of test.py", top_k=3)) == 3
+    assert len(index.loaded_shards()) == 1
+
+    index = load_index(test_directory, config, embedder)
+    index.QUERIED_SHARDS = 1
+    definitions = index.symbols().definitions("docs_main")
+    assert [d.path for d in definitions] == [os.path.join("docs", "main.py")]
+    assert index.loaded_shards() == ["docs"]
+
+    index.query("what does `web_main` do", top_k=3)
+    assert "web" in index.loaded_shards()
+    assert len(index.loaded_shards()) <= 3
+
+    index = load_index(test_directory, config, embedder)
+    index.QUERIED_SHARDS = 1
+    results = search_code(index, "what does `web_main` do", 2)
+    assert results[0]["path"] == os.path.join("web", "main.py")
+    assert len(index.loaded_shards()) <= 2
+
+    index = load_index(test_directory, config, embedder)
+    matches = grep(index, "def", path="tools")["matches"]
+    assert [m["path"] for m in matches] == [os.path.join("tools", "main.py")]
+    assert [m["path"] for m in grep(index, "content", path="test.md")["matches"]] == ["test.md"]
+    assert sorted(index.loaded_shards()) == ["", "tools"]
+
+    with open(os.path.join(test_directory, "api", "main.py"), "a") as f:
+        f.write("\napi_main()\n")
+    assert index.add_files([os.path.join("api", "main.py")]) == 1
+    index.SHARD_IDLE_S = 0
+    index.evict_idle_shards()
+    assert index.loaded_shards() == ["api"]
+
+
+def test_new_sharded_index_evicts_only_stored_shards(
+    test_directory, config: Config, embedder: Embedder
+):
+    os.makedirs(os.path.join(test_directory, "api"))
+    with open(os.path.join(test_directory, "api", "main.py"), "w") as f:
+        f.write("def main():\n    pass\n")
+
+    config.index_shard_depth = 1
+    index = load_index(test_directory, config, embedder, rebuild=True)
+    index.SHARD_IDLE_S = 0
+    index.add_files([os.path.join("api", "main.py")])
+    index.evict_idle_shards()
+    assert index.loaded_shards() == ["api"]
+
+    update_index(index, config)
+    index.evict_idle_shards()
+    assert index.loaded_shards() == []
+    assert index.file(os.path.join("api", "main.py")) is not None
+    assert index.add_files([os.path.join("api", "main.py")]) == 0
+    assert len(load_index(test_directory, config, embedder).files()) == index.num_files() == 7
@@ -0,0 +1,103 @@
+import json
+import os
+import tempfile
+
+import pytest
+from mistralai import Mistral
+from openai import OpenAI
+
+from filechat import command_parser, metrics
+from filechat.chat import Chat
+from filechat.cli import run
+from filechat.config import Config
+
+
+@pytest.fixture
+def registry():
+    metrics.enable()
+    yield metrics.Registry()
+    metrics.disable()
+    metrics.REGISTRY.reset()
+
+
+def test_metrics_are_only_recorded_when_enabled(registry: metrics.Registry):
+    counter = registry.counter("test_total", "Test counter")
+    histogram = registry.histogram("test_seconds", "Test histogram")
+
+    metrics.disable()
+    counter.inc()
+    with histogram.time():
+        pass
+    assert counter.value() == 0
+    assert histogram.count() == 0
+
+    metrics.enable()
+    counter.inc(2)
+    with histogram.time():
+        pass
+    assert counter.value() == 2
+    assert histogram.count() == 1
+    assert registry.counter("test_total", "Test counter") is counter
+
+
+def test_histogram_quantiles(registry: metrics.Registry):
+    histogram = registry.histogram("test_values", "Test histogram", (1, 2, 4, 8))
+    for value in (0.5, 1.5, 1.5, 3, 7):
+        histogram.observe(value)
+
+    assert histogram.count() == 5
+    assert histogram.sum() == pytest.approx(13.5)
+    assert histogram.max() == 7
+    assert histogram.cumulative_counts() == [1, 3, 4, 5, 5]
+    assert 1 <= histogram.quantile(0.5) <= 2
+    assert 4 <= histogram.quantile(0.95) <= 7
+
+
+def test_export_formats(registry: metrics.Registry):
+    registry.counter("test_lookups_total", "Lookups", result="hit").inc(3)
+    registry.counter("test_lookups_total", "Lookups", result="miss").inc()
+    registry.histogram("test_seconds", "Durations", (0.1, 1)).observe(0.5)
+
+    text = registry.to_prometheus()
+    assert text.count("# TYPE test_lookups_total counter") == 1
+    assert 'test_lookups_total{result="hit"} 3' in text
+    assert 'test_seconds_bucket{le="0.1"} 0' in text
+    assert 'test_seconds_bucket{le="1"} 1' in text
+    assert 'test_seconds_bucket{le="+Inf"} 1' in text
+    assert "test_seconds_sum 0.5" in text
+    assert "test_seconds_count 1" in text
+
+    exported = {m["name"] + str(m["labels"]): m for m in json.loads(registry.to_json())}
+    assert exported["test_lookups_total{'result': 'miss'}"]["value"] == 1
+    assert exported["test_seconds{}"]["buckets"] == {"0.1": 0, "1": 1, "+Inf": 1}
+
+
+def test_metrics_file(registry, test_directory, config: Config, capsys):
+    temp_dir = tempfile.mkdtemp()
+    config_path = os.path.join(temp_dir, "filechat.json")
+    metrics_path = os.path.join(temp_dir, "metrics.json")
+    with open(config_path, "w") as f:
+        f.write(config.model_dump_json())
+
+    args = ["index", test_directory, "-c", config_path, "--metrics-file", metrics_path]
+    run(command_parser.parse_args(args))
+    capsys.readouterr()
+
+    with open(metrics_path) as f:
+        exported = {m["name"]: m for m in json.load(f)}
+    assert exported["filechat_scan_seconds"]["count"] == 1
+    assert exported["filechat_read_seconds"]["count"] == 6
+    assert exported["filechat_hash_seconds"]["count"] == 6
+    assert exported["filechat_faiss_add_seconds"]["count"] >= 1
+
+
+def test_tool_seconds(registry, test_directory: str, config: Config, client: OpenAI | Mistral):
+    chat = Chat(client, config.model.model, config, test_directory)
+    chat._call_tool("read_file", '{"path": "test.md"}')
+    chat._call_tool("made_up_tool", "{}")
+
+    exported = [m for m in metrics.REGISTRY.to_dict() if m["name"] == "filechat_tool_seconds"]
+    counts = {m["labels"]["tool"]: m["count"] for m in exported}
+    assert counts["read_file"] == 1
+    assert counts["unknown"] == 1
+    assert "made_up_tool" not in counts
@@ -0,0 +1,27 @@
+import subprocess
+import sys
+
+
+def test_heavy_imports_are_deferred():
+    code = (
+        "import sys, filechat; filechat.arg_parser.parse_args(['.']);"
+        "print(' '.join(m for m in ('openai', 'mistralai', 'textual', 'faiss', 'onnxruntime',"
+        " 'watchdog', 'pydantic', 'rich') if m in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == ""
+
+
+def test_daemon_client_doesnt_import_index_backends():
+    # What the chat UI imports when a daemon keeps the indexes
+    code = (
+        "import sys, filechat.chat, filechat.daemon, filechat.tui, filechat.workspace;"
+        "print(' '.join(m for m in ('faiss', 'onnxruntime', 'tokenizers', 'watchdog')"
+        " if m in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == ""
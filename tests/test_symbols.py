@@ -0,0 +1,153 @@
+from filechat.symbols import SymbolIndex, code_names, extract_symbols
+
+PYTHON_SOURCE = """\
+import os
+from typing import NamedTuple as Tuple
+
+LIMIT = 10
+
+
+class Parser:
+    def parse(self, text):
+        def helper():
+            pass
+        return text.split()
+
+
+async def main():
+    pass
+"""
+
+GO_SOURCE = """\
+package main
+
+import (
+    "fmt"
+    str "strings"
+)
+
+type Server struct {
+    port int
+}
+
+func (s *Server) Start() error {
+    return nil
+}
+
+func main() {
+    fmt.Println(str.ToUpper("hi"))
+}
+"""
+
+C_SOURCE = """\
+#include <stdio.h>
+#define MAX_SIZE 10
+
+typedef struct node {
+    int value;
+} Node;
+
+static int count_nodes(Node *head)
+{
+    if (head == NULL) {
+        return 0;
+    }
+    return 1;
+}
+"""
+
+
+def _kinds(symbols) -> list[tuple[str, str]]:
+    return [(s.name, s.kind) for s in symbols]
+
+
+def test_python_symbols():
+    symbols = extract_symbols("parser.py", PYTHON_SOURCE)
+    assert _kinds(symbols) == [
+        ("os", "import"),
+        ("Tuple", "import"),
+        ("LIMIT", "variable"),
+        ("Parser", "class"),
+        ("parse", "method"),
+        ("helper", "function"),
+        ("main", "function"),
+    ]
+    assert symbols[4].line == 8
+    assert symbols[4].signature == "def parse(self, text):"
+
+
+def test_python_syntax_error():
+    assert extract_symbols("broken.py", "def broken(:\n") == []
+
+
+def test_javascript_symbols():
+    source = (
+        "import React, { useState as useLocalState } from 'react';\n"
+        "export default class App {\n"
+        "  render() {\n"
+        "    if (this.ready) {\n"
+        "    }\n"
+        "  }\n"
+        "}\n"
+        "export const API_URL = 'http://localhost';\n"
+        "export interface Props {}\n"
+    )
+    assert _kinds(extract_symbols("app.tsx", source)) == [
+        ("React", "import"),
+        ("useLocalState", "import"),
+        ("App", "class"),
+        ("render", "method"),
+        ("API_URL", "variable"),
+        ("Props", "interface"),
+    ]
+
+
+def test_go_symbols():
+    assert _kinds(extract_symbols("main.go", GO_SOURCE)) == [
+        ("fmt", "import"),
+        ("str", "import"),
+        ("Server", "struct"),
+        ("Start", "method"),
+        ("main", "function"),
+    ]
+
+
+def test_c_symbols():
+    assert _kinds(extract_symbols("list.c", C_SOURCE)) == [
+        ("stdio.h", "import"),
+        ("MAX_SIZE", "macro"),
+        ("node", "struct"),
+        ("Node", "type"),
+        ("count_nodes", "function"),
+    ]
+
+
+def test_incremental_update():
+    symbols = SymbolIndex()
+    symbols.update_file("a.py", "def first():\n    pass\n")
+    symbols.update_file("b.py", "from a import first\n\nfirst()\n")
+
+    assert [s.path for s in symbols.definitions("first")] == ["a.py"]
+    assert [s.path for s in symbols.definitions("first", include_imports=True)] == [
+        "a.py",
+        "b.py",
+    ]
+    assert symbols.references("first") == ["a.py", "b.py"]
+
+    symbols.update_file("a.py", "def second():\n    pass\n")
+    assert [s.path for s in symbols.definitions("first")] == []
+    assert symbols.references("first") == ["b.py"]
+
+    symbols.remove_file("b.py")
+    assert symbols.references("first") == []
+    assert len(symbols) == 1
+
+
+def test_code_names():
+    assert code_names("How do I start the file watcher?") == []
+    assert code_names("Where is FileIndex built, and what do `start` and load_index do?") == [
+        "start",
+        "FileIndex",
+        "load_index",
+    ]
+    assert code_names("Is HTTPServer or renderTree used?") == ["HTTPServer", "renderTree"]
@@ -1,33 +1,196 @@
+import os
+
 from filechat.config import Config
-from filechat.tools import list_directory
+from filechat.embedder import Embedder
+from filechat.index import FileIndex, get_index
+from filechat.tools import find_symbol, grep, list_directory, read_file, search_code
+from filechat.tree import ProjectTree
 from pathlib import Path
-from pytest import raises
+from pytest import approx, fixture, raises
+
+
+@fixture
+def code_index(test_directory: str, config: Config) -> FileIndex:
+    os.makedirs(os.path.join(test_directory, "src"))
+    with open(os.path.join(test_directory, "src", "parser.py"), "w") as f:
+        f.write("class Parser:\n    def parse(self, text):\n        return text.split()\n")
+    with open(os.path.join(test_directory, "src", "tree.js"), "w") as f:
+        f.write("export function renderTree(node) {\n  return node;\n}\n")
+
+    embedder = Embedder(
+        config.embedding_model, config.embedding_model_path, config.embedding_model_url
+    )
+    index, _ = get_index(test_directory, config, embedder)
+    return index
+
 
+@fixture
+def project_tree(config: Config) -> ProjectTree:
+    tree = ProjectTree(".", config)
+    tree.scan()
+    return tree
 
-def test_list_directory(config: Config):
-    directory_contents = list_directory(Path("."), ".", config)
 
-    assert {"name": "README.md", "type": "file"} in directory_contents
-    assert {"name": "pyproject.toml", "type": "file"} in directory_contents
-    assert {"name": "src", "type": "directory"} in directory_contents
+def test_list_directory(project_tree: ProjectTree):
+    directory_contents = list_directory(project_tree, ".")["entries"]
+    entries = {(e["name"], e["type"]) for e in directory_contents}
 
-    assert {"name": "uv.lock", "type": "file"} not in directory_contents
-    assert {"name": ".git", "type": "directory"} not in directory_contents
+    assert ("README.md", "file") in entries
+    assert ("pyproject.toml", "file") in entries
+    assert ("src", "directory") in entries
 
+    assert ("uv.lock", "file") not in entries
+    assert (".git", "directory") not in entries
 
-def test_list_directory_is_file(config: Config):
+    pyproject = next(e for e in directory_contents if e["name"] == "pyproject.toml")
+    assert pyproject["size"] == os.path.getsize("pyproject.toml")
+
+
+def test_list_directory_is_file(project_tree: ProjectTree):
     with raises(FileNotFoundError):
-        list_directory(Path("."), "pyproject.toml", config)
+        list_directory(project_tree, "pyproject.toml")
 
 
-def test_list_directory_not_exists(config: Config):
+def test_list_directory_not_exists(project_tree: ProjectTree):
     with raises(FileNotFoundError):
-        list_directory(Path("."), "something_that_is_not_here", config)
+        list_directory(project_tree, "something_that_is_not_here")
 
 
-def test_list_directory_outside_project(config: Config):
+def test_list_directory_outside_project(project_tree: ProjectTree):
     with raises(ValueError):
-        list_directory(Path("."), "/home/", config)
+        list_directory(project_tree, "/home/")
+
+    with raises(ValueError):
+        list_directory(project_tree, "..")
+
+
+def test_list_directory_recursive(test_directory: str, config: Config):
+    os.makedirs(os.path.join(test_directory, "src", "utils"))
+    with open(os.path.join(test_directory, "src", "main.py"), "w") as f:
+        f.write("print('main')")
+    with open(os.path.join(test_directory, "src", "utils", "helpers.py"), "w") as f:
+        f.write("pass")
+    tree = ProjectTree(test_directory, config)
+    tree.scan()
+
+    listing = list_directory(tree, "src", depth=2)
+    assert (listing["path"], listing["files"], listing["size"]) == ("src", 2, 17)
+    assert listing["entries"] == [
+        {
+            "name": "utils",
+            "type": "directory",
+            "files": 1,
+            "size": 4,
+            "entries": [{"name": "helpers.py", "type": "file", "size": 4}],
+        },
+        {"name": "main.py", "type": "file", "size": 13},
+    ]
+
+    listing = list_directory(tree, ".", depth=3, max_entries=4)
+    assert len(listing["entries"]) == 4
+    assert listing["truncated"]
+
+    os.remove(os.path.join(test_directory, "src", "utils", "helpers.py"))
+    os.rmdir(os.path.join(test_directory, "src", "utils"))
+    tree.remove_file(os.path.join("src", "utils", "helpers.py"))
+    assert list_directory(tree, "src")["entries"] == [
+        {"name": "main.py", "type": "file", "size": 13}
+    ]
+    assert list_directory(tree, ".")["files"] == 7
+
+
+def test_read_file_lines(test_directory: str, config: Config):
+    with open(os.path.join(test_directory, "app.log"), "w") as f:
+        f.write("".join(f"line {i}\n" for i in range(1, 101)))
+    config.allowed_suffixes.append(".log")
+    project = Path(test_directory)
+
+    result = read_file(project, "app.log", config, start_line=10, end_line=12)
+    assert result["content"] == "line 10\nline 11\nline 12\n"
+    assert (result["start_line"], result["end_line"], result["total_lines"]) == (10, 12, 100)
+
+    result = read_file(project, "app.log", config, start_line=99, end_line=500)
+    assert result["content"] == "line 99\nline 100\n"
+    assert result["end_line"] == 100
 
     with raises(ValueError):
-        list_directory(Path("."), "..", config)
+        read_file(project, "app.log", config, start_line=101)
+
+
+def test_read_file_large(test_directory: str, config: Config):
+    with open(os.path.join(test_directory, "large.txt"), "w") as f:
+        f.write("x" * 1000 + "\n" + "y" * 2000 + "\n")
+    config.max_file_size_kb = 2
+    project = Path(test_directory)
+
+    with raises(ValueError):
+        read_file(project, "large.txt", config)
+
+    result = read_file(project, "large.txt", config, start_line=1)
+    assert result["content"] == "x" * 1000 + "\n"
+    assert result["end_line"] == 1
+    assert result["truncated"]
+
+    result = read_file(project, "large.txt", config, offset=995, length=10)
+    assert result["content"] == "xxxxx\nyyyy"
+    assert result["size"] == 3002
+    assert "truncated" not in result
+
+
+def test_search_code(code_index: FileIndex):
+    results = search_code(code_index, "split text into words with the parser", 2)
+
+    assert len(results) == 2
+    assert results[0]["path"] == os.path.join("src", "parser.py")
+    assert "return text.split()" in results[0]["snippet"]
+
+
+def test_symbol_match_bonus(code_index: FileIndex):
+    query_embedding = code_index.embed_query("what does render tree do")
+    plain = code_index.query_with_scores("what does render tree do", 10, query_embedding)
+    scores = {f.path(): score for f, score in plain}
+    tree_path = os.path.join("src", "tree.js")
+
+    hits = code_index.query_with_scores("what does `renderTree` do", 10, query_embedding)
+    assert [score for _, score in hits] == sorted((score for _, score in hits), reverse=True)
+    for indexed_file, score in hits:
+        bonus = FileIndex.SYMBOL_MATCH_BONUS if indexed_file.path() == tree_path else 0
+        assert score == approx(scores[indexed_file.path()] + bonus)
+
+    # Files outside of the nearest ones get the bonus on top of their own similarity too
+    hits = code_index.query_with_scores("what does `renderTree` do", 1, query_embedding)
+    expected = max(plain[0][1], scores[tree_path] + FileIndex.SYMBOL_MATCH_BONUS)
+    assert hits[0][1] == approx(expected)
+
+
+def test_grep(code_index: FileIndex):
+    result = grep(code_index, r"return \w+", path="src")
+    assert [(m["path"], m["line"]) for m in result["matches"]] == [
+        (os.path.join("src", "parser.py"), 3),
+        (os.path.join("src", "tree.js"), 2),
+    ]
+    assert not result["truncated"]
+
+    result = grep(code_index, "content", ignore_case=True, max_matches=2)
+    assert len(result["matches"]) == 2
+    assert result["truncated"]
+
+    with raises(ValueError):
+        grep(code_index, "(")
+
+
+def test_find_symbol(code_index: FileIndex):
+    result = find_symbol(code_index, "renderTree")
+    assert result["definitions"] == [{
+        "path": os.path.join("src", "tree.js"),
+        "line": 1,
+        "kind": "function",
+        "text": "export function renderTree(node) {",
+    }]
+    assert result["referenced_in"] == [os.path.join("src", "tree.js")]
+
+    result = find_symbol(code_index, "parse")
+    assert [(d["path"], d["kind"]) for d in result["definitions"]] == [
+        (os.path.join("src", "parser.py"), "method")
+    ]
+    assert find_symbol(code_index, "render")["definitions"] == []
@@ -0,0 +1,164 @@
+import asyncio
+import threading
+from collections.abc import Callable
+from typing import cast
+
+import pytest
+from mistralai import Mistral
+from openai import OpenAI
+from textual.app import App, ComposeResult
+from textual.pilot import Pilot
+from textual.screen import Screen
+from textual.widgets import ListItem, Static
+
+from filechat.chat import Chat, ChatStore
+from filechat.config import Config
+from filechat.embedder import Embedder
+from filechat.index import get_index
+from filechat.tui import (
+    FilechatApp,
+    HistoryScreen,
+    SearchScreen,
+    StreamingResponse,
+    Transcript,
+    TranscriptEntry,
+    message_entries,
+)
+
+
+class TranscriptApp(App):
+    def __init__(self, transcript: Transcript):
+        super().__init__()
+        self.transcript = transcript
+
+    def compose(self) -> ComposeResult:
+        yield self.transcript
+
+
+class ScreenApp(App):
+    def __init__(self, make_screen: Callable[[], Screen]):
+        super().__init__()
+        self.make_screen = make_screen
+        self.results = []
+
+    def on_mount(self):
+        self.push_screen(self.make_screen(), callback=self.results.append)
+
+
+async def wait_until(pilot: Pilot, condition: Callable[[], bool]):
+    for _ in range(100):
+        if condition():
+            return
+        await pilot.pause(0.02)
+
+
+@pytest.mark.asyncio
+async def test_transcript_virtualization():
+    messages = [{"role": "system", "content": "system prompt"}]
+    for i in range(250):
+        messages.append({"role": "user", "content": f"Question {i}"})
+        answer = "\n".join(f"Line {j} of answer {i}" for j in range(i % 30 + 1))
+        messages.append({"role": "assistant", "content": answer, "files_used": ["a.py"]})
+
+    transcript = Transcript()
+    app = TranscriptApp(transcript)
+
+    async with app.run_test(headless=True, size=(80, 40)) as pilot:
+        transcript.set_entries(message_entries(messages))
+        await pilot.pause()
+
+        user_messages = cast(list[Static], list(app.query("Static.user")))
+        assert len(transcript.entries()) == 750
+        assert 0 < len(user_messages) < 10
+        assert user_messages[0].content == "Question 0"
+
+        # Message 201 is the 101st user message
+        transcript.scroll_to_message(201)
+        await pilot.pause()
+        await pilot.pause()
+
+        visible = [w for w in app.query("Static.user") if w.region.y == 0]
+        assert len(visible) == 1
+        assert cast(Static, visible[0]).content == "Question 100"
+        assert len(app.query(Static)) < 40
+
+        transcript.prepend_entries([TranscriptEntry("Older question", "user", "User")])
+        await pilot.pause()
+        await pilot.pause()
+
+        visible = [w for w in app.query("Static.user") if w.region.y == 0]
+        assert cast(Static, visible[0]).content == "Question 100"
+
+
+@pytest.mark.asyncio
+async def test_chat_screens(test_directory: str, config: Config, client: OpenAI | Mistral):
+    chat_store = ChatStore(test_directory, config, client)
+    for i in range(3):
+        chat = chat_store.new_chat()
+        chat.messages.append({"role": "user", "content": f"Question {i}"})
+        chat_store.store(chat)
+
+    # Chats are read in worker threads, so the screens fill in after they're shown
+    reading_threads = []
+    for name in ("chat_list", "load", "search"):
+        read = getattr(chat_store, name)
+
+        def read_in_thread(*args, read=read):
+            reading_threads.append(threading.current_thread())
+            return read(*args)
+
+        setattr(chat_store, name, read_in_thread)
+
+    app = ScreenApp(lambda: HistoryScreen(chat_store))
+    async with app.run_test(headless=True) as pilot:
+        await wait_until(pilot, lambda: len(app.screen.query(ListItem)) == 3)
+        assert len(app.screen.query(ListItem)) == 3
+        await pilot.press("enter")
+        await wait_until(pilot, lambda: bool(app.results))
+    assert app.results[0].title == "Question 2"
+    assert app.results[0].messages[-1] == {"role": "user", "content": "Question 2"}
+
+    app = ScreenApp(lambda: SearchScreen(chat_store, "question"))
+    async with app.run_test(headless=True) as pilot:
+        await wait_until(pilot, lambda: len(app.screen.query(ListItem)) == 6)
+        # The title and the message of every chat match
+        assert len(app.screen.query(ListItem)) == 6
+        await pilot.press(*" 1")
+        await wait_until(pilot, lambda: len(app.screen.query(ListItem)) == 2)
+        assert len(app.screen.query(ListItem)) == 2
+    chat_store.close()
+    assert reading_threads and threading.main_thread() not in reading_threads
+
+
+@pytest.mark.asyncio
+async def test_paused_stream_is_painted(
+    test_directory: str, config: Config, client: OpenAI | Mistral
+):
+    embedder = Embedder(
+        config.embedding_model, config.embedding_model_path, config.embedding_model_url
+    )
+    index, _ = get_index(test_directory, config, embedder)
+    chat_store = ChatStore(test_directory, config, client, index)
+    chat = Chat(client, config.model.model, config, test_directory, index=index)
+    resume = asyncio.Event()
+
+    async def user_message_async(message, files):
+        yield "Hello"
+        await resume.wait()
+        yield " world"
+
+    chat.user_message_async = user_message_async
+    app = FilechatApp(chat, index, chat_store)
+    async with app.run_test(headless=True) as pilot:
+        await pilot.press(*"Hi", "enter")
+
+        def shown_text() -> str:
+            streams = app.query(StreamingResponse)
+            return streams.last()._text if streams else ""
+
+        # The first chunk is shown while the stream waits for the next one
+        await wait_until(pilot, lambda: bool(shown_text()))
+        assert shown_text() == "Hello"
+        resume.set()
+        await wait_until(pilot, lambda: not app._responding())
+    chat_store.close()
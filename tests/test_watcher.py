@@ -0,0 +1,55 @@
+import os
+
+from watchdog.events import FileSystemEvent, FileSystemEventHandler
+
+from filechat.config import Config
+from filechat.watcher import SnapshotPoller, plan_watches
+
+
+class RecordingHandler(FileSystemEventHandler):
+    def __init__(self):
+        super().__init__()
+        self.events: list[tuple[str, str]] = []
+
+    def on_any_event(self, event: FileSystemEvent):
+        self.events.append((event.event_type, os.path.basename(str(event.src_path))))
+
+
+def test_plan_watches_skips_ignored(test_directory: str, config: Config):
+    os.makedirs(os.path.join(test_directory, "src", "node_modules", "lib"))
+    os.makedirs(os.path.join(test_directory, "docs", "api"))
+
+    watches = dict(plan_watches(test_directory, config))
+
+    assert watches[test_directory] is False
+    assert watches[os.path.join(test_directory, "src")] is False
+    assert watches[os.path.join(test_directory, "docs")] is True
+    assert os.path.join(test_directory, "docs", "api") not in watches
+    assert all("node_modules" not in path for path in watches)
+
+
+def test_snapshot_poller(test_directory: str, config: Config):
+    os.makedirs(os.path.join(test_directory, "node_modules"))
+    handler = RecordingHandler()
+    poller = SnapshotPoller(test_directory, config, handler)
+    poller._files = poller._take_snapshot()
+
+    with open(os.path.join(test_directory, "new.py"), "w") as f:
+        f.write("print('new')")
+    with open(os.path.join(test_directory, "test.txt"), "w") as f:
+        f.write("Changed content with a different size")
+    with open(os.path.join(test_directory, "node_modules", "ignored.js"), "w") as f:
+        f.write("ignored")
+    os.remove(os.path.join(test_directory, "test.md"))
+
+    poller.poll()
+
+    assert sorted(handler.events) == [
+        ("created", "new.py"),
+        ("deleted", "test.md"),
+        ("modified", "test.txt"),
+    ]
+
+    handler.events.clear()
+    poller.poll()
+    assert handler.events == []
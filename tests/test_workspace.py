@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from filechat.config import Config
+from filechat.embedder import Embedder
+from filechat.index import IndexStore, update_index
+from filechat.workspace import get_workspace
+
+
+@pytest.fixture
+def second_directory(test_directory, config: Config):
+    # Same name as the test directory, in a different parent
+    parent = tempfile.mkdtemp()
+    directory = os.path.join(parent, os.path.basename(test_directory))
+    os.makedirs(os.path.join(directory, "lib"))
+    with open(os.path.join(directory, "lib", "util.py"), "w") as f:
+        f.write("def parse_settings(path):\n    return open(path).read()\n")
+    yield directory
+    shutil.rmtree(parent)
+    IndexStore(config.index_store_path).remove(directory)
+
+
+def test_workspace(test_directory, second_directory, config: Config):
+    embedder = Embedder(
+        config.embedding_model, config.embedding_model_path, config.embedding_model_url
+    )
+    workspace, num_indexed = get_workspace([test_directory, second_directory], config, embedder)
+    assert num_indexed == 7
+
+    first, second = workspace.roots()
+    assert second == f"{first}-2"
+    util_path = os.path.join(second, "lib", "util.py")
+
+    hits = workspace.query_with_scores("parse settings", top_k=4)
+    assert len(hits) == 4
+    assert all(0 <= score <= 1 for _, score in hits)
+    assert [score for _, score in hits] == sorted((score for _, score in hits), reverse=True)
+    assert {f.path().split(os.sep)[0] for f, _ in hits} <= {first, second}
+
+    assert workspace.file(util_path).content().startswith("def parse_settings")
+    assert workspace.file(os.path.join(first, "lib", "util.py")) is None
+    assert workspace.read_file(util_path, start_line=2, end_line=2)["path"] == util_path
+    with pytest.raises(FileNotFoundError):
+        workspace.read_file("lib/util.py")
+
+    grep = workspace.run_index_tool("grep", {"pattern": "content of test.md"})
+    assert [m["path"] for m in grep["matches"]] == [os.path.join(first, "test.md")]
+    grep = workspace.run_index_tool("grep", {"pattern": "content", "path": second})
+    assert grep["matches"] == []
+    symbol = workspace.run_index_tool("find_symbol", {"name": "parse_settings"})
+    assert [d["path"] for d in symbol["definitions"]] == [util_path]
+
+    listing = workspace.list_directory(".", depth=2)
+    assert [e["name"] for e in listing["entries"]] == [first, second]
+    assert listing["files"] == 7
+    assert listing["entries"][1]["entries"][0]["name"] == "lib"
+    assert workspace.list_directory(os.path.join(second, "lib"))["path"] == os.path.join(
+        second, "lib"
+    )
+
+    # Updating a root gives it a new tree, which listings have to use
+    with open(os.path.join(second_directory, "lib", "config.py"), "w") as f:
+        f.write("SETTINGS_PATH = 'settings.json'\n")
+    update_index(workspace.resolve(second)[1], config)
+    assert workspace.list_directory(second)["files"] == 2